@@ -0,0 +1,193 @@
+"""A persistent, content-addressed cache of downloaded benchmark inputs.
+
+Objects are stored under a hash of their ETag and size, so the same object is
+only downloaded once however many tests and staging directories use it.
+Downloads go to a temporary file that is renamed into place only once it's
+complete and checked, so an interrupted download never looks like a cached
+object. Staging directories get reflinks or hardlinks to the cached objects
+rather than copies.
+
+A hardlinked input is the cached object itself, so a test that opens its
+inputs for writing, like loompy.connect does by default, would change the
+cache. Cached objects are read-only, which stops tests that don't run as
+root, and their modification time is kept at CACHED_MTIME_NS, so that a write
+through a hardlink, which sets it to the current time, is noticed the next
+time the object is used. The object is then downloaded again.
+
+Each object's access time records when it was last used, and once the cache
+is over its size budget, the least recently used objects are evicted. Objects
+that are still hardlinked from a staging directory aren't evicted, since
+removing them wouldn't free any space, but they count against the budget, and
+a warning says so when they alone exceed it. The localizer removes staged
+inputs once the tests that use them are done, so this only lasts as long as
+the tests that are running.
+"""
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import warnings
+
+
+# ioctl that makes a file share another's extents, on filesystems that
+# support it (btrfs, xfs)
+FICLONE = 0x40049409
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "table-testing", "datasets")
+
+MD5_ETAG = re.compile("^[0-9a-f]{32}$")
+
+# Modification time of every cached object, in ns since the epoch
+CACHED_MTIME_NS = 0
+
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def _md5(path):
+    hasher = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _reflink(src_path, dest_path):
+    with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+        fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+
+
+class DatasetCache(object):
+    """Cache of downloaded objects.
+
+    Args:
+      cache_dir: where to keep the cached objects
+      max_bytes: size budget for the cache. None means unlimited.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.tmp_dir = os.path.join(cache_dir, "tmp")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._can_reflink = True
+        self._evict_lock = threading.Lock()
+
+    def object_path(self, obj):
+        """Where an object_store.ObjectInfo is kept in the cache."""
+        digest = hashlib.sha256("{}:{}".format(obj.etag, obj.size).encode()).hexdigest()
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _mark_used(self, path):
+        """Set the access time of a cached object to now, keeping its
+        modification time at CACHED_MTIME_NS.
+        """
+        os.utime(path, ns=(int(time.time() * 1e9), CACHED_MTIME_NS))
+
+    def fetch(self, store, bucket, obj):
+        """Return the path of an object in the cache, downloading it first if
+        it isn't there yet or has been written to since it was downloaded.
+        """
+        path = self.object_path(obj)
+        try:
+            stat_ = os.stat(path)
+        except FileNotFoundError:
+            stat_ = None
+        if stat_ is not None:
+            if stat_.st_mtime_ns == CACHED_MTIME_NS and stat_.st_size == obj.size:
+                self._mark_used(path)
+                return path
+            print("Cached s3://{}/{} was modified, downloading it again".format(bucket, obj.key))
+            os.remove(path)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(fd)
+        try:
+            store.download(bucket, obj.key, tmp_path, obj.size)
+            size = os.path.getsize(tmp_path)
+            if size != obj.size:
+                raise IOError("Downloaded {} bytes of s3://{}/{}, expected {}".format(
+                    size, bucket, obj.key, obj.size))
+            # ETags of objects that weren't uploaded in parts are their md5
+            if MD5_ETAG.match(obj.etag) and _md5(tmp_path) != obj.etag:
+                raise IOError("Checksum mismatch for s3://{}/{}".format(bucket, obj.key))
+            os.chmod(tmp_path, READ_ONLY)
+            self._mark_used(tmp_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.rename(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def link(self, cache_path, dest_path):
+        """Put a cached object at dest_path without copying it if possible.
+
+        Reflinks are tried first, since the staged file is then independent of
+        the cached one, then hardlinks, which are read-only like the cached
+        object, and then a plain copy if the cache and the staging directory
+        are on different filesystems.
+        """
+        if os.path.exists(dest_path) and os.path.samefile(cache_path, dest_path):
+            return
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(dest_path, threading.get_ident())
+
+        linked = False
+        if self._can_reflink:
+            try:
+                _reflink(cache_path, tmp_path)
+                linked = True
+            except OSError:
+                self._can_reflink = False
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        if not linked:
+            try:
+                os.link(cache_path, tmp_path)
+            except OSError:
+                shutil.copyfile(cache_path, tmp_path)
+
+        # Replace whatever was there, like a partial download
+        os.replace(tmp_path, dest_path)
+
+    def evict(self):
+        """Remove the least recently used objects until the cache fits its
+        budget, skipping the ones that staging directories still hardlink to.
+        """
+        if self.max_bytes is None:
+            return
+        with self._evict_lock:
+            entries = []
+            for dirpath, _, filenames in os.walk(self.objects_dir):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat_ = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat_.st_atime, stat_.st_size, stat_.st_nlink, path))
+
+            total = sum(size for _, size, _, _ in entries)
+            for _, size, nlink, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if nlink > 1:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+            if total > self.max_bytes:
+                warnings.warn(
+                    "Dataset cache is {:.1f} MB over its budget, in objects that staging "
+                    "directories still link to".format((total - self.max_bytes) / 2**20))
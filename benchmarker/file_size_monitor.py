@@ -0,0 +1,289 @@
+"""Sample how much output a test has written while it runs.
+
+Walking an output directory with thousands of chunk files on every sample is
+slow and competes with the test for metadata I/O. So where inotify is
+available, the monitor keeps a table of file sizes and only stats the files the
+kernel says have changed. Elsewhere it falls back to listing directories again
+only when their mtime changes, and stats just the files it already knows about.
+
+The output is the file or directory at the output path, along with anything
+next to it named like the output path plus an extension, since some tests add
+one (output_0.npy).
+"""
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+import time
+import warnings
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_LIBC = _load_libc()
+
+
+def _is_output(name, base_name):
+    return name == base_name or name.startswith(base_name + ".")
+
+
+class ScanTracker(object):
+    """Track the size of the output by stat'ing its files, and listing
+    directories again only when their mtime changes.
+    """
+
+    def __init__(self, output_path):
+        self.parent_dir, self.base_name = os.path.split(os.path.abspath(output_path))
+        self._listings = {}
+
+    def _list_dir(self, dir_path):
+        """Return the files and subdirectories of dir_path, from the cache if
+        the directory hasn't changed since it was last listed.
+        """
+        mtime = os.stat(dir_path).st_mtime_ns
+        cached = self._listings.get(dir_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1], cached[2]
+
+        file_paths, dir_paths = [], []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dir_paths.append(entry.path)
+                else:
+                    file_paths.append(entry.path)
+        self._listings[dir_path] = (mtime, file_paths, dir_paths)
+        return file_paths, dir_paths
+
+    def total_size(self):
+        try:
+            file_paths, dir_paths = self._list_dir(self.parent_dir)
+        except OSError:
+            return 0
+        file_paths = [path for path in file_paths
+                      if _is_output(os.path.basename(path), self.base_name)]
+        dir_paths = [path for path in dir_paths
+                     if _is_output(os.path.basename(path), self.base_name)]
+
+        total = 0
+        while file_paths or dir_paths:
+            for file_path in file_paths:
+                try:
+                    total += os.stat(file_path).st_size
+                except OSError:
+                    pass
+            file_paths = []
+            subdir_paths = []
+            for dir_path in dir_paths:
+                try:
+                    dir_file_paths, dir_subdir_paths = self._list_dir(dir_path)
+                except OSError:
+                    continue
+                file_paths.extend(dir_file_paths)
+                subdir_paths.extend(dir_subdir_paths)
+            dir_paths = subdir_paths
+        return total
+
+    def close(self):
+        pass
+
+
+class InotifyTracker(object):
+    """Track the size of the output from inotify events.
+
+    Every directory in the output is watched, along with the directory that
+    holds the output, and only the files named in events are stat'ed again.
+    """
+
+    def __init__(self, output_path):
+        if _LIBC is None:
+            raise OSError("inotify is not available")
+        self.parent_dir, self.base_name = os.path.split(os.path.abspath(output_path))
+
+        self._fd = _LIBC.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._watches = {}
+        self._sizes = {}
+        self._total = 0
+        self._rescan()
+
+    def _add_watch(self, dir_path):
+        wd = _LIBC.inotify_add_watch(self._fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dir_path)
+        self._watches[wd] = dir_path
+
+    def _set_size(self, path, size):
+        self._total += size - self._sizes.get(path, 0)
+        self._sizes[path] = size
+
+    def _forget(self, path, is_dir=False):
+        """Drop path, and everything under it if it's a directory.
+
+        Only directories need a scan of every known path. Files are forgotten
+        on every rename of a chunk file, so they're looked up directly.
+        """
+        if not is_dir:
+            self._total -= self._sizes.pop(path, 0)
+            return
+        prefix = path + os.sep
+        for known_path in [p for p in self._sizes if p.startswith(prefix)]:
+            self._total -= self._sizes.pop(known_path)
+
+    def _update_file(self, path):
+        try:
+            self._set_size(path, os.stat(path).st_size)
+        except OSError:
+            self._forget(path)
+
+    def _scan(self, path):
+        """Watch a new directory and everything under it, and record the sizes
+        of its files. Watches are added before listing, so nothing created in
+        between is missed.
+        """
+        if not os.path.isdir(path):
+            self._update_file(path)
+            return
+        for dir_path, _, file_names in os.walk(path):
+            self._add_watch(dir_path)
+            for file_name in file_names:
+                self._update_file(os.path.join(dir_path, file_name))
+
+    def _rescan(self):
+        self._sizes = {}
+        self._total = 0
+        self._add_watch(self.parent_dir)
+        for name in os.listdir(self.parent_dir):
+            if _is_output(name, self.base_name):
+                self._scan(os.path.join(self.parent_dir, name))
+
+    def _read_events(self):
+        try:
+            buf = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+            events.append((wd, mask, name))
+        return events
+
+    def total_size(self):
+        changed_paths = set()
+        new_dir_paths = set()
+        events = self._read_events()
+        while events:
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, so start over
+                    self._rescan()
+                    return self._total
+                if mask & IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                dir_path = self._watches.get(wd)
+                if dir_path is None or not name:
+                    continue
+                if dir_path == self.parent_dir and not _is_output(name, self.base_name):
+                    continue
+
+                path = os.path.join(dir_path, name)
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._forget(path, is_dir=bool(mask & IN_ISDIR))
+                    changed_paths.discard(path)
+                    new_dir_paths.discard(path)
+                elif mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        new_dir_paths.add(path)
+                else:
+                    changed_paths.add(path)
+            events = self._read_events()
+
+        for dir_path in new_dir_paths:
+            self._scan(dir_path)
+        for path in changed_paths:
+            self._update_file(path)
+        return self._total
+
+    def close(self):
+        os.close(self._fd)
+
+
+class FileSizeMonitor(threading.Thread):
+    """Monitor the size of a test's output in the background.
+
+    The size is sampled every interval seconds, and samples holds (seconds since
+    the monitor started, size in bytes) pairs.
+    """
+
+    def __init__(self, file_path, interval=0.1):
+
+        threading.Thread.__init__(self)
+        self.file_path = file_path
+        self.interval = interval
+        self.samples = []
+        try:
+            self._tracker = InotifyTracker(file_path)
+        except OSError:
+            self._tracker = ScanTracker(file_path)
+        self._start_time = time.perf_counter()
+        self._exit_event = threading.Event()
+        self.start()
+
+    @property
+    def file_sizes(self):
+        return [size for _, size in self.samples]
+
+    def _sample(self):
+        try:
+            size = self._tracker.total_size()
+        except OSError as e:
+            # Most likely out of inotify watches
+            warnings.warn("Falling back to scanning {}: {}".format(self.file_path, e))
+            self._tracker.close()
+            self._tracker = ScanTracker(self.file_path)
+            size = self._tracker.total_size()
+        self.samples.append((time.perf_counter() - self._start_time, size))
+
+    def run(self):
+        while True:
+            self._sample()
+            if self._exit_event.wait(self.interval):
+                break
+
+    def exit(self):
+        self._exit_event.set()
+        self.join()
+        self._sample()
+        self._tracker.close()
@@ -0,0 +1,121 @@
+"""Build each test's docker image once, and reuse it until the test changes.
+
+Images are keyed by a hash of the files that go into them: everything in the
+test directory, and the shared code in the build context's common directory.
+A manifest on disk maps the hashes to image ids, so on later runs an unchanged
+test doesn't go through the docker build API at all.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+
+import docker
+
+
+DEFAULT_MANIFEST_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "table-testing", "images.json")
+
+
+def _hash_files(hasher, root_dir):
+    """Add the relative paths and contents of the files under root_dir to
+    hasher, in a fixed order.
+    """
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+        for filename in sorted(filenames):
+            if filename.endswith(".pyc"):
+                continue
+            path = os.path.join(dirpath, filename)
+            hasher.update(os.path.relpath(path, root_dir).encode())
+            hasher.update(b"\0")
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(2**20), b""):
+                    hasher.update(block)
+            hasher.update(b"\0")
+
+
+def image_key(test_path, build_context):
+    """Hash the files that can go into a test's image."""
+    hasher = hashlib.sha256()
+    _hash_files(hasher, test_path)
+    common_dir = os.path.join(build_context, "common")
+    if os.path.abspath(build_context) != os.path.abspath(test_path) and os.path.isdir(common_dir):
+        hasher.update(b"common\0")
+        _hash_files(hasher, common_dir)
+    return hasher.hexdigest()
+
+
+class ImageCache(object):
+    """Build test images on demand and remember them in a manifest.
+
+    Safe to use from many threads: if several jobs need the same test's image,
+    the first builds it and the others wait for it.
+
+    Args:
+      docker_client: client to build and look up images with
+      manifest_path: json file mapping image keys to image ids
+      rebuild: ignore the manifest and build every image once, for example to
+        pick up a new base image
+    """
+
+    def __init__(self, docker_client, manifest_path=DEFAULT_MANIFEST_PATH, rebuild=False):
+        self.docker_client = docker_client
+        self.manifest_path = manifest_path
+        self.rebuild = rebuild
+        self._manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                self._manifest = json.load(manifest_file)
+        # Keys whose image has been built or found during this run
+        self._checked = set()
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._key_locks = collections.defaultdict(threading.Lock)
+
+    def _save_manifest(self):
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(self._manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _image_exists(self, image_id):
+        try:
+            self.docker_client.images.get(image_id)
+        except docker.errors.ImageNotFound:
+            return False
+        return True
+
+    def get(self, test_path, build_context):
+        """Return the id of an image for the test, building it if necessary."""
+        with self._lock:
+            key = self._keys.get(test_path)
+        if key is None:
+            key = image_key(test_path, build_context)
+        with self._lock:
+            self._keys[test_path] = key
+            key_lock = self._key_locks[key]
+
+        with key_lock:
+            with self._lock:
+                image_id = self._manifest.get(key)
+            if key in self._checked:
+                return image_id
+            if image_id is not None and not self.rebuild and self._image_exists(image_id):
+                self._checked.add(key)
+                return image_id
+
+            tag = "matrix_benchmark_{}:{}".format(os.path.basename(test_path), key[:12]).lower()
+            image, _ = self.docker_client.images.build(
+                path=build_context,
+                dockerfile=os.path.relpath(os.path.join(test_path, "Dockerfile"), build_context),
+                tag=tag)
+            print("Built", tag)
+
+            with self._lock:
+                self._manifest[key] = image.id
+                self._checked.add(key)
+                self._save_manifest()
+            return image.id
@@ -0,0 +1,173 @@
+"""Copy test inputs from the object store into staging directories.
+
+Some sources are split into thousands of small files, each of them an input.
+Rather than listing and downloading each input on its own, the localizer lists
+the inputs' common prefix once per bucket, and downloads all the objects on one
+executor that is shared by every test in the run, retrying failed downloads and
+reporting progress as it goes.
+
+Staged inputs are hardlinks to the dataset cache when they can't be reflinks,
+and a cached object can't be evicted while a staging directory links to it.
+Once a source-format combination has run, its staged inputs are removed with
+unstage, so that the cache can stay within its budget.
+"""
+import bisect
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+import urllib.parse
+
+
+def _parse_s3_path(s3_path):
+    parsed_path = urllib.parse.urlparse(s3_path)
+    return parsed_path.netloc, parsed_path.path[1:] # Strip the leading /
+
+
+class Progress(object):
+    """Count localized objects and bytes, and print the progress every
+    interval seconds.
+    """
+
+    def __init__(self, total_objects, total_bytes, interval=10):
+        self.total_objects = total_objects
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.objects = 0
+        self.bytes = 0
+        self.downloaded_bytes = 0
+        self._lock = threading.Lock()
+        self._start_time = time.perf_counter()
+        self._last_report = self._start_time
+
+    def add(self, size, downloaded):
+        with self._lock:
+            self.objects += 1
+            self.bytes += size
+            if downloaded:
+                self.downloaded_bytes += size
+            now = time.perf_counter()
+            if now - self._last_report >= self.interval:
+                self._last_report = now
+                self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self._start_time
+        print("Localized {}/{} objects, {:.1f}/{:.1f} MB, downloading at {:.1f} MB/s".format(
+            self.objects, self.total_objects, self.bytes / 2**20, self.total_bytes / 2**20,
+            self.downloaded_bytes / 2**20 / max(elapsed, 1e-9)))
+
+
+class Localizer(object):
+    """Localize inputs through a dataset cache.
+
+    Args:
+      store: object_store.S3Store or LocalStore to download from
+      dataset_cache_: dataset_cache.DatasetCache to download into
+      workers: number of concurrent downloads for the whole run
+      retries: how many times to retry a failed download
+      progress_interval: seconds between progress reports
+    """
+
+    def __init__(self, store, dataset_cache_, workers=32, retries=3, progress_interval=10):
+        self.store = store
+        self.dataset_cache = dataset_cache_
+        self.retries = retries
+        self.progress_interval = progress_interval
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # Staging dir to the paths of the objects staged in it
+        self._staged = collections.defaultdict(set)
+        self._staged_lock = threading.Lock()
+
+    def _localize_object(self, bucket, obj, staging_dir, progress):
+        downloaded = not os.path.exists(self.dataset_cache.object_path(obj))
+        for attempt in range(self.retries + 1):
+            try:
+                cache_path = self.dataset_cache.fetch(self.store, bucket, obj)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print("Retrying s3://{}/{} after error: {}".format(bucket, obj.key, e))
+                time.sleep(0.5 * 2**attempt)
+        staged_path = os.path.join(staging_dir, obj.key)
+        self.dataset_cache.link(cache_path, staged_path)
+        with self._staged_lock:
+            self._staged[staging_dir].add(staged_path)
+        progress.add(obj.size, downloaded)
+
+    def _list_inputs(self, keys_by_bucket):
+        """List the objects under each of the keys with one listing of their
+        common prefix per bucket.
+
+        Returns:
+          dict of the ObjectInfos to localize, keyed by bucket and key
+        """
+        objects = collections.defaultdict(dict)
+        for bucket, keys in keys_by_bucket.items():
+            listed = sorted(self.store.list_objects(bucket, os.path.commonprefix(keys)))
+            listed_keys = [obj.key for obj in listed]
+            for key in keys:
+                idx = bisect.bisect_left(listed_keys, key)
+                while idx < len(listed) and listed_keys[idx].startswith(key):
+                    objects[bucket][listed_keys[idx]] = listed[idx]
+                    idx += 1
+        return objects
+
+    def localize(self, inputs, staging_dir):
+        """Put the s3 inputs in the staging dir, under their keys.
+
+        This is done prior to test execution for tests that expect data to be
+        present in a local filesystem. Each input is a prefix: everything under
+        it is localized.
+
+        Returns:
+          the local path, or list of paths, of the inputs
+        """
+        s3_paths = inputs if isinstance(inputs, list) else [inputs]
+
+        keys_by_bucket = collections.defaultdict(list)
+        for s3_path in s3_paths:
+            bucket, key = _parse_s3_path(s3_path)
+            keys_by_bucket[bucket].append(key)
+
+        objects = self._list_inputs(keys_by_bucket)
+        progress = Progress(
+            sum(len(bucket_objects) for bucket_objects in objects.values()),
+            sum(obj.size for bucket_objects in objects.values() for obj in bucket_objects.values()),
+            self.progress_interval)
+
+        futures = [self._executor.submit(self._localize_object, bucket, obj, staging_dir, progress)
+                   for bucket, bucket_objects in objects.items()
+                   for obj in bucket_objects.values()]
+        done, not_done = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        _ = [f.result() for f in done]
+        progress.report()
+
+        # Everything that was just staged is linked or copied, so it's safe to
+        # evict it from the cache
+        self.dataset_cache.evict()
+
+        localized_inputs = [os.path.join(staging_dir, _parse_s3_path(s3_path)[1])
+                            for s3_path in s3_paths]
+        return localized_inputs if isinstance(inputs, list) else localized_inputs[0]
+
+    def unstage(self, staging_dir):
+        """Remove the inputs localized to staging_dir, and evict the cached
+        objects that nothing links to anymore if the cache is over budget.
+        """
+        with self._staged_lock:
+            staged_paths = self._staged.pop(staging_dir, set())
+        for staged_path in staged_paths:
+            try:
+                os.remove(staged_path)
+            except FileNotFoundError:
+                pass
+        self.dataset_cache.evict()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,135 @@
+"""Serve staged inputs over HTTP, standing in for an object store.
+
+Tests with remote inputs read them from this server with range requests, the
+way they would read from a web service. The server counts the requests it
+handles and the bytes it sends, so the benchmarker can record how much of the
+inputs each repetition actually read.
+"""
+import http.server
+import os
+import re
+import threading
+import urllib.parse
+
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open between requests, like an object store would
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _resolve(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip("/")
+        root_dir = self.server.root_dir
+        full_path = os.path.realpath(os.path.join(root_dir, path))
+        if not full_path.startswith(root_dir + os.sep) or not os.path.isfile(full_path):
+            return None
+        return full_path
+
+    def _send_error(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _respond(self, send_body):
+        self.server.count_request()
+        full_path = self._resolve()
+        if full_path is None:
+            self._send_error(404)
+            return
+
+        size = os.path.getsize(full_path)
+        start, end = 0, size
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header:
+            match = RANGE_PATTERN.match(range_header.strip())
+            if match is None or match.groups() == ("", ""):
+                self._send_error(416)
+                return
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+            else:
+                start = max(0, size - int(last))
+            if start >= end:
+                self._send_error(416)
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(full_path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining:
+                block = f.read(min(remaining, 2**20))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+        self.server.count_bytes(end - start - remaining)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root_dir):
+        http.server.ThreadingHTTPServer.__init__(self, address, _Handler)
+        self.root_dir = os.path.realpath(root_dir)
+        self.requests = 0
+        self.bytes_sent = 0
+        self._count_lock = threading.Lock()
+
+    def count_request(self):
+        with self._count_lock:
+            self.requests += 1
+
+    def count_bytes(self, bytes_sent):
+        with self._count_lock:
+            self.bytes_sent += bytes_sent
+
+
+class ObjectServer(object):
+    """Serve the files under root_dir on host:port. Port 0 picks a free one."""
+
+    def __init__(self, root_dir, host="127.0.0.1", port=0):
+        self._server = _Server((host, port), root_dir)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def url(self, path):
+        """Return the URL of a file or directory under root_dir."""
+        host, port = self._server.server_address[:2]
+        relative_path = os.path.relpath(os.path.realpath(path), self._server.root_dir)
+        return "http://{}:{}/{}".format(
+            host, port, urllib.parse.quote(relative_path.replace(os.sep, "/")))
+
+    def stats(self):
+        """Return the number of requests handled and bytes sent so far."""
+        with self._server._count_lock:
+            return {"requests": self._server.requests, "bytes": self._server.bytes_sent}
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,89 @@
+"""Where the benchmark inputs are downloaded from.
+
+The inputs live in s3. LocalStore stands in for the bucket with a local
+directory, so that localization can be run and tested without network access.
+"""
+import collections
+import os
+import shutil
+
+import boto3
+import botocore
+
+
+ObjectInfo = collections.namedtuple("ObjectInfo", ["key", "size", "etag"])
+
+
+class S3Store(object):
+    """Read objects from s3 anonymously.
+
+    One client, and so one connection pool, is shared by all the threads that
+    use the store.
+
+    Args:
+      endpoint_url: url of an s3-compatible server to use instead of s3, for
+        example a local stand-in
+      max_pool_connections: size of the connection pool. Should be at least the
+        number of threads downloading at once.
+      multipart_threshold: objects at least this big are downloaded in
+        concurrent parts, and smaller ones with a single request
+    """
+
+    def __init__(self, endpoint_url=None, max_pool_connections=32,
+                 multipart_threshold=8 * 2**20):
+        config = botocore.client.Config(
+            signature_version=botocore.UNSIGNED,
+            max_pool_connections=max_pool_connections,
+            retries={"max_attempts": 5})
+        self._client = boto3.client('s3', endpoint_url=endpoint_url, config=config)
+        self.multipart_threshold = multipart_threshold
+
+    def list_objects(self, bucket, prefix):
+        """Yield an ObjectInfo for every object whose key starts with prefix."""
+        paginator = self._client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield ObjectInfo(obj["Key"], obj["Size"], obj["ETag"].strip('"'))
+
+    def download(self, bucket, key, path, size=None):
+        """Download an object to path. size is the object's size, if it's
+        known from a listing.
+        """
+        if size is None or size >= self.multipart_threshold:
+            self._client.download_file(bucket, key, path)
+            return
+        # Small objects don't need the transfer manager and its thread pool
+        response = self._client.get_object(Bucket=bucket, Key=key)
+        with open(path, "wb") as f:
+            for block in iter(lambda: response["Body"].read(2**20), b""):
+                f.write(block)
+
+
+class LocalStore(object):
+    """Stand in for s3 with a local directory, where s3://bucket/key is
+    root_dir/bucket/key.
+
+    ETags are made up from the file's modification time and size, so they
+    change whenever the file does.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def list_objects(self, bucket, prefix):
+        bucket_dir = os.path.join(self.root_dir, bucket)
+        # Only walk the part of the bucket that can match the prefix
+        start_dir = os.path.join(bucket_dir, os.path.dirname(prefix))
+        for dirpath, dirnames, filenames in os.walk(start_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, bucket_dir).replace(os.sep, "/")
+                if not key.startswith(prefix):
+                    continue
+                stat = os.stat(path)
+                yield ObjectInfo(key, stat.st_size,
+                                 "{:x}-{:x}".format(stat.st_mtime_ns, stat.st_size))
+
+    def download(self, bucket, key, path, size=None):
+        shutil.copyfile(os.path.join(self.root_dir, bucket, key), path)
@@ -0,0 +1,168 @@
+"""Control whether a test's inputs are in the page cache, without root.
+
+Dropping the whole page cache needs sudo, and without it the benchmarks
+quietly run warm. Instead, the staged inputs themselves are evicted with
+posix_fadvise(POSIX_FADV_DONTNEED), or read to warm them, and mincore reports
+how much of them is actually resident afterwards, so every repetition records
+the cache state it ran in.
+"""
+import ctypes
+import ctypes.util
+import mmap
+import os
+import subprocess
+
+
+MODES = ["cold", "warm", "partial", "drop"]
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+                       ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+MAP_FAILED = ctypes.c_void_p(-1).value
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def _files(paths):
+    """Yield the files at paths, walking the ones that are directories."""
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for filename in filenames:
+                    yield os.path.join(dirpath, filename)
+        elif os.path.isfile(path):
+            yield path
+
+
+def evict(paths):
+    """Drop the files at paths from the page cache."""
+    for path in _files(paths):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # Dirty pages can't be dropped, so write them back first
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def prewarm(paths, fraction=1.0):
+    """Read the first fraction of each of the files at paths into the page
+    cache.
+    """
+    buffer = memoryview(bytearray(2**20))
+    for path in _files(paths):
+        with open(path, "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            remaining = int(size * fraction)
+            if remaining < size:
+                # Readahead would cache more than the fraction
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_RANDOM)
+            while remaining > 0:
+                num_bytes = f.readinto(buffer[:remaining])
+                if not num_bytes:
+                    break
+                remaining -= num_bytes
+
+
+def _resident_bytes(path):
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        address = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if address == MAP_FAILED:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        try:
+            num_pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+            pages = (ctypes.c_ubyte * num_pages)()
+            if _libc.mincore(address, size, pages) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), path)
+            resident_pages = sum(page & 1 for page in pages)
+        finally:
+            _libc.munmap(address, size)
+    finally:
+        os.close(fd)
+    return min(resident_pages * PAGE_SIZE, size)
+
+
+def residency(paths):
+    """Report how much of the files at paths is in the page cache.
+
+    Returns:
+      dict with the number of files, their total bytes, how many of those are
+        resident, and the resident fraction
+    """
+    files = 0
+    total_bytes = 0
+    resident_bytes = 0
+    for path in _files(paths):
+        files += 1
+        total_bytes += os.path.getsize(path)
+        resident_bytes += _resident_bytes(path)
+    return {
+        "files": files,
+        "bytes": total_bytes,
+        "resident_bytes": resident_bytes,
+        "resident_fraction": resident_bytes / total_bytes if total_bytes else 0.0,
+    }
+
+
+def drop_caches():
+    """Clear the whole page cache so we're actually reading from disk.
+
+    This unfortunately requires sudo access.
+
+    Returns:
+      whether the cache was dropped
+    """
+    result = subprocess.run(
+        "echo 3 | sudo -n tee /proc/sys/vm/drop_caches",
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    return result.returncode == 0
+
+
+class CacheControl(object):
+    """Put a test's inputs in a given cache state before each repetition.
+
+    Args:
+      mode: "cold" evicts the inputs, "warm" reads all of them, "partial"
+        evicts them and then reads warm_fraction of each file, and "drop"
+        drops the whole page cache, which needs sudo
+      warm_fraction: fraction of each input file to read in "partial" mode
+    """
+
+    def __init__(self, mode="cold", warm_fraction=0.5):
+        if mode not in MODES:
+            raise ValueError("Unknown cache mode {}, expected one of {}".format(mode, MODES))
+        self.mode = mode
+        self.warm_fraction = warm_fraction
+
+    def prepare(self, paths):
+        """Put the files at paths in the cache state.
+
+        Returns:
+          dict describing the cache state, with the mode and the residency of
+            the files afterwards
+        """
+        state = {"mode": self.mode}
+        if self.mode == "drop":
+            state["dropped"] = drop_caches()
+            if not state["dropped"]:
+                print("Couldn't drop the page cache without sudo, the inputs may be cached")
+        elif self.mode == "warm":
+            prewarm(paths)
+        else:
+            evict(paths)
+            if self.mode == "partial":
+                state["warm_fraction"] = self.warm_fraction
+                prewarm(paths, self.warm_fraction)
+        state.update(residency(paths))
+        return state
@@ -0,0 +1,54 @@
+"""Decide how many times to repeat a test.
+
+Stable tests don't need many repetitions to pin down their running time, and
+noisy ones need more than a fixed count gives them. With a target width, a
+combination is repeated until the confidence interval of its mean running time
+is within that fraction of the mean, between a minimum and a maximum number of
+repetitions. The interval is a Student-t interval for the first few
+repetitions, where a percentile bootstrap is too narrow, and bootstrapped
+after that, like in summarize_results. Warm-up repetitions run first and are
+discarded.
+"""
+import statistics
+
+from summarize_results import mean_ci
+
+
+class RepetitionPolicy(object):
+    """When to stop repeating a source-format combination.
+
+    Args:
+      max_repetitions: most repetitions to run. Without a target_ci_width,
+        exactly this many run.
+      min_repetitions: fewest repetitions to run before checking the interval
+      warmup: repetitions to run first and discard
+      target_ci_width: stop once the confidence interval of the mean is at most
+        this fraction of the mean, like 0.05
+      confidence: confidence level of the interval
+      resamples: bootstrap resamples per check, once there are enough
+        repetitions to bootstrap
+    """
+
+    def __init__(self, max_repetitions=10, min_repetitions=3, warmup=0, target_ci_width=None,
+                 confidence=0.95, resamples=2000):
+        if target_ci_width is not None and min_repetitions < 2:
+            raise ValueError("Need at least 2 repetitions to estimate a confidence interval")
+        self.max_repetitions = max_repetitions
+        self.min_repetitions = min(min_repetitions, max_repetitions)
+        self.warmup = warmup
+        self.target_ci_width = target_ci_width
+        self.confidence = confidence
+        self.resamples = resamples
+
+    def ci_width(self, times):
+        """Width of the confidence interval of the mean, relative to the mean."""
+        low, high = mean_ci(times, self.confidence, self.resamples)
+        return (high - low) / statistics.mean(times)
+
+    def done(self, times):
+        """Whether the repetitions that took times are enough."""
+        if len(times) >= self.max_repetitions:
+            return True
+        if self.target_ci_width is None or len(times) < self.min_repetitions:
+            return False
+        return self.ci_width(times) <= self.target_ci_width
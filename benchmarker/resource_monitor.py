@@ -0,0 +1,224 @@
+"""Sample a docker container's resource usage from its cgroup.
+
+Works with both cgroup v1 and v2 hierarchies, and with both the cgroupfs and
+systemd cgroup drivers.
+"""
+import os
+import threading
+import time
+import warnings
+
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+V1_CONTROLLERS = ["cpuacct", "memory", "blkio"]
+
+
+def _read_int(path):
+    with open(path) as f:
+        return int(f.read().split()[0])
+
+
+def _read_keyed(path):
+    """Read a cgroup file of "key value" lines into a dict."""
+    values = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                values[fields[0]] = int(fields[1])
+    return values
+
+
+def find_cgroup(container_id, cgroup_root=CGROUP_ROOT):
+    """Find the cgroup directories of a container.
+
+    Returns:
+      ("v2", path) for the unified hierarchy, ("v1", {controller: path}) for
+      the legacy one, or (None, None) if the cgroup can't be found.
+    """
+    container_dirs = [
+        os.path.join("system.slice", "docker-{}.scope".format(container_id)),
+        os.path.join("docker", container_id)
+    ]
+
+    if os.path.exists(os.path.join(cgroup_root, "cgroup.controllers")):
+        for container_dir in container_dirs:
+            path = os.path.join(cgroup_root, container_dir)
+            if os.path.isdir(path):
+                return "v2", path
+        return None, None
+
+    paths = {}
+    for controller in V1_CONTROLLERS:
+        for container_dir in container_dirs:
+            path = os.path.join(cgroup_root, controller, container_dir)
+            if os.path.isdir(path):
+                paths[controller] = path
+                break
+    if paths:
+        return "v1", paths
+    return None, None
+
+
+def _read_v2(path):
+    """Read the cumulative counters and current memory of a v2 cgroup."""
+    counters = {}
+
+    cpu_stat = _read_keyed(os.path.join(path, "cpu.stat"))
+    counters["cpu_user_seconds"] = cpu_stat.get("user_usec", 0) / 1e6
+    counters["cpu_system_seconds"] = cpu_stat.get("system_usec", 0) / 1e6
+
+    memory_stat = _read_keyed(os.path.join(path, "memory.stat"))
+    counters["page_faults"] = memory_stat.get("pgfault", 0)
+    counters["major_page_faults"] = memory_stat.get("pgmajfault", 0)
+
+    io_totals = {"rbytes": 0, "wbytes": 0, "rios": 0, "wios": 0}
+    with open(os.path.join(path, "io.stat")) as io_stat:
+        for line in io_stat:
+            for field in line.split()[1:]:
+                key, _, value = field.partition("=")
+                if key in io_totals:
+                    io_totals[key] += int(value)
+    counters["io_read_bytes"] = io_totals["rbytes"]
+    counters["io_write_bytes"] = io_totals["wbytes"]
+    counters["io_read_ops"] = io_totals["rios"]
+    counters["io_write_ops"] = io_totals["wios"]
+
+    memory = _read_int(os.path.join(path, "memory.current"))
+    return counters, memory
+
+
+def _read_blkio(path):
+    """Sum the Read and Write lines of a v1 blkio file over devices."""
+    totals = {"Read": 0, "Write": 0}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[1] in totals:
+                totals[fields[1]] += int(fields[2])
+    return totals["Read"], totals["Write"]
+
+
+def _read_v1(paths):
+    """Read the cumulative counters and current memory of v1 cgroups."""
+    counters = {}
+
+    if "cpuacct" in paths:
+        ticks_per_second = os.sysconf("SC_CLK_TCK")
+        cpuacct_stat = _read_keyed(os.path.join(paths["cpuacct"], "cpuacct.stat"))
+        counters["cpu_user_seconds"] = cpuacct_stat.get("user", 0) / ticks_per_second
+        counters["cpu_system_seconds"] = cpuacct_stat.get("system", 0) / ticks_per_second
+
+    memory = None
+    if "memory" in paths:
+        memory_stat = _read_keyed(os.path.join(paths["memory"], "memory.stat"))
+        counters["page_faults"] = memory_stat.get("pgfault", 0)
+        counters["major_page_faults"] = memory_stat.get("pgmajfault", 0)
+        memory = _read_int(os.path.join(paths["memory"], "memory.usage_in_bytes"))
+
+    if "blkio" in paths:
+        counters["io_read_bytes"], counters["io_write_bytes"] = _read_blkio(
+            os.path.join(paths["blkio"], "blkio.throttle.io_service_bytes"))
+        counters["io_read_ops"], counters["io_write_ops"] = _read_blkio(
+            os.path.join(paths["blkio"], "blkio.throttle.io_serviced"))
+
+    return counters, memory
+
+
+def _read_cgroup_peak(version, path):
+    """Read the kernel's record of the cgroup's peak memory, if it keeps one."""
+    try:
+        if version == "v2":
+            return _read_int(os.path.join(path, "memory.peak"))
+        return _read_int(os.path.join(path["memory"], "memory.max_usage_in_bytes"))
+    except (OSError, KeyError):
+        return None
+
+
+class CgroupMonitor(threading.Thread):
+    """Sample a container's cgroup accounting in the background.
+
+    Records CPU user and system time, memory over time and its peak, block I/O
+    bytes and operations, and page faults. Counters are reported as the
+    difference between the first and last sample. If fresh_container is set,
+    the container is assumed to have started with the monitor, so counters are
+    reported from zero and the kernel's peak memory is used too.
+
+    A container's cgroup goes away when it exits, so for a container that runs
+    a single command the counters are as of the last sample, up to interval
+    seconds before the end.
+    """
+
+    def __init__(self, container_id, interval=0.1, fresh_container=False,
+                 cgroup_root=CGROUP_ROOT):
+
+        threading.Thread.__init__(self)
+        self.interval = interval
+        self.fresh_container = fresh_container
+        self.version, self.path = find_cgroup(container_id, cgroup_root)
+        if self.version is None:
+            warnings.warn("Can't find the cgroup of container {}".format(container_id))
+
+        self.first_counters = None
+        self.last_counters = None
+        self.memory_samples = []
+        self.cgroup_peak = None
+        self._start_time = time.perf_counter()
+        self._exit_event = threading.Event()
+        self.start()
+
+    def _sample(self):
+        if self.version == "v2":
+            counters, memory = _read_v2(self.path)
+        else:
+            counters, memory = _read_v1(self.path)
+        if self.fresh_container:
+            self.cgroup_peak = _read_cgroup_peak(self.version, self.path)
+
+        if self.first_counters is None:
+            self.first_counters = counters
+        self.last_counters = counters
+        if memory is not None:
+            self.memory_samples.append((time.perf_counter() - self._start_time, memory))
+
+    def run(self):
+        if self.version is None:
+            return
+        while True:
+            try:
+                self._sample()
+            except OSError:
+                # The container has exited and its cgroup is gone
+                break
+            if self._exit_event.wait(self.interval):
+                break
+
+    def exit(self):
+        self._exit_event.set()
+        self.join()
+        # Take a last sample, so the counters cover everything up to now
+        if self.version is not None:
+            try:
+                self._sample()
+            except OSError:
+                pass
+
+    def results(self):
+        """Return the sampled resource usage as a dict."""
+        if self.last_counters is None:
+            return {}
+
+        results = {}
+        for key, value in self.last_counters.items():
+            if self.fresh_container:
+                results[key] = value
+            else:
+                results[key] = value - self.first_counters.get(key, 0)
+
+        peaks = [memory for _, memory in self.memory_samples]
+        if self.cgroup_peak is not None:
+            peaks.append(self.cgroup_peak)
+        if peaks:
+            results["peak_memory_bytes"] = max(peaks)
+        results["memory_samples"] = self.memory_samples
+        return results
@@ -0,0 +1,125 @@
+"""Structured benchmark results.
+
+Every repetition of every test is written as one JSON record per line, with
+the run it belongs to, the host it ran on, the test's image and the metrics
+the benchmarker collected. Runs can be appended to the same file, so a file
+can hold a baseline and the runs to compare against it. Combinations that
+fail get a record with their error instead of metrics.
+
+summarize_results.py reads these files.
+"""
+import datetime
+import json
+import os
+import platform
+import threading
+import uuid
+
+
+def new_run_id():
+    return "{}-{}".format(datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"),
+                          uuid.uuid4().hex[:8])
+
+
+def _total_memory_bytes():
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def host_info():
+    """Describe the host the benchmarks run on."""
+    return {
+        "hostname": platform.node(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "memory_bytes": _total_memory_bytes(),
+        "python": platform.python_version(),
+    }
+
+
+def test_name(test_path):
+    """Name a test by its task and directory, like merge/merge_npy."""
+    test_path = os.path.normpath(str(test_path))
+    return "/".join([os.path.basename(os.path.dirname(test_path)), os.path.basename(test_path)])
+
+
+class ResultsWriter(object):
+    """Append records for one run of the benchmarker to a JSON Lines file.
+
+    Records are written as soon as each repetition finishes, from any of the
+    scheduler's threads, so a run that's interrupted keeps what it finished.
+
+    Args:
+      path: the results file
+      run_id: identifies the run's records. Defaults to the start time and a
+        random suffix.
+      config: settings of the run to record with every record, like whether
+        containers were persistent
+    """
+
+    def __init__(self, path, run_id=None, config=None):
+        self.path = path
+        self.run_id = run_id or new_run_id()
+        self.host = host_info()
+        self.config = config or {}
+        self._lock = threading.Lock()
+        results_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(results_dir, exist_ok=True)
+
+    def _write(self, record):
+        record = dict(record, run_id=self.run_id, host=self.host, config=self.config,
+                      timestamp=datetime.datetime.utcnow().isoformat() + "Z")
+        line = json.dumps(record, sort_keys=True)
+        with self._lock, open(self.path, "a") as results_file:
+            results_file.write(line + "\n")
+
+    def write_repetition(self, test_path, image, source, format_, repetition, timings):
+        """Record the timings run_test_repetition returned."""
+        metrics = {key: value for key, value in timings.items() if key != "output_sizes"}
+        output_sizes = timings.get("output_sizes") or []
+        metrics["output_bytes"] = output_sizes[-1][1] if output_sizes else None
+        self._write({
+            "test": test_name(test_path),
+            "image": image,
+            "source": source,
+            "format": format_,
+            "repetition": repetition,
+            "status": "ok",
+            "metrics": metrics,
+            "output_sizes": output_sizes,
+        })
+
+    def write_failure(self, test_path, image, source, format_, error):
+        """Record that a source-format combination failed."""
+        self._write({
+            "test": test_name(test_path),
+            "image": image,
+            "source": source,
+            "format": format_,
+            "repetition": None,
+            "status": "failed",
+            "error": "{}: {}".format(type(error).__name__, error),
+        })
+
+
+def read_results(path, run_id=None):
+    """Read the records of a results file.
+
+    Args:
+      run_id: only return this run's records. "latest" means the last run in
+        the file, and None means every run.
+    """
+    with open(path) as results_file:
+        records = [json.loads(line) for line in results_file if line.strip()]
+    if run_id == "latest":
+        run_id = records[-1]["run_id"] if records else None
+    if run_id is not None:
+        records = [record for record in records if record["run_id"] == run_id]
+    return records
@@ -1,117 +1,360 @@
 import argparse
 import collections
-import concurrent.futures
+import functools
+import json
 import os
 import pathlib
 import shutil
 import subprocess
+import sys
 import tempfile
-import threading
 import time
-import urllib.parse
 
-import boto3
-import botocore
 import docker
 import yaml
 
+import dataset_cache
+import image_cache
+import localizer
+import object_server
+import object_store
+import page_cache
+import repetition_policy
+import resource_monitor
+import results_store
+import scheduler
+from file_size_monitor import FileSizeMonitor
+
+
+@functools.lru_cache(maxsize=None)
+def docker_client():
+    """Connect to docker the first time it's needed, so that in-process runs
+    work on machines without it.
+    """
+    return docker.from_env()
+
+BENCHMARKER_DIR = os.path.dirname(os.path.abspath(__file__))
 
-DOCKER_CLIENT = docker.from_env()
+# Where test scripts write their phase times and counters, in the test instance
+# directory
+TASK_TIMING_NAME = "task_timing.json"
 
-def drop_caches():
-    """Clear the page cache so we're actually reading from disk.
+# The profilers timed_entrypoint.py can run test commands under, and the
+# extensions of the files they write
+PROFILE_EXTENSIONS = {"cprofile": "pstats", "sample": "collapsed"}
 
-    This unfortunately requires sudo access.
+def get_build_context(test_path):
+    """Find the docker build context for a test.
+
+    Test images can include the shared code in tasks/common, so the context is
+    the closest directory above the test that has a "common" subdirectory. If
+    there isn't one, the test directory itself is the context.
     """
+    test_path = os.path.abspath(test_path)
+    candidate = os.path.dirname(test_path)
+    while True:
+        if os.path.isdir(os.path.join(candidate, "common")):
+            return candidate
+        parent = os.path.dirname(candidate)
+        if parent == candidate:
+            return test_path
+        candidate = parent
+
+def find_task_script(test_path):
+    """Find a test's entrypoint script and the directories of the scripts it
+    imports, from the COPY and ENTRYPOINT lines of its Dockerfile.
 
-    subprocess.run(
-        "echo 3 | sudo tee /proc/sys/vm/drop_caches",
-        shell=True,
-        stdout=subprocess.PIPE)
+    Returns:
+      tuple of the local path of the entrypoint script, and a list of the
+        directories to put on its PYTHONPATH
+    """
+    build_context = get_build_context(test_path)
+    copies = {}
+    entrypoint = None
+    with open(os.path.join(test_path, "Dockerfile")) as dockerfile:
+        for line in dockerfile:
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == "COPY":
+                copies[fields[2]] = os.path.join(build_context, fields[1])
+            elif fields and fields[0] == "ENTRYPOINT":
+                entrypoint = json.loads(line.split(None, 1)[1])
+    if not entrypoint or entrypoint[-1] not in copies:
+        raise RuntimeError("Can't find the entrypoint script of {}".format(test_path))
+
+    script_dirs = []
+    for source in copies.values():
+        script_dir = os.path.dirname(source)
+        if source.endswith(".py") and script_dir not in script_dirs:
+            script_dirs.append(script_dir)
+    return copies[entrypoint[-1]], script_dirs
+
+def read_task_timing(path):
+    """Read and remove the phase times and counters a test command wrote with
+    tasks/common/task_timing.py.
+
+    Returns:
+      dict with "phases" and "counters", empty if the command didn't write any
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as task_timing_file:
+        task_timing = json.load(task_timing_file)
+    os.remove(path)
+    return task_timing
+
+def profile_args(work_dir, profile, command):
+    """Arguments for timed_entrypoint.py that run command under the profile
+    profiler, if there is one, and write the profile to the "profile"
+    directory in work_dir, named after the subcommand.
+    """
+    if not profile:
+        return []
+    profile_path = os.path.join(work_dir, "profile", "{}.{}".format(
+        command[0], PROFILE_EXTENSIONS[profile]))
+    ensure_dir(profile_path)
+    return ["--profile", profile, "--profile-path", profile_path]
+
+def load_yaml(path):
+    with open(path) as yaml_file:
+        return yaml.safe_load(yaml_file)
 
 def ensure_dir(path):
     """Test if directory at path exists, and if not, create it."""
     pathlib.Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
 
-class FileSizeMonitor(threading.Thread):
-    """Monitor the size of a file in the background. Measure every second."""
-
-    def __init__(self, file_path):
-
-        threading.Thread.__init__(self)
-        self.file_path = file_path
-        self.file_sizes = []
-        self._exit_event = threading.Event()
-        self.start()
-
-    def _get_size(self, path):
-        if os.path.isfile(path):
-            return os.path.getsize(self.file_path)
-        else:
-            return sum(
-                os.path.getsize(os.path.join(dirpath, filename))
-                for dirpath, dirnames, filenames
-                in os.walk(path)
-                for filename in filenames
-            )
-
-    def run(self):
-        while not self._exit_event.isSet():
-            try:
-                self.file_sizes.append(self._get_size(self.file_path))
-            except OSError:
-                self.file_sizes.append(0)
-            time.sleep(1)
-
-    def exit(self):
-        self._exit_event.set()
-        self.join()
-
-def localize_inputs(inputs, staging_dir):
-    """Copy inputs from s3 into the staging dir.
-
-    This is done prior to test execution for tests that expect data to be present in
-    a local filesystem.
-    """
-
-    s3 = boto3.resource('s3', config=botocore.client.Config(signature_version=botocore.UNSIGNED))
+class ContainerRunner(object):
+    """Run each test command in a fresh container.
 
-    def localize_input(input_s3_path, staging_dir_):
-        parsed_path = urllib.parse.urlparse(input_s3_path)
-        bucket = s3.Bucket(parsed_path.netloc)
-        key = parsed_path.path[1:] # String the leading /
-
-        futures = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-            for obj in bucket.objects.filter(Prefix=key).all():
-                local_path = os.path.join(staging_dir_, obj.key)
-                if os.path.exists(local_path):
-                    continue
-                ensure_dir(local_path)
-                futures.append(executor.submit(bucket.download_file, obj.key, local_path))
-                #bucket.download_file(obj.key, local_path)
-        _ = [f.result() for f in futures]
+    The measured time includes creating the container and starting the
+    interpreter along with the test itself. The container's resource usage is
+    sampled from its cgroup every resource_interval seconds. Containers are
+    pinned to the CPUs in cpuset and limited to mem_limit, if they're given,
+    and get the environment variables in environment. network_mode "host" lets
+    them reach servers the benchmarker runs on localhost.
+    """
 
-        return os.path.join(staging_dir_, key)
+    def __init__(self, image_name, work_dir, resource_interval=0.1, cpuset=None,
+                 mem_limit=None, environment=None, network_mode=None):
+        self.image_name = image_name
+        self.work_dir = work_dir
+        self.volumes = {work_dir: {"bind": work_dir, "mode": "rw"}}
+        self.startup_time = 0.0
+        self.resource_interval = resource_interval
+        self.run_options = {}
+        if cpuset is not None:
+            self.run_options["cpuset_cpus"] = cpuset
+        if mem_limit is not None:
+            self.run_options["mem_limit"] = mem_limit
+        if environment:
+            self.run_options["environment"] = environment
+        if network_mode is not None:
+            self.run_options["network_mode"] = network_mode
+
+    def start(self):
+        pass
+
+    def run(self, command):
+        """Run a command with the image's entrypoint. Return a dict of timings,
+        where "time" is the time we report for the command, and "resources" is
+        the resource usage of the container.
+        """
+        start_time = time.perf_counter()
+        container = docker_client().containers.run(
+            image=self.image_name,
+            command=' '.join(command),
+            volumes=self.volumes,
+            detach=True,
+            **self.run_options
+        )
+        monitor = resource_monitor.CgroupMonitor(
+            container.id, self.resource_interval, fresh_container=True)
+        result = container.wait()
+        end_time = time.perf_counter()
+        monitor.exit()
+
+        # Older versions of docker-py return just the exit code
+        exit_status = result["StatusCode"] if isinstance(result, dict) else result
+        try:
+            if exit_status != 0:
+                raise docker.errors.ContainerError(
+                    container, exit_status, ' '.join(command), self.image_name,
+                    container.logs(stdout=False, stderr=True))
+        finally:
+            container.remove()
+
+        return {"time": end_time - start_time, "resources": monitor.results()}
+
+    def stop(self):
+        pass
+
+class PersistentContainerRunner(ContainerRunner):
+    """Run test commands with docker exec in one long-lived container.
+
+    The container just sleeps, and each command runs the image's entrypoint
+    script through timed_entrypoint.py, which times the script's imports and
+    its main function separately. The time we report is just the main
+    function, so container creation and interpreter startup don't count
+    against the format. With a profile, "cprofile" or "sample", the commands
+    are profiled too. See profile_args.
+    """
 
+    def __init__(self, image_name, work_dir, resource_interval=0.1, cpuset=None,
+                 mem_limit=None, environment=None, network_mode=None, profile=None):
+        super().__init__(image_name, work_dir, resource_interval, cpuset, mem_limit,
+                         environment, network_mode)
+        self.profile = profile
+
+    def start(self):
+        image = docker_client().images.get(self.image_name)
+        self.entrypoint = image.attrs["Config"]["Entrypoint"]
+
+        volumes = dict(self.volumes)
+        volumes[BENCHMARKER_DIR] = {"bind": "/benchmarker", "mode": "ro"}
+
+        start_time = time.perf_counter()
+        self.container = docker_client().containers.run(
+            image=self.image_name,
+            entrypoint=["sleep", "infinity"],
+            volumes=volumes,
+            detach=True,
+            **self.run_options
+        )
+        # The container is ready once it can run a command
+        self.container.exec_run(["true"])
+        self.startup_time = time.perf_counter() - start_time
+
+    def run(self, command):
+        timing_path = os.path.join(self.work_dir, "exec_timing.json")
+        interpreter, script = self.entrypoint[0], self.entrypoint[-1]
+        exec_command = [interpreter, "/benchmarker/timed_entrypoint.py",
+                        "--timing-file", timing_path]
+        exec_command += profile_args(self.work_dir, self.profile, command)
+        exec_command += [script] + command
+
+        # The container's cgroup counters are cumulative, so the monitor reports
+        # what changed during this command
+        monitor = resource_monitor.CgroupMonitor(self.container.id, self.resource_interval)
+        start_time = time.perf_counter()
+        exit_code, output = self.container.exec_run(exec_command)
+        end_time = time.perf_counter()
+        monitor.exit()
+        if exit_code != 0:
+            raise RuntimeError("Command {} failed in {}:\n{}".format(
+                command, self.image_name, output.decode(errors="replace")))
+
+        with open(timing_path) as timing_file:
+            script_timings = json.load(timing_file)
+        os.remove(timing_path)
+
+        exec_time = end_time - start_time
+        return {
+            "time": script_timings["task"],
+            "exec_time": exec_time,
+            "container_startup": self.startup_time,
+            "interpreter_startup": exec_time - script_timings["import"] - script_timings["task"],
+            "import": script_timings["import"],
+            "task": script_timings["task"],
+            "resources": monitor.results()
+        }
+
+    def stop(self):
+        self.container.remove(force=True)
+
+class InProcessRunner(object):
+    """Run test commands in a local subprocess, without docker.
+
+    The test's entrypoint script runs through timed_entrypoint.py with this
+    machine's python, or the given one, which needs the test's dependencies.
+    Like with persistent containers, the time we report is just the script's
+    main function, and the resource usage comes from getrusage rather than a
+    cgroup, along with the tracemalloc peak if trace_memory is set. Commands
+    are pinned to the CPUs in cpuset. Memory limits only apply to containers.
+    Commands are profiled like in PersistentContainerRunner.
+    """
 
-    if isinstance(inputs, list):
-        localized_inputs = []
-        for input_ in inputs:
-            localized_inputs.append(localize_input(input_, staging_dir))
-        return localized_inputs
+    def __init__(self, test_path, work_dir, cpuset=None, environment=None, python=None,
+                 trace_memory=True, profile=None):
+        self.work_dir = work_dir
+        self.script, script_dirs = find_task_script(test_path)
+        self.python = python or sys.executable
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.cpus = {int(cpu) for cpu in cpuset.split(",")} if cpuset else None
+        self.env = dict(os.environ)
+        self.env.update(environment or {})
+        self.env["PYTHONPATH"] = os.pathsep.join(
+            script_dirs + [path for path in [os.environ.get("PYTHONPATH")] if path])
+
+    def start(self):
+        pass
+
+    def _pin(self):
+        os.sched_setaffinity(0, self.cpus)
+
+    def run(self, command):
+        timing_path = os.path.join(self.work_dir, "exec_timing.json")
+        exec_command = [self.python, os.path.join(BENCHMARKER_DIR, "timed_entrypoint.py"),
+                        "--timing-file", timing_path]
+        if self.trace_memory:
+            exec_command.append("--trace-memory")
+        exec_command += profile_args(self.work_dir, self.profile, command)
+        exec_command += [self.script] + command
+
+        start_time = time.perf_counter()
+        result = subprocess.run(exec_command, env=self.env, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                preexec_fn=self._pin if self.cpus else None)
+        end_time = time.perf_counter()
+        if result.returncode != 0:
+            raise RuntimeError("Command {} failed for {}:\n{}".format(
+                command, self.script, result.stdout.decode(errors="replace")))
+
+        with open(timing_path) as timing_file:
+            script_timings = json.load(timing_file)
+        os.remove(timing_path)
+
+        exec_time = end_time - start_time
+        return {
+            "time": script_timings["task"],
+            "exec_time": exec_time,
+            "interpreter_startup": exec_time - script_timings["import"] - script_timings["task"],
+            "import": script_timings["import"],
+            "task": script_timings["task"],
+            "resources": script_timings["resources"]
+        }
+
+    def stop(self):
+        pass
+
+def run_test_repetition(runner, test_dir, input_paths, test_yaml_path, repetition,
+                        output_size_interval=0.1, object_server_=None, cache_control=None,
+                        local_input_paths=None):
+    """Execute one repetition of a test.
 
-    return localize_input(inputs, staging_dir)
+    Args:
+      object_server_: object_server.ObjectServer serving the inputs, if they're
+        remote
+      cache_control: page_cache.CacheControl that puts the inputs in the page
+        cache state to test. Defaults to evicting them.
+      local_input_paths: the staged inputs, if input_paths are URLs
 
-def run_test_repetition(docker_image_name, test_dir, input_paths, test_yaml_path, repetition):
-    """Execute one repetition of a test. Return the time it took to complete."""
+    Returns:
+      dict of timings from the runner. "time" is the time the repetition took,
+      "resources" is the resource usage of the test command and
+      "output_sizes" is (seconds, bytes) samples of the output as it was
+      written. "phases" and "counters" are what the test script recorded
+      with task_timing, and "verify" has the same for the verify command.
+      For remote inputs, "remote" has the number of requests and
+      bytes the test made of the object server. "cache" is the page cache
+      state of the inputs when the test started.
+    """
 
-    # Try to clear the pagecache.
-    drop_caches()
+    cache_control = cache_control or page_cache.CacheControl()
+    cache_state = cache_control.prepare(local_input_paths or input_paths)
 
     output_path = os.path.join(test_dir, "output_{}".format(repetition))
     ensure_dir(output_path)
-    file_monitor = FileSizeMonitor(output_path)
+    file_monitor = FileSizeMonitor(output_path, output_size_interval)
 
     # Run and time the test repetition
     test_cmd = ["test", "--input-paths"]
@@ -119,23 +362,41 @@ def run_test_repetition(docker_image_name, test_dir, input_paths, test_yaml_path
     test_cmd.append("--output-path")
     test_cmd.append(output_path)
 
-    start_time = time.perf_counter()
-    DOCKER_CLIENT.containers.run(
-        image=docker_image_name,
-        command=' '.join(test_cmd),
-        volumes={test_dir: {"bind": test_dir, "mode": "rw"}}
-    )
-    end_time = time.perf_counter()
-    file_monitor.exit()
-
-    test_time = end_time - start_time
+    # The runner points TASK_TIMING_FILE here. Clear out anything a failed
+    # repetition left behind.
+    task_timing_path = os.path.join(test_dir, TASK_TIMING_NAME)
+    if os.path.exists(task_timing_path):
+        os.remove(task_timing_path)
+
+    if object_server_ is not None:
+        server_stats = object_server_.stats()
+    try:
+        timings = runner.run(test_cmd)
+    finally:
+        file_monitor.exit()
+    if object_server_ is not None:
+        timings["remote"] = {key: value - server_stats[key]
+                             for key, value in object_server_.stats().items()}
+    timings.update(read_task_timing(task_timing_path))
+
+    test_time = timings["time"]
+    timings["num_inputs"] = len(input_paths)
+    timings["cache"] = cache_state
+    timings["output_sizes"] = file_monitor.samples
+    resources = timings["resources"]
+    if "io_read_bytes" in resources and input_paths:
+        resources["io_read_bytes_per_input"] = resources["io_read_bytes"] / len(input_paths)
 
     # Write the timing results to a file
     results_log_path = os.path.join(test_dir, "timing_results_{}.log".format(repetition))
     with open(results_log_path, "w") as results_log:
         results_log.write(str(test_time) + "\n")
-        for size in file_monitor.file_sizes:
-            results_log.write(str(size) + "\n")
+        for seconds, size in file_monitor.samples:
+            results_log.write("{} {}\n".format(seconds, size))
+
+    resources_log_path = os.path.join(test_dir, "resources_{}.json".format(repetition))
+    with open(resources_log_path, "w") as resources_log:
+        json.dump(resources, resources_log)
 
     # And finally, verify the output
     shutil.copy(test_yaml_path, os.path.join(test_dir, "test.yaml"))
@@ -144,36 +405,181 @@ def run_test_repetition(docker_image_name, test_dir, input_paths, test_yaml_path
     verify_cmd.append(output_path)
     verify_cmd.append("--test-yaml")
     verify_cmd.append(os.path.join(test_dir, "test.yaml"))
-    DOCKER_CLIENT.containers.run(
-        image=docker_image_name,
-        command=' '.join(verify_cmd),
-        volumes={test_dir: {"bind": test_dir, "mode": "rw"}}
-    )
+    runner.run(verify_cmd)
+    timings["verify"] = read_task_timing(task_timing_path)
     print(test_time)
-    return test_time
+    return timings
 
-def run_test(test_path, data_yaml_path, repetitions=10, local_staging_dir=None):
-    """Run a test. Get timing results for the specified matrix formats.
+def run_combination(slot, image_cache_, localizer_, test_path, source, format_, inputs,
+                    test_instance_dir, repetitions=10, persistent_containers=False,
+                    resource_interval=0.1, output_size_interval=0.1, file_location=None,
+                    remote_environment=None, results_writer=None, cache_control=None,
+                    in_process=False, python=None, trace_memory=True, profile=None):
+    """Run the repetitions of one source-format combination of a test.
 
     Args:
-      test_dir: path to the test directory. Should have a test.yaml and a Dockerfile
-      data_yaml_path: path to the yaml file that describes the available data formats
-        in s3
-      local_staging_dir: where inputs and outputs should be staged
+      slot: the scheduler.Slot to run the test's containers in
+      image_cache_: image_cache.ImageCache to get the test's image from
+      localizer_: localizer.Localizer to localize inputs with
+      inputs: s3 paths of the inputs
+      repetitions: number of repetitions, or a
+        repetition_policy.RepetitionPolicy that decides when to stop
+      file_location: "local" or "remote", to override the test.yaml
+      remote_environment: environment variables for the test containers when
+        the inputs are remote, like the remote_io block size
+      results_writer: results_store.ResultsWriter to record each repetition,
+        or the failure of the combination, with
+      cache_control: page_cache.CacheControl that sets the page cache state of
+        the inputs before each repetition
+      in_process: run the test's script in a local subprocess with python
+        instead of in docker. See InProcessRunner.
+      profile: "cprofile" or "sample", to override the test.yaml's profile.
+        After the timed repetitions, one more repetition runs under that
+        profiler, and its profiles are written to the "profile" directory in
+        test_instance_dir. Its times aren't recorded.
 
     Returns:
-      output_file_sizes: dict of output produced over time for each of the
-        source-format combinations
+      list of the results of each repetition, not counting warm-ups or the
+        profiled one
+    """
+    if isinstance(repetitions, int):
+        repetitions = repetition_policy.RepetitionPolicy(repetitions)
+    test_config = load_yaml(os.path.join(test_path, "test.yaml"))
+    print("Running", test_path, "on", source, format_)
+
+    image_name = None
+    try:
+        # Get the image that runs the test. It's the same for every source and
+        # format, so it's only built once.
+        if not in_process:
+            image_name = image_cache_.get(test_path, get_build_context(test_path))
+
+        # Localize the remote s3 files first. Tests that run off of local files
+        # read them from the staging dir, and tests with remote files read them
+        # over HTTP from an object server that serves the staging dir, standing in
+        # for a web service.
+        file_location = file_location or test_config["file_location"]
+        inputs = localizer_.localize(inputs, test_instance_dir)
+        local_inputs = inputs if isinstance(inputs, list) else [inputs]
+        print("Done localizing to", test_instance_dir)
+
+        object_server_ = None
+        environment = {"TASK_TIMING_FILE": os.path.join(test_instance_dir, TASK_TIMING_NAME)}
+        network_mode = None
+        if file_location == "remote":
+            object_server_ = object_server.ObjectServer(test_instance_dir)
+            object_server_.start()
+            if isinstance(inputs, list):
+                inputs = [object_server_.url(input_) for input_ in inputs]
+            else:
+                inputs = object_server_.url(inputs)
+            environment.update(remote_environment or {})
+            # The server only listens on localhost
+            network_mode = "host"
+
+        runner = None
+        try:
+            if in_process:
+                runner = InProcessRunner(test_path, test_instance_dir, slot.cpuset, environment,
+                                         python, trace_memory)
+            else:
+                runner_class = (PersistentContainerRunner if persistent_containers
+                                else ContainerRunner)
+                runner = runner_class(image_name, test_instance_dir, resource_interval,
+                                      slot.cpuset, slot.mem_limit, environment, network_mode)
+            runner.start()
+            test_yaml_path = os.path.join(test_path, "test.yaml")
+            for w in range(repetitions.warmup):
+                run_test_repetition(runner, test_instance_dir, inputs, test_yaml_path,
+                                    "warmup_{}".format(w), output_size_interval, object_server_,
+                                    cache_control, local_inputs)
+
+            results = []
+            while not repetitions.done([timings["time"] for timings in results]):
+                r = len(results)
+                timings = run_test_repetition(
+                    runner, test_instance_dir, inputs, test_yaml_path, r,
+                    output_size_interval, object_server_, cache_control, local_inputs)
+                if results_writer is not None:
+                    results_writer.write_repetition(test_path, image_name, source, format_, r,
+                                                    timings)
+                results.append(timings)
+            if repetitions.target_ci_width is not None and len(results) > 1:
+                print("Ran {} repetitions of {} on {} {}, CI width {:.1%} (target {:.1%})".format(
+                    len(results), test_path, source, format_,
+                    repetitions.ci_width([timings["time"] for timings in results]),
+                    repetitions.target_ci_width))
+
+            # Profilers slow the test down, so profile a repetition of its own
+            profile = profile or test_config.get("profile")
+            if profile:
+                profile_combination(
+                    test_path, image_name, slot, test_instance_dir, inputs, test_yaml_path,
+                    profile, resource_interval, output_size_interval, environment,
+                    network_mode, object_server_, cache_control, local_inputs, in_process,
+                    python)
+            return results
+        finally:
+            if runner is not None:
+                runner.stop()
+            if object_server_ is not None:
+                object_server_.stop()
+            # The staged inputs keep cached objects from being evicted
+            localizer_.unstage(test_instance_dir)
+    except Exception as e:
+        if results_writer is not None:
+            results_writer.write_failure(test_path, image_name, source, format_, e)
+        raise
+
+def profile_combination(test_path, image_name, slot, test_instance_dir, inputs, test_yaml_path,
+                        profile, resource_interval=0.1, output_size_interval=0.1,
+                        environment=None, network_mode=None, object_server_=None,
+                        cache_control=None, local_inputs=None, in_process=False, python=None):
+    """Run one repetition of a source-format combination under a profiler.
+
+    Only commands run through timed_entrypoint.py can be profiled, so it runs
+    in a persistent container even if the timed repetitions didn't.
+    """
+    if in_process:
+        # tracemalloc would show up all over the profile
+        runner = InProcessRunner(test_path, test_instance_dir, slot.cpuset, environment,
+                                 python, False, profile)
+    else:
+        runner = PersistentContainerRunner(image_name, test_instance_dir, resource_interval,
+                                           slot.cpuset, slot.mem_limit, environment,
+                                           network_mode, profile)
+    runner.start()
+    try:
+        run_test_repetition(runner, test_instance_dir, inputs, test_yaml_path, "profile",
+                            output_size_interval, object_server_, cache_control, local_inputs)
+    finally:
+        runner.stop()
+    print("Wrote {} profiles of {} to {}".format(
+        profile, test_path, os.path.join(test_instance_dir, "profile")))
+
+def submit_test(scheduler_, image_cache_, localizer_, test_path, data_yaml_path, repetitions=10,
+                local_staging_dir=None, persistent_containers=False, resource_interval=0.1,
+                output_size_interval=0.1, file_location=None, remote_environment=None,
+                results_writer=None, cache_control=None, in_process=False, python=None,
+                trace_memory=True, profile=None):
+    """Schedule the source-format combinations of a test.
+
+    Combinations run concurrently unless the test.yaml has "exclusive: true",
+    in which case each of them runs alone.
+
+    Returns:
+      dict of futures for the results of each combination's repetitions, keyed
+        by source and format
     """
 
-    test_config = yaml.load(open(os.path.join(test_path, "test.yaml")))
-    data_config = yaml.load(open(data_yaml_path))
+    test_config = load_yaml(os.path.join(test_path, "test.yaml"))
+    data_config = load_yaml(data_yaml_path)
 
     test_staging_dir = local_staging_dir or tempfile.mkdtemp()
     if not os.path.isabs(test_staging_dir):
         raise RuntimeError("Staging path must be absolute: {}".format(test_staging_dir))
 
-    test_running_times = collections.defaultdict(collections.defaultdict)
+    test_futures = collections.defaultdict(collections.defaultdict)
 
     # Iterate over the source and format combinations specified in the test's
     # config yaml
@@ -188,37 +594,181 @@ def run_test(test_path, data_yaml_path, repetitions=10, local_staging_dir=None):
                 inputs_ = [inputs["pattern"].replace("$idx", str(i)) for i in inputs["indices"]]
                 inputs = inputs_
 
-            # If the tests are supposed to run off of local files, localize the
-            # remote s3 files first.
-            if test_config["file_location"] == "local":
-                inputs = localize_inputs(inputs, test_instance_dir)
-            print("Done localizing to", test_instance_dir)
+            job = functools.partial(
+                run_combination, image_cache_=image_cache_, localizer_=localizer_,
+                test_path=test_path, source=source, format_=format_,
+                inputs=inputs, test_instance_dir=test_instance_dir,
+                repetitions=repetitions, persistent_containers=persistent_containers,
+                resource_interval=resource_interval,
+                output_size_interval=output_size_interval, file_location=file_location,
+                remote_environment=remote_environment, results_writer=results_writer,
+                cache_control=cache_control, in_process=in_process, python=python,
+                trace_memory=trace_memory, profile=profile)
+            # Tests that share a staging dir would overwrite each other's
+            # outputs, so they never run at the same time
+            test_futures[source][format_] = scheduler_.submit(
+                job, exclusive=test_config.get("exclusive", False),
+                lock_key=test_instance_dir)
+
+    return test_futures
+
+def collect_results(test_futures):
+    """Wait for the futures from submit_test and return their results."""
+    test_running_times = collections.defaultdict(collections.defaultdict)
+    for source, format_futures in test_futures.items():
+        for format_, future in format_futures.items():
+            test_running_times[source][format_] = future.result()
+    return test_running_times
 
-            # Build the image that runs the test
-            image, _ = DOCKER_CLIENT.images.build(
-                path=test_path, tag="matrix_benchmark_{}_{}".format(source, format_).lower())
-            image_name = image.tags[0]
-            print("Built", image_name)
+def run_test(test_path, data_yaml_path, repetitions=10, local_staging_dir=None,
+             persistent_containers=False, resource_interval=0.1,
+             output_size_interval=0.1, file_location=None, remote_environment=None,
+             results_writer=None, cache_control=None, in_process=False, python=None,
+             trace_memory=True, profile=None, scheduler_=None, image_cache_=None,
+             localizer_=None):
+    """Run a test. Get timing results for the specified matrix formats.
 
-            running_times = [run_test_repetition(image_name, test_instance_dir, inputs, os.path.join(test_path, "test.yaml"), r)
-                             for r in range(repetitions)]
-            test_running_times[source][format_] = running_times
+    Args:
+      test_dir: path to the test directory. Should have a test.yaml and a Dockerfile
+      data_yaml_path: path to the yaml file that describes the available data formats
+        in s3
+      local_staging_dir: where inputs and outputs should be staged
+      persistent_containers: run the repetitions of each source-format
+        combination in one long-lived container, and time only the test itself
+      resource_interval: seconds between samples of the containers' resource
+        usage
+      output_size_interval: seconds between samples of the output size
+      file_location: "local" or "remote", to override where the test.yaml
+        says the test reads its inputs from
+      remote_environment: environment variables for tests with remote inputs
+      results_writer: results_store.ResultsWriter to record the results with
+      cache_control: page_cache.CacheControl that sets the page cache state of
+        the inputs. By default they're evicted before every repetition.
+      in_process: run the test's script in a local subprocess instead of in
+        docker, with python, or this interpreter by default. trace_memory
+        records the tracemalloc peak, at some cost in speed.
+      profile: "cprofile" or "sample", to profile one extra repetition of
+        every combination, whatever the test.yaml says. See run_combination.
+      scheduler_: scheduler.Scheduler to run the source-format combinations
+        on. By default they run one after another.
+      image_cache_: image_cache.ImageCache to get the test's image from. By
+        default the manifest in the user's cache directory is used.
+      localizer_: localizer.Localizer to localize inputs with. By default they
+        come from s3, through an unlimited cache in the user's cache directory.
 
-    return test_running_times
+    Returns:
+      output_file_sizes: dict of output produced over time for each of the
+        source-format combinations
+    """
 
-def run_tests(test_dir, data_yaml_path, repetitions=10, local_staging_dir=None):
+    if image_cache_ is None and not in_process:
+        image_cache_ = image_cache.ImageCache(docker_client())
+    own_localizer = localizer_ is None
+    if own_localizer:
+        localizer_ = localizer.Localizer(object_store.S3Store(), dataset_cache.DatasetCache())
+    own_scheduler = scheduler_ is None
+    if own_scheduler:
+        scheduler_ = scheduler.Scheduler()
+    try:
+        test_futures = submit_test(
+            scheduler_, image_cache_, localizer_, test_path, data_yaml_path, repetitions, local_staging_dir,
+            persistent_containers, resource_interval, output_size_interval, file_location,
+            remote_environment, results_writer, cache_control, in_process, python,
+            trace_memory, profile)
+        return collect_results(test_futures)
+    finally:
+        if own_scheduler:
+            scheduler_.shutdown()
+        if own_localizer:
+            localizer_.close()
+
+def run_tests(test_dir, data_yaml_path, repetitions=10, local_staging_dir=None,
+              persistent_containers=False, resource_interval=0.1,
+              output_size_interval=0.1, max_jobs=1, pin_cpus=False,
+              cpus_per_job=None, mem_limit=None,
+              image_manifest_path=image_cache.DEFAULT_MANIFEST_PATH, rebuild_images=False,
+              dataset_cache_dir=dataset_cache.DEFAULT_CACHE_DIR, dataset_cache_bytes=None,
+              bucket_dir=None, s3_endpoint_url=None, download_workers=32, file_location=None,
+              remote_environment=None, results_path=None, run_id=None, warmup=0,
+              min_repetitions=3, target_ci_width=None, cache_mode="cold", warm_fraction=0.5,
+              in_process=False, python=None, trace_memory=True, profile=None):
     """Discover tests by recursing through test_dir. Run each test repetitions
     times and report running times.
+
+    With a target_ci_width, each combination instead runs between
+    min_repetitions and repetitions times, until the confidence interval of
+    its mean time is that narrow. See repetition_policy.RepetitionPolicy. The
+    first warmup repetitions of every combination are discarded.
+
+    Before each repetition, the inputs are put in the page cache state given
+    by cache_mode. See page_cache.CacheControl.
+
+    With in_process, tests run in local subprocesses instead of docker. See
+    run_test for python and trace_memory.
+
+    Up to max_jobs source-format combinations, from any of the tests, run at
+    once. See scheduler.Scheduler for the other scheduling arguments, and
+    image_cache.ImageCache for the image arguments. Inputs are localized
+    through a dataset cache in dataset_cache_dir of up to dataset_cache_bytes,
+    from s3 or, if bucket_dir is given, from a local directory standing in for
+    it, with download_workers concurrent downloads for the whole run.
+    file_location overrides where every test reads its inputs from, and
+    profile profiles every test, like the profile in a test.yaml. Each
+    repetition is recorded in the results file at results_path, under run_id.
     """
 
-    all_running_times = {}
-    for candidate_test_yaml in pathlib.Path(test_dir).glob("**/test.yaml"):
-        candidate_test_path = candidate_test_yaml.parent
-        print(candidate_test_yaml, candidate_test_path)
-        if candidate_test_path.joinpath("Dockerfile").exists():
-            running_times = run_test(str(candidate_test_path), data_yaml_path,
-                                     repetitions, local_staging_dir)
-            all_running_times[candidate_test_path] = running_times
+    image_cache_ = None
+    if not in_process:
+        image_cache_ = image_cache.ImageCache(docker_client(), image_manifest_path,
+                                              rebuild_images)
+    if bucket_dir:
+        store = object_store.LocalStore(bucket_dir)
+    else:
+        store = object_store.S3Store(s3_endpoint_url, max_pool_connections=download_workers)
+    localizer_ = localizer.Localizer(
+        store, dataset_cache.DatasetCache(dataset_cache_dir, dataset_cache_bytes),
+        download_workers)
+    scheduler_ = scheduler.Scheduler(max_jobs, pin_cpus, cpus_per_job, mem_limit)
+    policy = repetition_policy.RepetitionPolicy(repetitions, min_repetitions, warmup,
+                                                target_ci_width)
+    cache_control = page_cache.CacheControl(cache_mode, warm_fraction)
+    results_writer = None
+    if results_path:
+        results_writer = results_store.ResultsWriter(results_path, run_id, {
+            "repetitions": repetitions,
+            "min_repetitions": min_repetitions,
+            "warmup": warmup,
+            "target_ci_width": target_ci_width,
+            "cache_mode": cache_mode,
+            "warm_fraction": warm_fraction if cache_mode == "partial" else None,
+            "persistent_containers": persistent_containers,
+            "in_process": in_process,
+            "trace_memory": trace_memory if in_process else None,
+            "file_location": file_location,
+            "jobs": max_jobs,
+            "pin_cpus": pin_cpus,
+            "memory_limit": mem_limit,
+        })
+        print("Recording results of run", results_writer.run_id, "in", results_path)
+    all_futures = {}
+    try:
+        for candidate_test_yaml in pathlib.Path(test_dir).glob("**/test.yaml"):
+            candidate_test_path = candidate_test_yaml.parent
+            print(candidate_test_yaml, candidate_test_path)
+            if candidate_test_path.joinpath("Dockerfile").exists():
+                all_futures[candidate_test_path] = submit_test(
+                    scheduler_, image_cache_, localizer_, str(candidate_test_path), data_yaml_path,
+                    policy, local_staging_dir, persistent_containers,
+                    resource_interval, output_size_interval, file_location, remote_environment,
+                    results_writer, cache_control, in_process, python, trace_memory,
+                    profile)
+
+        all_running_times = {}
+        for candidate_test_path, test_futures in all_futures.items():
+            all_running_times[candidate_test_path] = collect_results(test_futures)
+    finally:
+        scheduler_.shutdown()
+        localizer_.close()
     print(all_running_times)
     return all_running_times
 
@@ -244,12 +794,191 @@ def main():
         "--repetitions",
         default=10,
         type=int,
-        help="Number of times to repeat each test."
+        help=("Number of times to repeat each test, or with --target-ci-width, "
+              "the most times.")
+    )
+    parser.add_argument(
+        "--warmup",
+        default=0,
+        type=int,
+        help="Number of repetitions to run and discard before the measured ones."
+    )
+    parser.add_argument(
+        "--min-repetitions",
+        default=3,
+        type=int,
+        help="Fewest times to repeat each test with --target-ci-width."
+    )
+    parser.add_argument(
+        "--target-ci-width",
+        type=float,
+        help=("Repeat each test until the 95%% confidence interval of its mean "
+              "time is at most this fraction of the mean, like 0.05.")
+    )
+    parser.add_argument(
+        "--persistent-containers",
+        action="store_true",
+        help=("Run all repetitions of a source-format combination with docker "
+              "exec in one container, and report only the time spent in the "
+              "test itself, not container or interpreter startup.")
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help=("Run each test's script in a local subprocess instead of in "
+              "docker. The python running it needs the test's dependencies.")
+    )
+    parser.add_argument(
+        "--python",
+        help="Python to run tests with in --in-process mode. Defaults to this one."
+    )
+    parser.add_argument(
+        "--no-trace-memory",
+        action="store_true",
+        help="Don't record the tracemalloc peak in --in-process mode, which slows tests down."
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(PROFILE_EXTENSIONS),
+        help=("After each combination's timed repetitions, run one more under "
+              "cProfile, or a sampling profiler that writes collapsed stacks, "
+              "and write the profiles to its staging directory. Defaults to "
+              "the profile in each test.yaml, if any.")
+    )
+    parser.add_argument(
+        "--resource-interval",
+        default=0.1,
+        type=float,
+        help="Seconds between samples of a test container's cgroup resource usage."
+    )
+    parser.add_argument(
+        "--output-size-interval",
+        default=0.1,
+        type=float,
+        help="Seconds between samples of the size of a test's output."
+    )
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help=("Number of source-format combinations to run at once. Tests "
+              "with exclusive: true in their test.yaml always run alone.")
+    )
+    parser.add_argument(
+        "--pin-cpus",
+        action="store_true",
+        help="Pin the containers of each concurrent job to their own CPUs."
+    )
+    parser.add_argument(
+        "--cpus-per-job",
+        type=int,
+        help="Number of CPUs for each job with --pin-cpus. Defaults to an even split."
+    )
+    parser.add_argument(
+        "--memory-limit",
+        help="Memory limit for each test container, like 4g."
+    )
+    parser.add_argument(
+        "--image-manifest",
+        default=image_cache.DEFAULT_MANIFEST_PATH,
+        help="Where to record the test images that have been built."
+    )
+    parser.add_argument(
+        "--rebuild-images",
+        action="store_true",
+        help="Build every test image again, even if the test hasn't changed."
+    )
+    parser.add_argument(
+        "--dataset-cache-dir",
+        default=dataset_cache.DEFAULT_CACHE_DIR,
+        help=("Where to cache downloaded inputs. Staging dirs link to it, so "
+              "it's best on the same filesystem.")
+    )
+    parser.add_argument(
+        "--dataset-cache-gb",
+        type=float,
+        help="Size budget for the dataset cache. Defaults to unlimited."
+    )
+    parser.add_argument(
+        "--bucket-dir",
+        help=("Local directory to read inputs from instead of s3, laid out as "
+              "<bucket>/<key>.")
+    )
+    parser.add_argument(
+        "--s3-endpoint-url",
+        help="Url of an s3-compatible server to download inputs from instead of s3."
+    )
+    parser.add_argument(
+        "--download-workers",
+        default=32,
+        type=int,
+        help="Number of inputs to download at once, across all tests."
+    )
+    parser.add_argument(
+        "--file-location",
+        choices=["local", "remote"],
+        help=("Whether tests read their inputs from local files or over HTTP. "
+              "Defaults to the file_location in each test.yaml.")
+    )
+    parser.add_argument(
+        "--remote-block-size",
+        type=int,
+        help="Bytes per range request when tests read remote inputs."
+    )
+    parser.add_argument(
+        "--remote-cache-blocks",
+        type=int,
+        help="Number of blocks of each remote input a test keeps in memory."
+    )
+    parser.add_argument(
+        "--remote-prefetch-blocks",
+        type=int,
+        help="Number of blocks to read ahead when a test reads a remote input sequentially."
+    )
+    parser.add_argument(
+        "--cache-mode",
+        default="cold",
+        choices=page_cache.MODES,
+        help=("Page cache state of the inputs before each repetition: cold "
+              "evicts them, warm reads them, partial evicts them and reads "
+              "--warm-fraction of each file, and drop drops the whole page "
+              "cache, which needs sudo.")
+    )
+    parser.add_argument(
+        "--warm-fraction",
+        default=0.5,
+        type=float,
+        help="Fraction of each input file to read with --cache-mode partial."
+    )
+    parser.add_argument(
+        "--results-path",
+        default="results.jsonl",
+        help=("JSON Lines file to append a record of each repetition to. See "
+              "summarize_results.py to summarize it.")
+    )
+    parser.add_argument(
+        "--run-id",
+        help="Name for this run in the results file. Defaults to the start time."
     )
     args = parser.parse_args()
 
+    remote_environment = {}
+    for name, value in [("REMOTE_BLOCK_SIZE", args.remote_block_size),
+                        ("REMOTE_CACHE_BLOCKS", args.remote_cache_blocks),
+                        ("REMOTE_PREFETCH_BLOCKS", args.remote_prefetch_blocks)]:
+        if value is not None:
+            remote_environment[name] = str(value)
+
     output_file_sizes = run_tests(
-        args.test_root, args.data_yaml, args.repetitions, args.local_staging_dir)
+        args.test_root, args.data_yaml, args.repetitions, args.local_staging_dir,
+        args.persistent_containers, args.resource_interval, args.output_size_interval,
+        args.jobs, args.pin_cpus, args.cpus_per_job, args.memory_limit,
+        args.image_manifest, args.rebuild_images, args.dataset_cache_dir,
+        int(args.dataset_cache_gb * 2**30) if args.dataset_cache_gb else None,
+        args.bucket_dir, args.s3_endpoint_url, args.download_workers, args.file_location,
+        remote_environment, args.results_path, args.run_id, args.warmup,
+        args.min_repetitions, args.target_ci_width, args.cache_mode, args.warm_fraction,
+        args.in_process, args.python, not args.no_trace_memory, args.profile)
     print(output_file_sizes)
 
 if __name__ == "__main__":
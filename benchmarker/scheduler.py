@@ -0,0 +1,133 @@
+"""Run independent benchmark jobs concurrently.
+
+Each source-format combination of a test is a job. Jobs run on a pool of
+max_jobs threads, and each running job gets a slot: the CPUs its containers are
+pinned to and their memory limit, so that concurrent jobs don't compete for the
+same cores or push each other out of memory.
+
+Two kinds of jobs can't overlap. Exclusive jobs, for I/O-sensitive tests, run
+alone on the whole machine. And jobs that share a lock key, which is their
+staging directory, run one after another, so they don't overwrite each other's
+inputs and outputs.
+"""
+import collections
+import concurrent.futures
+import os
+import queue
+import threading
+
+
+Slot = collections.namedtuple("Slot", ["cpuset", "mem_limit"])
+
+
+class ReadWriteLock(object):
+    """A lock that many readers or one writer can hold. Waiting writers go
+    first, so exclusive jobs aren't starved by a stream of shared ones.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._condition:
+            while self._writer or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            self._readers -= 1
+            self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+
+def _format_cpuset(cpus):
+    return ",".join(str(cpu) for cpu in cpus)
+
+
+class Scheduler(object):
+    """Run jobs concurrently under a concurrency limit.
+
+    Args:
+      max_jobs: how many jobs can run at once
+      pin_cpus: pin each job's containers to its own set of CPUs. The CPUs this
+        process may use are split evenly between the slots, unless
+        cpus_per_job is given.
+      cpus_per_job: how many CPUs each slot gets when pinning
+      mem_limit: memory limit for each job's containers, in any form docker
+        accepts, like "4g"
+    """
+
+    def __init__(self, max_jobs=1, pin_cpus=False, cpus_per_job=None, mem_limit=None):
+        self.max_jobs = max_jobs
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs)
+        self._exclusive_lock = ReadWriteLock()
+        self._key_locks = collections.defaultdict(threading.Lock)
+        self._key_locks_lock = threading.Lock()
+
+        self._slots = queue.Queue()
+        if pin_cpus:
+            cpus = sorted(os.sched_getaffinity(0))
+            cpus_per_job = cpus_per_job or max(1, len(cpus) // max_jobs)
+            if cpus_per_job * max_jobs > len(cpus):
+                raise RuntimeError("Can't give {} jobs {} CPUs each with only {} CPUs".format(
+                    max_jobs, cpus_per_job, len(cpus)))
+            for job in range(max_jobs):
+                job_cpus = cpus[job * cpus_per_job:(job + 1) * cpus_per_job]
+                self._slots.put(Slot(_format_cpuset(job_cpus), mem_limit))
+            self._exclusive_slot = Slot(
+                _format_cpuset(cpus[:cpus_per_job * max_jobs]), mem_limit)
+        else:
+            for _ in range(max_jobs):
+                self._slots.put(Slot(None, mem_limit))
+            self._exclusive_slot = Slot(None, mem_limit)
+
+    def _key_lock(self, lock_key):
+        with self._key_locks_lock:
+            return self._key_locks[lock_key]
+
+    def _run(self, job, exclusive, lock_key):
+        key_lock = self._key_lock(lock_key) if lock_key is not None else threading.Lock()
+        with key_lock:
+            if exclusive:
+                # Exclusive jobs have the whole machine, so they get all the
+                # pinned CPUs
+                self._exclusive_lock.acquire_write()
+                try:
+                    return job(self._exclusive_slot)
+                finally:
+                    self._exclusive_lock.release_write()
+
+            self._exclusive_lock.acquire_read()
+            slot = self._slots.get()
+            try:
+                return job(slot)
+            finally:
+                self._slots.put(slot)
+                self._exclusive_lock.release_read()
+
+    def submit(self, job, exclusive=False, lock_key=None):
+        """Schedule job to be called with the Slot it should run in.
+
+        Returns:
+          a concurrent.futures.Future for the job's return value
+        """
+        return self._executor.submit(self._run, job, exclusive, lock_key)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,346 @@
+"""Summarize benchmark results and compare runs.
+
+The table command renders the results table in the task READMEs from a
+results file:
+
+    python summarize_results.py table --results results.jsonl
+
+and with --readme, replaces the first table after the README's "# Results"
+heading with it. The compare command flags combinations that got
+significantly slower than in a baseline run, and exits with status 1 if any
+did:
+
+    python summarize_results.py compare --baseline baseline.jsonl --results results.jsonl
+
+Confidence intervals are bootstrapped, so they don't assume the running times
+are normally distributed. A percentile bootstrap is too narrow with only a few
+values, though, so intervals of the mean of fewer than MIN_BOOTSTRAP_VALUES
+values are Student-t intervals instead.
+"""
+import argparse
+import collections
+import math
+import random
+import statistics
+import sys
+
+import results_store
+
+# Fewest values to bootstrap the confidence interval of a mean from
+MIN_BOOTSTRAP_VALUES = 10
+
+
+def bootstrap_ci(values, confidence=0.95, resamples=10000, statistic=statistics.mean, seed=0):
+    """Percentile bootstrap confidence interval of a statistic of values."""
+    if len(values) < 2:
+        return (statistic(values), statistic(values))
+    rng = random.Random(seed)
+    estimates = sorted(statistic([rng.choice(values) for _ in values])
+                       for _ in range(resamples))
+    alpha = (1 - confidence) / 2
+    return (estimates[int(alpha * (resamples - 1))],
+            estimates[int((1 - alpha) * (resamples - 1))])
+
+
+def _incomplete_beta(x, a, b):
+    """Regularized incomplete beta function, by its continued fraction."""
+    if x <= 0 or x >= 1:
+        return min(max(x, 0.0), 1.0)
+    if x > (a + 1) / (a + b + 2):
+        return 1 - _incomplete_beta(1 - x, b, a)
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+                     + a * math.log(x) + b * math.log(1 - x)) / a
+    # Lentz's method on 1 + 1 / (1 + d1 / (1 + d2 / ...)), with terms kept
+    # away from zero. The leading 1 is taken off at the end.
+    tiny = 1e-300
+    c = 1.0
+    d = 0.0
+    fraction = 1.0
+    for m in range(200):
+        if m == 0:
+            numerators = [1.0]
+        else:
+            numerators = [m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m))]
+        numerators.append(-(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1)))
+        for numerator in numerators:
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            fraction *= c * d
+        if abs(c * d - 1) < 1e-12:
+            break
+    return front * (fraction - 1)
+
+
+def t_quantile(p, df):
+    """Quantile of Student's t distribution with df degrees of freedom, for
+    p of at least 0.5.
+    """
+    def cdf(t):
+        return 1 - _incomplete_beta(df / (df + t * t), df / 2, 0.5) / 2
+
+    low, high = 0.0, 1.0
+    while cdf(high) < p:
+        low, high = high, 2 * high
+    for _ in range(100):
+        middle = (low + high) / 2
+        if cdf(middle) < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def t_ci(values, confidence=0.95):
+    """Student-t confidence interval of the mean of values."""
+    mean = statistics.mean(values)
+    if len(values) < 2:
+        return (mean, mean)
+    half_width = (t_quantile(1 - (1 - confidence) / 2, len(values) - 1)
+                  * statistics.stdev(values) / math.sqrt(len(values)))
+    return (mean - half_width, mean + half_width)
+
+
+def mean_ci(values, confidence=0.95, resamples=10000):
+    """Confidence interval of the mean of values: a Student-t interval for
+    fewer than MIN_BOOTSTRAP_VALUES values, bootstrapped otherwise.
+    """
+    if len(values) < MIN_BOOTSTRAP_VALUES:
+        return t_ci(values, confidence)
+    return bootstrap_ci(values, confidence, resamples)
+
+
+def bootstrap_ratio_ci(baseline, current, confidence=0.95, resamples=10000, seed=0):
+    """Percentile bootstrap confidence interval of the ratio of the mean of
+    current to the mean of baseline, resampling each independently.
+    """
+    rng = random.Random(seed)
+    ratios = sorted(statistics.mean([rng.choice(current) for _ in current]) /
+                    statistics.mean([rng.choice(baseline) for _ in baseline])
+                    for _ in range(resamples))
+    alpha = (1 - confidence) / 2
+    return (ratios[int(alpha * (resamples - 1))],
+            ratios[int((1 - alpha) * (resamples - 1))])
+
+
+def group_metric(records, metric="time"):
+    """Collect a metric by test, source and format.
+
+    Returns:
+      OrderedDict of lists of the metric's values, or None for combinations
+        that failed, sorted by test, format and source
+    """
+    groups = {}
+    for record in records:
+        key = (record["test"], record["source"], record["format"])
+        if record["status"] != "ok":
+            groups[key] = None
+        elif groups.get(key, []) is not None:
+            value = record["metrics"].get(metric)
+            if value is not None:
+                groups.setdefault(key, []).append(value)
+    return collections.OrderedDict(
+        sorted(groups.items(), key=lambda item: (item[0][0], item[0][2], item[0][1])))
+
+
+def summarize(values, confidence=0.95, resamples=10000):
+    """Return the mean, min, max, variance and confidence interval of values."""
+    return {
+        "n": len(values),
+        "mean": statistics.mean(values),
+        "min": min(values),
+        "max": max(values),
+        "variance": statistics.variance(values) if len(values) > 1 else 0.0,
+        "ci": mean_ci(values, confidence, resamples),
+    }
+
+
+def _display_test(test):
+    """Drop the task from a test name, so merge/merge_npy is npy."""
+    task, _, name = test.rpartition("/")
+    prefix = task + "_"
+    return name[len(prefix):] if name.startswith(prefix) else name
+
+
+def _markdown_table(header, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    lines = ["| " + " | ".join(str(cell).ljust(width) for cell, width in zip(row, widths)) + " |"
+             for row in [header] + rows]
+    lines.insert(1, "|" + "|".join("-" * (width + 2) for width in widths) + "|")
+    return "\n".join(lines)
+
+
+def render_table(records, metric="time", confidence=0.95, resamples=10000, show_source=False):
+    """Render the markdown results table of the task READMEs."""
+    header = ["Test", "Format", "Mean time (s)", "Min", "Max", "Variance",
+              "{:.0%} CI".format(confidence)]
+    if show_source:
+        header.insert(1, "Source")
+    rows = []
+    for (test, source, format_), values in group_metric(records, metric).items():
+        if not values:
+            row = [_display_test(test), format_, "Failed", "N/A", "N/A", "N/A", "N/A"]
+        else:
+            stats = summarize(values, confidence, resamples)
+            row = [_display_test(test), format_, "{:.2f}".format(stats["mean"]),
+                   "{:.2f}".format(stats["min"]), "{:.2f}".format(stats["max"]),
+                   "{:.2f}".format(stats["variance"]),
+                   "{:.2f}-{:.2f}".format(*stats["ci"])]
+        if show_source:
+            row.insert(1, source)
+        rows.append(row)
+    return _markdown_table(header, rows)
+
+
+def replace_readme_table(readme_path, table):
+    """Replace the first table after the "# Results" heading of a README."""
+    with open(readme_path) as readme:
+        lines = readme.read().split("\n")
+    results_line = next((i for i, line in enumerate(lines) if line.strip() == "# Results"), None)
+    if results_line is None:
+        raise RuntimeError("No # Results heading in {}".format(readme_path))
+    start = next((i for i in range(results_line, len(lines)) if lines[i].startswith("|")), None)
+    if start is None:
+        lines.extend(["", table])
+    else:
+        end = start
+        while end < len(lines) and lines[end].startswith("|"):
+            end += 1
+        lines[start:end] = [table]
+    with open(readme_path, "w") as readme:
+        readme.write("\n".join(lines))
+
+
+def compare(baseline_records, records, metric="time", threshold=0.05, confidence=0.95,
+            resamples=10000):
+    """Compare a run against a baseline.
+
+    A combination is a regression if the whole confidence interval of the
+    ratio of its mean to the baseline's mean is above 1 + threshold, so small
+    or noisy changes aren't flagged.
+
+    Returns:
+      list of dicts describing each combination that's in both runs
+    """
+    baseline = group_metric(baseline_records, metric)
+    current = group_metric(records, metric)
+    comparisons = []
+    for key, values in current.items():
+        baseline_values = baseline.get(key)
+        if not values or not baseline_values:
+            continue
+        low, high = bootstrap_ratio_ci(baseline_values, values, confidence, resamples)
+        comparisons.append({
+            "test": key[0],
+            "source": key[1],
+            "format": key[2],
+            "baseline_mean": statistics.mean(baseline_values),
+            "mean": statistics.mean(values),
+            "ratio_ci": (low, high),
+            "regression": low > 1 + threshold,
+            "improvement": high < 1 - threshold,
+        })
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    def add_common_arguments(subparser):
+        subparser.add_argument(
+            "--results",
+            required=True,
+            help="Results file written by run_benchmark.py."
+        )
+        subparser.add_argument(
+            "--run-id",
+            default="latest",
+            help="Run in the results file to use. Defaults to the last one."
+        )
+        subparser.add_argument(
+            "--metric",
+            default="time",
+            help="Metric to summarize, like time or exec_time."
+        )
+        subparser.add_argument(
+            "--confidence",
+            default=0.95,
+            type=float,
+            help="Confidence level of the confidence intervals."
+        )
+        subparser.add_argument(
+            "--resamples",
+            default=10000,
+            type=int,
+            help="Number of bootstrap resamples."
+        )
+
+    table_parser = subparsers.add_parser("table", help="Render the README results table.")
+    add_common_arguments(table_parser)
+    table_parser.add_argument(
+        "--show-source",
+        action="store_true",
+        help="Add a column for the data source."
+    )
+    table_parser.add_argument(
+        "--readme",
+        help="README to replace the results table of, instead of printing it."
+    )
+
+    compare_parser = subparsers.add_parser("compare", help="Flag slowdowns against a baseline.")
+    add_common_arguments(compare_parser)
+    compare_parser.add_argument(
+        "--baseline",
+        required=True,
+        help="Results file with the baseline run."
+    )
+    compare_parser.add_argument(
+        "--baseline-run-id",
+        default="latest",
+        help="Run in the baseline file to compare against. Defaults to the last one."
+    )
+    compare_parser.add_argument(
+        "--threshold",
+        default=0.05,
+        type=float,
+        help="Smallest relative slowdown to flag."
+    )
+    args = parser.parse_args()
+
+    records = results_store.read_results(args.results, args.run_id)
+
+    if args.command == "table":
+        table = render_table(records, args.metric, args.confidence, args.resamples,
+                             args.show_source)
+        if args.readme:
+            replace_readme_table(args.readme, table)
+        else:
+            print(table)
+        return
+
+    baseline_records = results_store.read_results(args.baseline, args.baseline_run_id)
+    comparisons = compare(baseline_records, records, args.metric, args.threshold,
+                          args.confidence, args.resamples)
+    rows = []
+    for comparison in comparisons:
+        change = comparison["mean"] / comparison["baseline_mean"] - 1
+        if comparison["regression"]:
+            verdict = "SLOWER"
+        elif comparison["improvement"]:
+            verdict = "faster"
+        else:
+            verdict = ""
+        rows.append([comparison["test"], comparison["source"], comparison["format"],
+                     "{:.2f}".format(comparison["baseline_mean"]),
+                     "{:.2f}".format(comparison["mean"]), "{:+.1%}".format(change),
+                     "{:.3f}-{:.3f}".format(*comparison["ratio_ci"]), verdict])
+    print(_markdown_table(["Test", "Source", "Format", "Baseline", "Current", "Change",
+                           "Ratio CI", ""], rows))
+    if any(comparison["regression"] for comparison in comparisons):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
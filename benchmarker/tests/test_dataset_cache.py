@@ -0,0 +1,129 @@
+import os
+import stat
+import threading
+
+import pytest
+
+import dataset_cache
+import object_store
+
+
+class CountingStore(object_store.LocalStore):
+    """LocalStore that counts downloads."""
+
+    def __init__(self, root_dir):
+        object_store.LocalStore.__init__(self, root_dir)
+        self.downloads = 0
+        self._lock = threading.Lock()
+
+    def download(self, bucket, key, path, size=None):
+        with self._lock:
+            self.downloads += 1
+        object_store.LocalStore.download(self, bucket, key, path, size)
+
+
+def _put(root_dir, key, data):
+    path = os.path.join(str(root_dir), "bucket", key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _object(store, key):
+    return next(obj for obj in store.list_objects("bucket", key) if obj.key == key)
+
+
+@pytest.fixture
+def store(tmp_path):
+    _put(tmp_path / "store", "a", b"a" * 100)
+    _put(tmp_path / "store", "b", b"b" * 100)
+    _put(tmp_path / "store", "c", b"c" * 100)
+    return CountingStore(str(tmp_path / "store"))
+
+
+def test_objects_are_downloaded_once(tmp_path, store):
+    cache = dataset_cache.DatasetCache(str(tmp_path / "cache"))
+    obj = _object(store, "a")
+    path = cache.fetch(store, "bucket", obj)
+    assert cache.fetch(store, "bucket", obj) == path
+    assert store.downloads == 1
+    with open(path, "rb") as f:
+        assert f.read() == b"a" * 100
+    stat_ = os.stat(path)
+    assert stat.S_IMODE(stat_.st_mode) == dataset_cache.READ_ONLY
+    assert stat_.st_mtime_ns == dataset_cache.CACHED_MTIME_NS
+    assert os.listdir(cache.tmp_dir) == []
+
+
+def test_write_through_a_hardlink_is_downloaded_again(tmp_path, store):
+    cache = dataset_cache.DatasetCache(str(tmp_path / "cache"))
+    obj = _object(store, "a")
+    cache_path = cache.fetch(store, "bucket", obj)
+    staged_path = str(tmp_path / "staging" / "a")
+    os.makedirs(os.path.dirname(staged_path))
+    os.link(cache_path, staged_path)
+
+    # Like a test that makes its input writable and opens it in place
+    os.chmod(staged_path, stat.S_IRUSR | stat.S_IWUSR)
+    with open(staged_path, "r+b") as f:
+        f.write(b"x")
+
+    assert cache.fetch(store, "bucket", obj) == cache_path
+    assert store.downloads == 2
+    with open(cache_path, "rb") as f:
+        assert f.read() == b"a" * 100
+    assert not os.path.samefile(cache_path, staged_path)
+
+
+def test_link_replaces_what_was_staged(tmp_path, store):
+    cache = dataset_cache.DatasetCache(str(tmp_path / "cache"))
+    cache_path = cache.fetch(store, "bucket", _object(store, "a"))
+    staged_path = str(tmp_path / "staging" / "dir" / "a")
+    os.makedirs(os.path.dirname(staged_path))
+    with open(staged_path, "wb") as f:
+        f.write(b"partial")
+
+    cache.link(cache_path, staged_path)
+    cache.link(cache_path, staged_path)
+    with open(staged_path, "rb") as f:
+        assert f.read() == b"a" * 100
+    assert os.listdir(os.path.dirname(staged_path)) == ["a"]
+
+
+def _fetch_in_order(cache, store, keys):
+    """Fetch the objects at keys, each used later than the one before."""
+    paths = {}
+    for atime_ns, key in enumerate(keys, 1):
+        paths[key] = cache.fetch(store, "bucket", _object(store, key))
+        os.utime(paths[key], ns=(atime_ns * 10**9, dataset_cache.CACHED_MTIME_NS))
+    return paths
+
+
+def test_evict_removes_least_recently_used(tmp_path, store):
+    cache = dataset_cache.DatasetCache(str(tmp_path / "cache"), max_bytes=200)
+    paths = _fetch_in_order(cache, store, ["b", "a", "c"])
+    cache.evict()
+    assert not os.path.exists(paths["b"])
+    assert os.path.exists(paths["a"])
+    assert os.path.exists(paths["c"])
+
+
+def test_evict_does_nothing_under_budget(tmp_path, store):
+    cache = dataset_cache.DatasetCache(str(tmp_path / "cache"), max_bytes=300)
+    paths = _fetch_in_order(cache, store, ["a", "b", "c"])
+    cache.evict()
+    assert all(os.path.exists(path) for path in paths.values())
+
+
+def test_evict_skips_linked_objects_and_warns(tmp_path, store):
+    cache = dataset_cache.DatasetCache(str(tmp_path / "cache"), max_bytes=100)
+    paths = _fetch_in_order(cache, store, ["a", "b", "c"])
+    os.makedirs(str(tmp_path / "staging"))
+    for key in ["a", "b"]:
+        os.link(paths[key], str(tmp_path / "staging" / key))
+
+    with pytest.warns(UserWarning, match="over its budget"):
+        cache.evict()
+    assert os.path.exists(paths["a"])
+    assert os.path.exists(paths["b"])
+    assert not os.path.exists(paths["c"])
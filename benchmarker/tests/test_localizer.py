@@ -0,0 +1,148 @@
+import os
+import threading
+
+import pytest
+
+import dataset_cache
+import localizer
+import object_store
+
+
+def _put(root_dir, key, data):
+    path = os.path.join(root_dir, "bucket", key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class FlakyStore(object_store.LocalStore):
+    """LocalStore that fails its first few downloads."""
+
+    def __init__(self, root_dir, failures):
+        object_store.LocalStore.__init__(self, root_dir)
+        self.failures = failures
+        self.downloads = 0
+        self._lock = threading.Lock()
+
+    def download(self, bucket, key, path, size=None):
+        with self._lock:
+            self.downloads += 1
+            fail = self.downloads <= self.failures
+        if fail:
+            raise IOError("Connection reset")
+        object_store.LocalStore.download(self, bucket, key, path, size)
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    store_dir = str(tmp_path / "store")
+    _put(store_dir, "source/csv/0.csv", b"0" * 10)
+    _put(store_dir, "source/csv/1.csv", b"1" * 10)
+    _put(store_dir, "source/csv/sub/2.csv", b"2" * 10)
+    _put(store_dir, "source/csv_other/3.csv", b"3" * 10)
+    _put(store_dir, "source/loom/0.loom", b"l" * 10)
+    return store_dir
+
+
+def _localizer(tmp_path, store, retries=3, max_bytes=None):
+    cache = dataset_cache.DatasetCache(str(tmp_path / "cache"), max_bytes)
+    return localizer.Localizer(store, cache, workers=4, retries=retries, progress_interval=60)
+
+
+def test_localize_stages_everything_under_each_prefix(tmp_path, store_dir):
+    localizer_ = _localizer(tmp_path, object_store.LocalStore(store_dir))
+    staging_dir = str(tmp_path / "staging")
+    try:
+        paths = localizer_.localize(
+            ["s3://bucket/source/csv/", "s3://bucket/source/loom/0.loom"], staging_dir)
+    finally:
+        localizer_.close()
+
+    assert paths == [os.path.join(staging_dir, "source/csv/"),
+                     os.path.join(staging_dir, "source/loom/0.loom")]
+    staged = sorted(os.path.relpath(os.path.join(dirpath, filename), staging_dir)
+                    for dirpath, _, filenames in os.walk(staging_dir)
+                    for filename in filenames)
+    assert staged == ["source/csv/0.csv", "source/csv/1.csv", "source/csv/sub/2.csv",
+                      "source/loom/0.loom"]
+    with open(os.path.join(staging_dir, "source/csv/sub/2.csv"), "rb") as f:
+        assert f.read() == b"2" * 10
+
+
+def test_localize_a_single_input(tmp_path, store_dir):
+    localizer_ = _localizer(tmp_path, object_store.LocalStore(store_dir))
+    staging_dir = str(tmp_path / "staging")
+    try:
+        path = localizer_.localize("s3://bucket/source/loom/0.loom", staging_dir)
+    finally:
+        localizer_.close()
+    assert path == os.path.join(staging_dir, "source/loom/0.loom")
+    assert os.path.isfile(path)
+
+
+def test_failed_downloads_are_retried(tmp_path, store_dir):
+    store = FlakyStore(store_dir, failures=1)
+    localizer_ = _localizer(tmp_path, store, retries=1)
+    try:
+        path = localizer_.localize("s3://bucket/source/loom/0.loom", str(tmp_path / "staging"))
+    finally:
+        localizer_.close()
+    assert store.downloads == 2
+    assert os.path.isfile(path)
+
+
+def test_localize_fails_after_the_last_retry(tmp_path, store_dir):
+    store = FlakyStore(store_dir, failures=2)
+    localizer_ = _localizer(tmp_path, store, retries=1)
+    try:
+        with pytest.raises(IOError):
+            localizer_.localize("s3://bucket/source/loom/0.loom", str(tmp_path / "staging"))
+    finally:
+        localizer_.close()
+    assert os.listdir(localizer_.dataset_cache.tmp_dir) == []
+
+
+def test_two_jobs_staging_the_same_key(tmp_path, store_dir):
+    localizer_ = _localizer(tmp_path, object_store.LocalStore(store_dir))
+    staging_dirs = [str(tmp_path / "staging{}".format(i)) for i in range(2)]
+    barrier = threading.Barrier(2, timeout=5)
+    errors = []
+
+    def job(staging_dir):
+        try:
+            barrier.wait()
+            localizer_.localize("s3://bucket/source/csv/", staging_dir)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=job, args=(staging_dir,)) for staging_dir in staging_dirs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    localizer_.close()
+
+    assert errors == []
+    for staging_dir in staging_dirs:
+        for key, data in [("0.csv", b"0"), ("1.csv", b"1"), ("sub/2.csv", b"2")]:
+            with open(os.path.join(staging_dir, "source/csv", key), "rb") as f:
+                assert f.read() == data * 10
+    cached = [filename for _, _, filenames in os.walk(localizer_.dataset_cache.objects_dir)
+              for filename in filenames]
+    assert len(cached) == 3
+    assert os.listdir(localizer_.dataset_cache.tmp_dir) == []
+
+
+def test_unstage_lets_the_cache_evict(tmp_path, store_dir):
+    localizer_ = _localizer(tmp_path, object_store.LocalStore(store_dir), max_bytes=10)
+    staging_dir = str(tmp_path / "staging")
+    try:
+        localizer_.localize("s3://bucket/source/csv/", staging_dir)
+        localizer_.unstage(staging_dir)
+    finally:
+        localizer_.close()
+    staged = [filename for _, _, filenames in os.walk(staging_dir) for filename in filenames]
+    cached = [filename for _, _, filenames in os.walk(localizer_.dataset_cache.objects_dir)
+              for filename in filenames]
+    assert staged == []
+    assert len(cached) == 1
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import page_cache
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    input_dir = tmp_path / "inputs"
+    os.makedirs(str(input_dir / "sub"))
+    sizes = {"a": 64 * page_cache.PAGE_SIZE, "sub/b": 16 * page_cache.PAGE_SIZE + 1, "empty": 0}
+    for name, size in sizes.items():
+        with open(str(input_dir / name), "wb") as f:
+            f.write(os.urandom(size))
+    return str(input_dir), sum(sizes.values())
+
+
+def test_residency_walks_directories(inputs):
+    input_dir, total_bytes = inputs
+    state = page_cache.residency([input_dir, os.path.join(input_dir, "missing")])
+    assert state["files"] == 3
+    assert state["bytes"] == total_bytes
+    assert 0 <= state["resident_bytes"] <= total_bytes
+
+
+def test_warm_reads_everything(inputs):
+    input_dir, total_bytes = inputs
+    state = page_cache.CacheControl("warm").prepare([input_dir])
+    assert state["mode"] == "warm"
+    assert state["resident_bytes"] == total_bytes
+    assert state["resident_fraction"] == 1.0
+
+
+def _evicts(input_dir):
+    page_cache.evict([input_dir])
+    return page_cache.residency([input_dir])["resident_fraction"] < 1.0
+
+
+def test_cold_and_partial(inputs):
+    input_dir, total_bytes = inputs
+    if not _evicts(input_dir):
+        pytest.skip("the filesystem keeps files in memory")
+
+    state = page_cache.CacheControl("cold").prepare([input_dir])
+    assert state["resident_fraction"] < 0.5
+
+    state = page_cache.CacheControl("partial", warm_fraction=0.5).prepare([input_dir])
+    assert state["warm_fraction"] == 0.5
+    # Readahead is turned off, but the last page read is cached whole
+    assert 0.4 <= state["resident_fraction"] <= 0.75
+
+
+def test_empty_inputs():
+    assert page_cache.residency([])["resident_fraction"] == 0.0
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        page_cache.CacheControl("lukewarm")
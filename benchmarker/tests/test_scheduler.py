@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+
+import pytest
+
+import scheduler
+
+
+class Tracker(object):
+    """Record how many jobs run at once, overall and per name."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.overlaps = []
+
+    def job(self, name, seconds=0.05):
+        def run(slot):
+            with self.lock:
+                self.running[name] = self.running.get(name, 0) + 1
+                self.overlaps.append((name, dict(self.running)))
+            time.sleep(seconds)
+            with self.lock:
+                self.running[name] -= 1
+                if not self.running[name]:
+                    del self.running[name]
+            return slot
+        return run
+
+
+def test_jobs_run_concurrently():
+    sched = scheduler.Scheduler(max_jobs=2)
+    barrier = threading.Barrier(2, timeout=5)
+    try:
+        futures = [sched.submit(lambda slot: barrier.wait()) for _ in range(2)]
+        # Both jobs have to be running for the barrier to let either through
+        for future in futures:
+            future.result(timeout=10)
+    finally:
+        sched.shutdown()
+
+
+def test_jobs_with_the_same_lock_key_run_one_at_a_time():
+    tracker = Tracker()
+    sched = scheduler.Scheduler(max_jobs=4)
+    try:
+        futures = [sched.submit(tracker.job("staged"), lock_key="/staging/a")
+                   for _ in range(4)]
+        for future in futures:
+            future.result(timeout=10)
+    finally:
+        sched.shutdown()
+    assert all(running["staged"] == 1 for _, running in tracker.overlaps)
+
+
+def test_exclusive_jobs_run_alone():
+    tracker = Tracker()
+    sched = scheduler.Scheduler(max_jobs=4)
+    try:
+        futures = [sched.submit(tracker.job("shared{}".format(i))) for i in range(3)]
+        futures.append(sched.submit(tracker.job("exclusive"), exclusive=True))
+        futures.extend(sched.submit(tracker.job("shared{}".format(i))) for i in range(3, 6))
+        for future in futures:
+            future.result(timeout=10)
+    finally:
+        sched.shutdown()
+    exclusive_starts = [running for name, running in tracker.overlaps if name == "exclusive"]
+    assert exclusive_starts == [{"exclusive": 1}]
+    assert all("exclusive" not in running
+               for name, running in tracker.overlaps if name != "exclusive")
+
+
+@pytest.mark.skipif(len(os.sched_getaffinity(0)) < 2, reason="needs 2 CPUs")
+def test_pinned_slots_get_their_own_cpus():
+    cpus = sorted(os.sched_getaffinity(0))
+    sched = scheduler.Scheduler(max_jobs=2, pin_cpus=True, cpus_per_job=1, mem_limit="1g")
+    barrier = threading.Barrier(2, timeout=5)
+
+    def job(slot):
+        barrier.wait()
+        return slot
+
+    try:
+        slots = [f.result(timeout=10) for f in [sched.submit(job) for _ in range(2)]]
+        exclusive_slot = sched.submit(lambda slot: slot, exclusive=True).result(timeout=10)
+    finally:
+        sched.shutdown()
+    assert sorted(slot.cpuset for slot in slots) == sorted(str(cpu) for cpu in cpus[:2])
+    assert all(slot.mem_limit == "1g" for slot in slots)
+    assert exclusive_slot.cpuset == "{},{}".format(*cpus[:2])
+
+
+def test_too_many_cpus_per_job():
+    with pytest.raises(RuntimeError):
+        scheduler.Scheduler(max_jobs=2, pin_cpus=True,
+                            cpus_per_job=len(os.sched_getaffinity(0)))
@@ -0,0 +1,61 @@
+import statistics
+
+import pytest
+
+import summarize_results
+
+
+@pytest.mark.parametrize("df,expected", [
+    (1, 12.7062),
+    (2, 4.3027),
+    (4, 2.7764),
+    (9, 2.2622),
+    (30, 2.0423),
+])
+def test_t_quantile(df, expected):
+    assert summarize_results.t_quantile(0.975, df) == pytest.approx(expected, abs=1e-4)
+
+
+def test_t_quantile_of_the_median():
+    assert summarize_results.t_quantile(0.5, 5) == pytest.approx(0.0, abs=1e-9)
+
+
+def test_t_ci():
+    low, high = summarize_results.t_ci([1, 2, 3, 4, 5])
+    # 3 +- t(0.975, 4) * stdev / sqrt(5)
+    assert low == pytest.approx(1.0368, abs=1e-4)
+    assert high == pytest.approx(4.9632, abs=1e-4)
+
+
+def test_t_ci_of_one_value():
+    assert summarize_results.t_ci([2.5]) == (2.5, 2.5)
+
+
+def test_bootstrap_ci_of_constant_values():
+    assert summarize_results.bootstrap_ci([3.0] * 12, resamples=100) == (3.0, 3.0)
+
+
+def test_bootstrap_ci():
+    values = [float(v) for v in range(1, 21)]
+    low, high = summarize_results.bootstrap_ci(values, resamples=2000)
+    # The standard error of the mean is about 1.3
+    assert 7.5 < low < 10.5 < high < 13.5
+    assert summarize_results.bootstrap_ci(values, resamples=2000) == (low, high)
+
+
+def test_mean_ci_switches_to_the_bootstrap():
+    few = [1.0, 2.0, 4.0]
+    assert summarize_results.mean_ci(few) == summarize_results.t_ci(few)
+    many = [float(v) for v in range(summarize_results.MIN_BOOTSTRAP_VALUES)]
+    assert (summarize_results.mean_ci(many, resamples=500)
+            == summarize_results.bootstrap_ci(many, resamples=500))
+
+
+def test_bootstrap_ratio_ci():
+    baseline = [10.0, 11.0, 9.0, 10.5, 9.5]
+    low, high = summarize_results.bootstrap_ratio_ci(baseline, baseline, resamples=2000)
+    assert low < 1.0 < high
+    slower = [2 * value for value in baseline]
+    low, high = summarize_results.bootstrap_ratio_ci(baseline, slower, resamples=2000)
+    assert 1.5 < low < 2.0 < high < 2.5
+    assert statistics.mean(slower) / statistics.mean(baseline) == 2.0
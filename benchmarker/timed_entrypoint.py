@@ -0,0 +1,190 @@
+"""Run a test's entrypoint script and time its imports and its work separately.
+
+The benchmarker uses this when it runs repetitions with docker exec in a
+long-lived container. The benchmarker directory is mounted in the container, and
+the image's entrypoint script is run through this wrapper:
+
+    python3 /benchmarker/timed_entrypoint.py --timing-file timing.json \
+        /scripts/merge_npy.py test --input-paths ... --output-path ...
+
+The timing file gets the time spent importing the script and the time spent in
+its main function. Whatever is left of the exec's wall time is container exec
+and interpreter startup overhead.
+
+The benchmarker's in-process mode runs task scripts through it too, without
+docker, and uses the resource usage it records for the main function: CPU
+time, page faults and block I/O from getrusage, including child processes
+the task waited for, the peak resident set size and, with --trace-memory, the
+peak of the memory traced by tracemalloc.
+
+With --profile, the main function runs under a profiler and the profile is
+written to --profile-path: cProfile's pstats, or with "sample", collapsed
+stacks sampled from every thread, one "frame;frame;... count" line per stack,
+which flamegraph.pl and speedscope read. The benchmarker only profiles
+repetitions whose times it doesn't record.
+"""
+import time
+START_TIME = time.perf_counter()
+
+import argparse
+import collections
+import cProfile
+import importlib.util
+import json
+import os
+import resource
+import sys
+import threading
+import tracemalloc
+
+
+# getrusage counts block I/O in 512 byte units
+BLOCK_SIZE = 512
+
+
+def _rusage():
+    """Sum the resource usage of this process and its waited-for children."""
+    usages = [resource.getrusage(resource.RUSAGE_SELF),
+              resource.getrusage(resource.RUSAGE_CHILDREN)]
+    return {
+        "cpu_user_seconds": sum(usage.ru_utime for usage in usages),
+        "cpu_system_seconds": sum(usage.ru_stime for usage in usages),
+        "page_faults": sum(usage.ru_minflt + usage.ru_majflt for usage in usages),
+        "major_page_faults": sum(usage.ru_majflt for usage in usages),
+        "io_read_bytes": sum(usage.ru_inblock for usage in usages) * BLOCK_SIZE,
+        "io_write_bytes": sum(usage.ru_oublock for usage in usages) * BLOCK_SIZE,
+        # getrusage doesn't count I/O operations like a cgroup does, only
+        # blocks, so these have names of their own
+        "io_read_blocks": sum(usage.ru_inblock for usage in usages),
+        "io_write_blocks": sum(usage.ru_oublock for usage in usages),
+        # Linux reports the maximum resident set size in KiB
+        "peak_memory_bytes": max(usage.ru_maxrss for usage in usages) * 1024,
+    }
+
+
+class SamplingProfiler(object):
+    """Sample the stacks of all of the process's threads every interval
+    seconds, from a background thread.
+
+    It has the same enable, disable and dump_stats methods as cProfile.Profile,
+    but dump_stats writes collapsed stacks instead of pstats.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enable(self):
+        self._thread = threading.Thread(target=self._sample, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self._thread.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(
+                        code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        with open(path, "w") as stacks_file:
+            for stack, count in self.stacks.most_common():
+                stacks_file.write("{} {}\n".format(stack, count))
+
+
+PROFILERS = {"cprofile": cProfile.Profile, "sample": SamplingProfiler}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--timing-file",
+        required=True,
+        help="Where to write the timings as json."
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Record the peak memory traced by tracemalloc during the main function."
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(PROFILERS),
+        help="Profile the main function with cProfile, or by sampling stacks."
+    )
+    parser.add_argument(
+        "--profile-path",
+        help="Where to write the profile."
+    )
+    parser.add_argument(
+        "script",
+        help="The entrypoint script to run. It must have a main function."
+    )
+    parser.add_argument(
+        "script_args",
+        nargs=argparse.REMAINDER,
+        help="Arguments for the script."
+    )
+    args = parser.parse_args()
+
+    # Make the script behave as if it had been run directly
+    script_path = os.path.abspath(args.script)
+    sys.path.insert(0, os.path.dirname(script_path))
+    sys.argv = [script_path] + args.script_args
+
+    import_start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location("task_script", script_path)
+    module = importlib.util.module_from_spec(spec)
+    # Register the module so that its functions can be pickled for process pools
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+
+    profiler = None
+    if args.profile:
+        profiler = PROFILERS[args.profile]()
+    if args.trace_memory:
+        tracemalloc.start()
+    usage_start = _rusage()
+    task_start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        module.main()
+    finally:
+        task_end = time.perf_counter()
+        usage_end = _rusage()
+        if profiler is not None:
+            # Keep the profile of a failed command too, it shows where it failed
+            profiler.disable()
+            profiler.dump_stats(args.profile_path)
+
+    resources = {key: value - usage_start[key] for key, value in usage_end.items()}
+    resources["peak_memory_bytes"] = usage_end["peak_memory_bytes"]
+    if args.trace_memory:
+        resources["tracemalloc_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    with open(args.timing_file, "w") as timing_file:
+        json.dump({
+            "wrapper_startup": import_start - START_TIME,
+            "import": task_start - import_start,
+            "task": task_end - task_start,
+            "total": task_end - START_TIME,
+            "resources": resources
+        }, timing_file)
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,179 @@
 import argparse
+import collections
+import concurrent.futures
 import os
 import pathlib
+import pickle
 import shutil
+import tempfile
 import urllib.request
 import yaml
 
+import numpy
+import scipy.sparse
+
 import converters
 
+# The arrays of a CSC matrix, saved as .npy files
+SPARSE_ARRAYS = ["data", "indices", "indptr"]
+
+
+def _available_cpus():
+    """Return the number of CPUs this process may run on, which is fewer than
+    os.cpu_count when the container is pinned to some of them.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+def _save_matrix(matrix, matrix_dir):
+    """Write a converters.Matrix's values as .npy files that workers can
+    memory map, and its names next to them.
+
+    Dense values are saved as they are, and sparse ones as the arrays of a CSC
+    matrix.
+    """
+    pathlib.Path(matrix_dir).mkdir(parents=True)
+    if scipy.sparse.issparse(matrix.data):
+        csc = matrix.data.tocsc()
+        arrays = {name: getattr(csc, name) for name in SPARSE_ARRAYS}
+    else:
+        arrays = {"values": numpy.asarray(matrix.data)}
+    for name, array in arrays.items():
+        numpy.save(os.path.join(matrix_dir, name + ".npy"), array)
+    with open(os.path.join(matrix_dir, "labels.pickle"), "wb") as labels_file:
+        pickle.dump((matrix.row_names, matrix.col_names, matrix.data.shape), labels_file)
+
+def _load_matrix(matrix_dir):
+    """Rebuild a converters.Matrix saved by _save_matrix around read-only
+    memory maps of its values, so the values aren't copied.
+    """
+    with open(os.path.join(matrix_dir, "labels.pickle"), "rb") as labels_file:
+        row_names, col_names, shape = pickle.load(labels_file)
+    values_path = os.path.join(matrix_dir, "values.npy")
+    if os.path.exists(values_path):
+        data = numpy.load(values_path, mmap_mode="r")
+    else:
+        data = scipy.sparse.csc_matrix(
+            tuple(numpy.load(os.path.join(matrix_dir, name + ".npy"), mmap_mode="r")
+                  for name in SPARSE_ARRAYS),
+            shape=shape, copy=False)
+    return converters.Matrix(data, row_names, col_names)
+
+def _write_output(matrix_dir, output_config, matrix_path, scratch_dir):
+    """Convert a saved matrix to one output format and move the result to
+    matrix_path, plus the extension the converter gave it.
+
+    Converters write into scratch_dir, which is on the same filesystem as
+    matrix_path, so the move is a rename and a matrix is either all there or
+    not there at all.
+    """
+    # The converters make their temporary files with tempfile
+    tempfile.tempdir = scratch_dir
+
+    matrix = _load_matrix(matrix_dir)
+    convertto_method = getattr(converters, "convert_to_" + output_config["format"])
+
+    # The convertto_method returns a path to a matrix file or
+    # directory, we'll want to move that to the data_path
+    tmp_matrix_path = convertto_method(matrix, **output_config.get("args", {}))
+    matrix_path += os.path.splitext(tmp_matrix_path)[1]
+
+    pathlib.Path(os.path.dirname(matrix_path)).mkdir(parents=True, exist_ok=True)
+    os.rename(tmp_matrix_path, matrix_path)
+    # Each converter gets a temporary directory of its own
+    os.rmdir(os.path.dirname(tmp_matrix_path))
+    return matrix_path
+
+def convert_source(source, source_config, source_path, outputs, data_path, executor,
+                   scratch_dir, max_pending_matrices):
+    """Convert the matrices in a source file to all of the output formats.
+
+    Each matrix is saved once to scratch_dir, and the writes of all of the
+    outputs of up to max_pending_matrices matrices run in executor at once.
+    """
+    # Get the method to convert this file to matrices
+    convertfrom_method = getattr(converters, "convert_from_" + source_config["type"])
+
+    # Matrices whose outputs are being written, with their futures
+    pending = collections.deque()
+
+    def finish_matrix():
+        matrix_dir, futures = pending.popleft()
+        for future in futures:
+            future.result()
+        shutil.rmtree(matrix_dir)
+
+    # Iterate over converted matrices
+    df_counter = 0
+    for matrix in convertfrom_method(source_path, **source_config.get("args", {})):
+        matrix_dir = os.path.join(scratch_dir, "inputs", source, str(df_counter))
+        _save_matrix(matrix, matrix_dir)
+        del matrix
+
+        # Iterate over expected output formats
+        futures = []
+        for output in outputs:
+            matrix_path = os.path.join(
+                data_path,
+                "matrices",
+                output,
+                source,
+                str(df_counter) if source_config["multiple_matrices"] else "",
+                "{}_{}".format(output, source)
+            )
+            futures.append(executor.submit(
+                _write_output, matrix_dir, outputs[output], matrix_path, scratch_dir))
+        pending.append((matrix_dir, futures))
+
+        # Don't let the saved matrices pile up if writing falls behind
+        if len(pending) >= max_pending_matrices:
+            finish_matrix()
+        df_counter += 1
+
+    while pending:
+        finish_matrix()
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--data-yaml", help="YAML file describing data inputs and outputs.",
                         required=True)
     parser.add_argument("--data-path", help="Path to put files.", required=True)
+    parser.add_argument("--workers", type=int, default=_available_cpus(),
+                        help=("Number of processes writing outputs. Defaults to the number "
+                              "of CPUs it may run on."))
     args = parser.parse_args()
 
-    data_dict = yaml.load(open(args.data_yaml))
+    with open(args.data_yaml) as data_yaml:
+        data_dict = yaml.safe_load(data_yaml)
 
     sources = data_dict["sources"]
     outputs = data_dict["outputs"]
 
-    for source in sources:
-
-        # Get the remote file and put it in data/sources/<name>
-        url = sources[source]["url"]
-
-        source_path = os.path.join(
-            args.data_path,
-            "sources",
-            source,
-            os.path.basename(url)
-        )
-
-        pathlib.Path(os.path.dirname(source_path)).mkdir(parents=True)
-        urllib.request.urlretrieve(url, filename=source_path)
+    # Keep temporary files on the same filesystem as the matrices, so they can
+    # be renamed into place
+    scratch_dir = tempfile.mkdtemp(prefix=".convert_", dir=args.data_path)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+            for source in sources:
 
-        # Get the method to convert this file to dataframes
-        convertfrom_method = getattr(converters, "convert_from_" + sources[source]["type"])
+                # Get the remote file and put it in data/sources/<name>
+                url = sources[source]["url"]
 
-        # Iterate over converted dataframes
-        df_counter = 0
-        for dataframe in convertfrom_method(source_path, **sources[source].get("args", {})):
-
-            # Iterate over expected output formats
-            for output in outputs:
-                convertto_method = getattr(converters, "convert_to_" + outputs[output]["format"])
-
-                # The convertto_method returns a path to a matrix file or
-                # directory, we'll want to move that to the data_path
-                tmp_matrix_path = convertto_method(
-                    dataframe,
-                    **outputs[output].get("args", {}))
-                ext = os.path.splitext(tmp_matrix_path)[1]
-
-                matrix_path = os.path.join(
+                source_path = os.path.join(
                     args.data_path,
-                    "matrices",
-                    output,
+                    "sources",
                     source,
-                    str(df_counter) if sources[source]["multiple_matrices"] else "",
-                    "{}_{}{}".format(output, source, ext)
+                    os.path.basename(url)
                 )
 
-                pathlib.Path(os.path.dirname(matrix_path)).mkdir(parents=True)
-                shutil.move(tmp_matrix_path, matrix_path)
-            df_counter += 1
+                pathlib.Path(os.path.dirname(source_path)).mkdir(parents=True)
+                urllib.request.urlretrieve(url, filename=source_path)
+
+                convert_source(source, sources[source], source_path, outputs, args.data_path,
+                               executor, scratch_dir, args.workers)
+    finally:
+        shutil.rmtree(scratch_dir)
 
 if __name__ == "__main__":
     main()
@@ -1,3 +1,5 @@
+import collections
+import gzip
 import tempfile
 import os
 
@@ -7,16 +9,75 @@ import h5sparse
 import loompy
 import numpy
 import pandas
+import pyarrow
+import pyarrow.parquet
 import scanpy.api as sc
 import scipy.io
 import scipy.sparse
 import zarr
 
+# An expression matrix, genes x cells. data is a dense numpy array or a
+# scipy.sparse matrix, and row_names and col_names are arrays of the gene and
+# cell names.
+Matrix = collections.namedtuple("Matrix", ["data", "row_names", "col_names"])
+
+# Roughly how many bytes of dense values to convert from a sparse matrix at a
+# time
+BLOCK_BYTES = 256 * 2**20
+
+def _from_dataframe(df):
+    return Matrix(df.values, df.index.values, df.columns.values)
+
+def _to_dataframe(matrix):
+    """Make a dense dataframe of a matrix, for formats that can only be
+    written from one.
+    """
+    data = matrix.data
+    if scipy.sparse.issparse(data):
+        data = data.toarray()
+    return pandas.DataFrame(data, matrix.row_names, matrix.col_names)
+
+def _column_blocks(matrix, multiple=1):
+    """Yield the start and end columns of blocks of a matrix's columns, and
+    their dense values.
+
+    Blocks are a multiple of multiple columns wide, like a chunk width, and
+    about BLOCK_BYTES each, so only one block of a sparse matrix is dense at a
+    time.
+    """
+    data = matrix.data
+    if scipy.sparse.issparse(data):
+        data = data.tocsc()
+    num_rows, num_cols = data.shape
+    width = BLOCK_BYTES // max(num_rows * data.dtype.itemsize, 1)
+    width = max(width // multiple, 1) * multiple
+    for start in range(0, num_cols, width):
+        end = min(start + width, num_cols)
+        block = data[:, start:end]
+        if scipy.sparse.issparse(block):
+            block = block.toarray()
+        yield start, end, block
+
+def _row_blocks(matrix):
+    """Like _column_blocks, but blocks of rows."""
+    data = matrix.data
+    if scipy.sparse.issparse(data):
+        data = data.tocsr()
+    num_rows, num_cols = data.shape
+    height = max(BLOCK_BYTES // max(num_cols * data.dtype.itemsize, 1), 1)
+    for start in range(0, num_rows, height):
+        end = min(start + height, num_rows)
+        block = data[start:end]
+        if scipy.sparse.issparse(block):
+            block = block.toarray()
+        yield start, end, block
+
 def convert_from_10xh5(path, genome):
     adata = sc.read_10x_h5(path, genome)
     adata.var_names_make_unique()
-    df = pandas.DataFrame(adata.X.todense().T, adata.var_names, adata.obs_names)
-    yield df
+    # X is cells x genes in CSR, so its transpose is genes x cells in CSC,
+    # without making it dense
+    yield Matrix(adata.X.T, adata.var_names.values, adata.obs_names.values)
 
 def convert_from_geocsv(path, split=False, num_to_keep=100):
     data = pandas.read_csv(
@@ -28,9 +89,9 @@ def convert_from_geocsv(path, split=False, num_to_keep=100):
     if split:
         cell_names = data.columns.tolist()
         for cell_name in cell_names[:num_to_keep]:
-            yield data[cell_name].to_frame()
+            yield _from_dataframe(data[cell_name].to_frame())
     else:
-        yield data
+        yield _from_dataframe(data)
 
 
 def _get_temp_path(suffix=None):
@@ -41,16 +102,21 @@ def _get_temp_path(suffix=None):
 
     return temp_path
 
-def convert_to_hdf5(df, chunks, compression):
-    """Convert a dataframe of expression values to an hdf5 file."""
+def convert_to_hdf5(matrix, chunks, compression):
+    """Convert an expression matrix to an hdf5 file."""
     path = _get_temp_path(".h5")
     f = h5py.File(path, 'w', libver='latest')
 
-    adj_chunks = (min(df.shape[0], chunks[0]), min(df.shape[1], chunks[1]))
-    f.create_dataset("data", data=df.as_matrix(), chunks=adj_chunks, compression=compression)
+    shape = matrix.data.shape
+    adj_chunks = (min(shape[0], chunks[0]), min(shape[1], chunks[1]))
+    dset = f.create_dataset("data", shape=shape, dtype=matrix.data.dtype, chunks=adj_chunks,
+                            compression=compression)
+    # Write whole chunk columns, so no chunk is compressed twice
+    for start, end, block in _column_blocks(matrix, adj_chunks[1]):
+        dset[:, start:end] = block
     dt = h5py.special_dtype(vlen=bytes)
-    f.create_dataset("gene_names", data=df.index.values, dtype=dt)
-    f.create_dataset("cell_names", data=df.columns.values, dtype=dt)
+    f.create_dataset("gene_names", data=matrix.row_names, dtype=dt)
+    f.create_dataset("cell_names", data=matrix.col_names, dtype=dt)
 
     f.attrs["hdf5_version"] = h5py.version.hdf5_version
     f.attrs["h5py_version"] = h5py.version.version
@@ -59,12 +125,12 @@ def convert_to_hdf5(df, chunks, compression):
 
     return path
 
-def convert_to_sparse_hdf5(df, major="csc"):
-    """Convert a dataframe to a sparse represenation in an hdf5 file."""
+def convert_to_sparse_hdf5(matrix, major="csc"):
+    """Convert an expression matrix to a sparse represenation in an hdf5 file."""
 
     path = _get_temp_path(".h5")
     matrix_class = getattr(scipy.sparse, major + "_matrix")
-    sparse_matrix = matrix_class(df.as_matrix())
+    sparse_matrix = matrix_class(matrix.data)
     f = h5sparse.File(path, 'w', libver='latest')
     f.create_dataset("data", data=sparse_matrix)
 
@@ -75,69 +141,118 @@ def convert_to_sparse_hdf5(df, major="csc"):
 
     return path
 
-def convert_to_loom(df):
-    """Convert a dataframe of expression values to a loom file."""
+def convert_to_loom(matrix):
+    """Convert an expression matrix to a loom file."""
 
     path = _get_temp_path(".loom")
-    loompy.create(path, df.as_matrix(),
-                  {"gene_names": df.index.values}, {"cell_names": df.columns.values})
+    # loompy writes sparse matrices a few columns at a time
+    loompy.create(path, matrix.data,
+                  {"gene_names": matrix.row_names}, {"cell_names": matrix.col_names})
     return path
 
-def convert_to_parquet(df):
-    """Convert a dataframe of expression values to a parquet file."""
+def convert_to_parquet(matrix):
+    """Convert an expression matrix to a parquet file, a row group per block
+    of genes.
+    """
 
     path = _get_temp_path(".parquet")
-    df.to_parquet(path, "pyarrow")
+    writer = None
+    try:
+        for start, end, block in _row_blocks(matrix):
+            df = pandas.DataFrame(block, matrix.row_names[start:end], matrix.col_names)
+            table = pyarrow.Table.from_pandas(df)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
 
     return path
 
-def convert_to_feather(df):
-    """Convert a dataframe of expression values to a feather file."""
+def convert_to_feather(matrix):
+    """Convert an expression matrix to a feather file, a record batch per
+    block of genes.
+
+    The file is a Feather V2 file, which is an Arrow IPC file, with the gene
+    names in an "index" column like reset_index makes. It is uncompressed, so
+    readers can memory-map its columns without copying them.
+    """
 
     path = _get_temp_path(".feather")
-    df.reset_index().to_feather(path)
+    schema = None
+    writer = None
+    # pyarrow 0.9 only writes Feather V1 files, which can't be written a
+    # block at a time, but its IPC file writer writes the same format as
+    # Feather V2
+    with pyarrow.OSFile(path, "wb") as sink:
+        try:
+            for start, end, block in _row_blocks(matrix):
+                df = pandas.DataFrame(block, matrix.row_names[start:end], matrix.col_names)
+                batch = pyarrow.RecordBatch.from_pandas(
+                    df.reset_index(), schema=schema, preserve_index=False)
+                if writer is None:
+                    schema = batch.schema
+                    writer = pyarrow.RecordBatchFileWriter(sink, schema)
+                writer.write_batch(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+
     return path
 
-def convert_to_anndata(df):
-    """Convert a dataframe of expression values to a scanpy anndata file."""
+def convert_to_anndata(matrix):
+    """Convert an expression matrix to a scanpy anndata file."""
 
+    # AnnData is cells x genes, so a CSC matrix becomes CSR
     adata = anndata.AnnData(
-        df.as_matrix().T,
-        {"cell_names": df.columns.values},
-        {"gene_names": df.index.values}
+        matrix.data.T,
+        {"cell_names": matrix.col_names},
+        {"gene_names": matrix.row_names}
     )
 
     path = _get_temp_path(".h5ad")
     adata.write(path)
     return path
 
-def convert_to_npy(df):
-    """Convert a dataframe of expression values to a binary numpy file."""
+def convert_to_npy(matrix):
+    """Convert an expression matrix to a binary numpy file."""
 
     path = _get_temp_path(".npy")
-    numpy.save(path, df.as_matrix())
+    array = numpy.lib.format.open_memmap(
+        path, mode="w+", dtype=matrix.data.dtype, shape=matrix.data.shape)
+    for start, end, block in _column_blocks(matrix):
+        array[:, start:end] = block
+    array.flush()
+    del array
     return path
 
 
-def convert_to_zarr(df, store_type, chunks):
+def convert_to_zarr(matrix, store_type, chunks):
     """Anything is possible with ZARR"""
 
     path = _get_temp_path(".zarr")
-    adj_chunks = (min(df.shape[0], chunks[0]), min(df.shape[1], chunks[1]))
+    shape = matrix.data.shape
+    adj_chunks = (min(shape[0], chunks[0]), min(shape[1], chunks[1]))
     store = getattr(zarr, store_type)(path)
-    zarr.array(df.as_matrix(), store=store, chunks=adj_chunks, dtype='f4')
+    array = zarr.create(shape, chunks=adj_chunks, dtype='f4', store=store)
+    for start, end, block in _column_blocks(matrix, adj_chunks[1]):
+        array[:, start:end] = block
 
     return path
 
-def convert_to_csv(df):
+def convert_to_csv(matrix):
 
     path = _get_temp_path(".csv.gz")
-    df.to_csv(path, compression="gzip")
+    with gzip.open(path, "wt") as csv_file:
+        for start, end, block in _row_blocks(matrix):
+            df = pandas.DataFrame(block, matrix.row_names[start:end], matrix.col_names)
+            df.to_csv(csv_file, header=(start == 0))
     return path
 
-def convert_to_mtx(df):
+def convert_to_mtx(matrix):
 
     path = _get_temp_path(".mtx")
-    sparse_mat = scipy.sparse.coo_matrix(df.values)
+    sparse_mat = scipy.sparse.coo_matrix(matrix.data)
     scipy.io.mmwrite(path, sparse_mat)
     return path
@@ -31,7 +31,8 @@ def main():
     )
     args = parser.parse_args()
 
-    source_data = yaml.load(open(args.source_yaml))
+    with open(args.source_yaml) as source_yaml:
+        source_data = yaml.safe_load(source_yaml)
     sources = source_data["sources"].keys()
     outputs = source_data["outputs"].keys()
 
@@ -0,0 +1,143 @@
+"""Compute the statistics the verify commands check without loading whole
+matrices.
+
+The verify commands check the shape, number of nonzero entries and sum of a
+test's output matrix. The functions here compute those a block at a time, with
+the blocks reduced on a thread pool, so memory use is bounded by the block size
+and the number of blocks in flight rather than the size of the matrix.
+"""
+import collections
+import concurrent.futures
+import itertools
+
+import numpy
+import yaml
+
+import parallel_read
+
+
+def array_stats(array):
+    """Return the number of nonzero entries and the sum of an array.
+
+    Integer arrays are summed as int64 and everything else as float64, so the
+    totals of many blocks add up exactly for count data.
+    """
+    array = numpy.asarray(array)
+    if array.dtype.kind in "biu":
+        total = int(array.sum(dtype=numpy.int64))
+    else:
+        total = float(array.sum(dtype=numpy.float64))
+    return int(numpy.count_nonzero(array)), total
+
+
+def reduce_blocks(block_stats, blocks, workers=None, use_processes=False):
+    """Add up the (nonzero count, sum) pairs block_stats returns for each block.
+
+    Args:
+      block_stats: function that takes an element of blocks and returns the
+        nonzero count and sum of that part of the matrix
+      blocks: iterable of descriptions of the blocks, like the slices
+        block_slices returns. At most twice the number of workers of them are
+        being reduced at a time.
+      workers: size of the pool. Defaults to parallel_read.available_cpus().
+      use_processes: use a process pool instead of a thread pool, for
+        block_stats functions that hold the GIL. block_stats has to be picklable.
+
+    Returns:
+      tuple of nonzero count and sum
+    """
+    workers = workers or parallel_read.available_cpus()
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    non_zero_count = 0
+    total = 0
+
+    def add(future):
+        nonlocal non_zero_count, total
+        block_non_zero_count, block_total = future.result()
+        non_zero_count += block_non_zero_count
+        total += block_total
+
+    # Keep a bounded number of blocks in flight, so that blocks that are read
+    # faster than they are reduced don't pile up in memory
+    with executor:
+        pending = collections.deque()
+        for block in blocks:
+            pending.append(executor.submit(block_stats, block))
+            if len(pending) >= 2 * workers:
+                add(pending.popleft())
+        while pending:
+            add(pending.popleft())
+    return non_zero_count, total
+
+
+def block_slices(shape, itemsize, chunks=None, block_bytes=64 * 2**20):
+    """Split an array into blocks of about block_bytes, tiling every axis.
+
+    Blocks grow along the last axis first, so a block of a matrix is whole rows
+    unless a row, or a row of chunks, is bigger than block_bytes.
+
+    Args:
+      shape: shape of the array
+      itemsize: size of an element in bytes
+      chunks: chunk shape of the array, if it's chunked. Blocks are then whole
+        multiples of it on every axis, so every chunk is decoded by only one
+        block.
+      block_bytes: size to aim for. A block is never smaller than one chunk.
+
+    Returns:
+      iterator of tuples of slices, one per axis, that index the blocks
+    """
+    unit = tuple(chunks) if chunks else (1,) * len(shape)
+    block_shape = [max(1, min(size, unit_size)) for size, unit_size in zip(shape, unit)]
+    for axis in reversed(range(len(shape))):
+        other_bytes = itemsize
+        for other_axis, size in enumerate(block_shape):
+            if other_axis != axis:
+                other_bytes *= size
+        num_units = max(1, block_bytes // max(1, other_bytes * unit[axis]))
+        block_shape[axis] = max(1, min(shape[axis], num_units * unit[axis]))
+
+    starts = [range(0, size, block_size) for size, block_size in zip(shape, block_shape)]
+    for block_starts in itertools.product(*starts):
+        yield tuple(slice(start, min(start + block_size, size))
+                    for start, block_size, size in zip(block_starts, block_shape, shape))
+
+
+def dense_stats(matrix, chunks=None, workers=None):
+    """Return the nonzero count and sum of a 2D array-like that supports
+    slicing, like a memory-mapped numpy array, a zarr array or an h5py dataset.
+    """
+    def block_stats(block):
+        return array_stats(matrix[block])
+
+    blocks = block_slices(matrix.shape, matrix.dtype.itemsize, chunks)
+    return reduce_blocks(block_stats, blocks, workers)
+
+
+def sparse_data_stats(data, workers=None):
+    """Return the nonzero count and sum of a sparse matrix given the 1D array-like
+    holding its stored values, for example the data dataset of a CSC matrix in
+    an hdf5 file.
+
+    Explicitly stored zeros are not counted.
+    """
+    def block_stats(block):
+        return array_stats(data[block])
+
+    blocks = block_slices(data.shape, data.dtype.itemsize, getattr(data, "chunks", None))
+    return reduce_blocks(block_stats, blocks, workers)
+
+
+def check_expected(test_yaml_path, non_zero_count, total, shape):
+    """Assert that the statistics of an output match the test's expected_output."""
+
+    with open(test_yaml_path) as test_yaml:
+        expected_values = yaml.safe_load(test_yaml)['expected_output']
+
+    assert non_zero_count == expected_values["non_zero_count"]
+    assert total == expected_values["sum"]
+    assert tuple(shape) == tuple(expected_values["shape"])
@@ -0,0 +1,152 @@
+"""Read many small matrix files concurrently.
+
+The merge tasks open thousands of small files, and opening them one after
+another means the per-file open latency dominates. read_parallel runs a
+format-specific loader over the paths on a bounded pool, hints the kernel to
+start reading files before the loader gets to them, and returns the results in
+the original order. iter_parallel does the same but hands the results over as
+they're ready, so they don't all have to be in memory at once.
+
+h5py holds a lock around every call into HDF5, so loaders that read with h5py
+only overlap their reads on a process pool.
+"""
+import collections
+import concurrent.futures
+import os
+
+import task_timing
+
+
+def available_cpus():
+    """Return the number of CPUs this process may run on.
+
+    os.cpu_count counts every CPU of the host, even when the container is
+    pinned to a few of them with --cpuset-cpus.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def readahead(path):
+    """Hint to the kernel that the file or directory at path will be read soon,
+    front to back.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    if os.path.isdir(path):
+        file_paths = [os.path.join(dirpath, filename)
+                      for dirpath, _, filenames in os.walk(path)
+                      for filename in filenames]
+    else:
+        file_paths = [path]
+
+    for file_path in file_paths:
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+class _CountingLoader(object):
+    """Call a loader and return its result with how many bytes it read from a
+    local path.
+
+    The count is taken in the thread or process that runs the loader, so it
+    can be added up in the one that started the pool. Remote inputs count the
+    bytes they fetch themselves.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __call__(self, path):
+        if "://" in path:
+            return self.loader(path), 0
+        start = task_timing.thread_bytes_read()
+        result = self.loader(path)
+        if start is None:
+            return result, 0
+        return result, task_timing.thread_bytes_read() - start
+
+
+def _counted(result_and_bytes_read):
+    result, bytes_read = result_and_bytes_read
+    task_timing.count("bytes_read", bytes_read)
+    return result
+
+
+def read_parallel(loader, paths, workers=None, use_processes=False, readahead_depth=None):
+    """Call loader on every path and return the results in the order of paths.
+
+    Takes the same arguments as iter_parallel.
+
+    Returns:
+      list of loader results, one per path
+    """
+    return list(iter_parallel(loader, paths, workers, use_processes, readahead_depth))
+
+
+def iter_parallel(loader, paths, workers=None, use_processes=False, readahead_depth=None):
+    """Call loader on every path and yield the results in the order of paths.
+
+    Args:
+      loader: function that takes a path and returns whatever was read from it.
+        It has to be picklable, so a module-level function, if use_processes is
+        set.
+      paths: paths to read
+      workers: size of the pool. Defaults to available_cpus(). With one worker the
+        paths are read in this thread, one after another.
+      use_processes: use a process pool instead of a thread pool, for loaders
+        that hold the GIL, or h5py's lock, while reading.
+      readahead_depth: how many files past the ones being loaded to issue
+        readahead hints for. Defaults to twice the number of workers.
+
+    Yields:
+      loader results, one per path. At most twice the number of workers paths
+      are loaded ahead of the result being consumed. Each path is counted as a
+      file opened, and what the loader read from the local ones, including in
+      process pool workers, as bytes read.
+    """
+
+    task_timing.count("files_opened", len(paths))
+    loader = _CountingLoader(loader)
+
+    workers = workers or available_cpus()
+    readahead_depth = 2 * workers if readahead_depth is None else readahead_depth
+    hinted = 0
+
+    def hint_up_to(end):
+        nonlocal hinted
+        while hinted < min(end, len(paths)):
+            readahead(paths[hinted])
+            hinted += 1
+
+    if workers == 1:
+        for idx, path in enumerate(paths):
+            hint_up_to(idx + 1 + readahead_depth)
+            yield _counted(loader(path))
+        return
+
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    # Keep a bounded number of loads in flight, so that the readahead hints
+    # stay just ahead of the files being loaded
+    with executor:
+        pending = collections.deque()
+        for idx, path in enumerate(paths):
+            hint_up_to(idx + 1 + readahead_depth)
+            pending.append(executor.submit(loader, path))
+            if len(pending) >= 2 * workers:
+                yield _counted(pending.popleft().result())
+        while pending:
+            yield _counted(pending.popleft().result())
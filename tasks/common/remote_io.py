@@ -0,0 +1,297 @@
+"""Read task inputs over HTTP with range requests.
+
+When the benchmarker runs a test with remote inputs, the input paths are URLs
+of an object server instead of local paths. open_input returns a seekable,
+read-only file object for either, so the libraries that accept file objects
+(h5py, pyarrow, numpy) can read only the parts of a remote file they need.
+
+Remote files are read a block at a time and the blocks are kept in a small LRU
+cache. Once reads become sequential, the next few blocks are fetched in the
+background. The block size, cache size and prefetch depth come from the
+REMOTE_BLOCK_SIZE, REMOTE_CACHE_BLOCKS and REMOTE_PREFETCH_BLOCKS environment
+variables, which the benchmarker sets.
+"""
+import collections
+import collections.abc
+import concurrent.futures
+import http.client
+import io
+import os
+import threading
+import urllib.parse
+
+import task_timing
+
+
+DEFAULT_BLOCK_SIZE = 2**20
+DEFAULT_CACHE_BLOCKS = 32
+DEFAULT_PREFETCH_BLOCKS = 4
+# Seconds to wait for a prefetched block before fetching it again
+PREFETCH_TIMEOUT = 60
+
+# Connections and the prefetch threads belong to the process that made them.
+# Process pool workers forked from it get copies whose sockets are shared with
+# the parent and whose threads don't exist, so both are keyed by pid.
+# os.register_at_fork would be neater, but the task images run Python 3.6.
+_local = threading.local()
+_prefetch_executors = {}
+_prefetch_executor_lock = threading.Lock()
+
+
+def is_remote(path):
+    return path.startswith("http://") or path.startswith("https://")
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _get_prefetch_executor():
+    pid = os.getpid()
+    with _prefetch_executor_lock:
+        if pid not in _prefetch_executors:
+            _prefetch_executors.clear()
+            _prefetch_executors[pid] = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+        return _prefetch_executors[pid]
+
+
+def _connections():
+    """This thread's connections, keyed by scheme and host, for this process."""
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        # Don't close the parent's sockets, it's still using them
+        _local.connections = {}
+        _local.pid = pid
+    return _local.connections
+
+
+def _request(url, method="GET", headers=None):
+    """Make a request on this thread's persistent connection to the url's host.
+
+    Returns:
+      tuple of the response and its body
+    """
+    parsed_url = urllib.parse.urlsplit(url)
+    connections = _connections()
+    key = (parsed_url.scheme, parsed_url.netloc)
+    path = parsed_url.path + ("?" + parsed_url.query if parsed_url.query else "")
+
+    for attempt in range(2):
+        connection = connections.get(key)
+        if connection is None:
+            if parsed_url.scheme == "https":
+                connection = http.client.HTTPSConnection(parsed_url.netloc)
+            else:
+                connection = http.client.HTTPConnection(parsed_url.netloc)
+            connections[key] = connection
+        try:
+            connection.request(method, path, headers=headers or {})
+            response = connection.getresponse()
+            body = response.read()
+            task_timing.count("remote_requests")
+            task_timing.count("bytes_read", len(body))
+            return response, body
+        except (http.client.HTTPException, OSError):
+            # The server may have closed an idle connection, so reconnect once
+            connection.close()
+            del connections[key]
+            if attempt:
+                raise
+
+
+def _check_status(response, url):
+    if response.status == 404:
+        raise FileNotFoundError(url)
+    if response.status >= 400:
+        raise IOError("{} {} for {}".format(response.status, response.reason, url))
+
+
+class HTTPFile(io.RawIOBase):
+    """A read-only, seekable file object for a URL, read with range requests.
+
+    Args:
+      url: URL of the file. The server has to support HEAD and range requests.
+      block_size: bytes per range request
+      cache_blocks: how many blocks to keep
+      prefetch_blocks: how many blocks to read ahead once reads are sequential
+    """
+
+    def __init__(self, url, block_size=None, cache_blocks=None, prefetch_blocks=None):
+        super().__init__()
+        self.url = url
+        self.block_size = block_size or _env_int("REMOTE_BLOCK_SIZE", DEFAULT_BLOCK_SIZE)
+        self.cache_blocks = cache_blocks or _env_int("REMOTE_CACHE_BLOCKS", DEFAULT_CACHE_BLOCKS)
+        if prefetch_blocks is None:
+            prefetch_blocks = _env_int("REMOTE_PREFETCH_BLOCKS", DEFAULT_PREFETCH_BLOCKS)
+        self.prefetch_blocks = prefetch_blocks
+
+        response, _ = _request(url, "HEAD")
+        _check_status(response, url)
+        self.size = int(response.getheader("Content-Length"))
+
+        self._blocks = collections.OrderedDict()
+        self._pid = os.getpid()
+        self._position = 0
+        self._last_block = None
+        self._lock = threading.RLock()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence {}".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {}".format(position))
+        self._position = position
+        return position
+
+    def _fetch_range(self, start, end):
+        """Read bytes [start, end) of the file with one request."""
+        response, body = _request(self.url, headers={"Range": "bytes={}-{}".format(start, end - 1)})
+        _check_status(response, self.url)
+        if response.status == 200:
+            # The server ignored the range and sent the whole file
+            body = body[start:end]
+        return body
+
+    def _fetch_blocks(self, first_block, last_block):
+        """Read blocks first_block to last_block, inclusive, with one request."""
+        start = first_block * self.block_size
+        end = min((last_block + 1) * self.block_size, self.size)
+        data = self._fetch_range(start, end)
+        return [data[(block - first_block) * self.block_size:
+                     (block - first_block + 1) * self.block_size]
+                for block in range(first_block, last_block + 1)]
+
+    def _store_block(self, block, data):
+        self._blocks[block] = data
+        self._blocks.move_to_end(block)
+        while len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+
+    def _prefetch(self, after_block):
+        last_block = (self.size - 1) // self.block_size
+        for block in range(after_block + 1, min(after_block + self.prefetch_blocks, last_block) + 1):
+            if block not in self._blocks:
+                self._store_block(block, _get_prefetch_executor().submit(
+                    self._fetch_range, block * self.block_size,
+                    min((block + 1) * self.block_size, self.size)))
+
+    def _get_blocks(self, first_block, last_block):
+        """Return the data of blocks first_block to last_block, inclusive,
+        fetching each run of missing blocks with a single request.
+        """
+        if self._pid != os.getpid():
+            # Forked with blocks being prefetched by threads this process
+            # doesn't have, so they'll never arrive
+            for cached_block, cached in list(self._blocks.items()):
+                if isinstance(cached, concurrent.futures.Future):
+                    del self._blocks[cached_block]
+            self._pid = os.getpid()
+
+        blocks = []
+        block = first_block
+        while block <= last_block:
+            cached = self._blocks.get(block)
+            if isinstance(cached, concurrent.futures.Future):
+                try:
+                    cached = cached.result(timeout=PREFETCH_TIMEOUT)
+                except (concurrent.futures.TimeoutError, http.client.HTTPException, OSError):
+                    # Fetch it again below
+                    del self._blocks[block]
+                    cached = None
+            if cached is not None:
+                self._store_block(block, cached)
+                blocks.append(cached)
+                block += 1
+                continue
+            run_end = block
+            while run_end < last_block and (run_end + 1) not in self._blocks:
+                run_end += 1
+            for fetched_block, data in zip(range(block, run_end + 1),
+                                           self._fetch_blocks(block, run_end)):
+                self._store_block(fetched_block, data)
+                blocks.append(data)
+            block = run_end + 1
+
+        if self.prefetch_blocks and self._last_block is not None and \
+                self._last_block <= first_block <= self._last_block + 1:
+            self._prefetch(last_block)
+        self._last_block = last_block
+        return blocks
+
+    def readinto(self, buffer):
+        with self._lock:
+            view = memoryview(buffer).cast("B")
+            num_bytes = min(len(view), self.size - self._position)
+            if num_bytes <= 0:
+                return 0
+            start, end = self._position, self._position + num_bytes
+            first_block = start // self.block_size
+            last_block = (end - 1) // self.block_size
+
+            written = 0
+            for block, data in zip(range(first_block, last_block + 1),
+                                   self._get_blocks(first_block, last_block)):
+                block_start = block * self.block_size
+                chunk = data[max(start, block_start) - block_start:end - block_start]
+                view[written:written + len(chunk)] = chunk
+                written += len(chunk)
+            self._position = end
+            return written
+
+    def readall(self):
+        buffer = bytearray(max(0, self.size - self._position))
+        num_bytes = self.readinto(buffer)
+        return bytes(buffer[:num_bytes])
+
+
+class HTTPStore(collections.abc.Mapping):
+    """A read-only zarr store for a directory store served over HTTP.
+
+    Every key is a single GET of the object under the store's URL. Stores
+    can't be listed, which zarr doesn't need for reading arrays.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def __getitem__(self, key):
+        url = "{}/{}".format(self.url, urllib.parse.quote(key))
+        response, body = _request(url)
+        if response.status == 404:
+            raise KeyError(key)
+        _check_status(response, url)
+        return body
+
+    def __contains__(self, key):
+        url = "{}/{}".format(self.url, urllib.parse.quote(key))
+        response, _ = _request(url, "HEAD")
+        return response.status != 404
+
+    def __iter__(self):
+        raise TypeError("HTTPStore can't be listed")
+
+    def __len__(self):
+        raise TypeError("HTTPStore can't be listed")
+
+
+def open_input(path):
+    """Open a local path or URL for reading in binary mode."""
+    if is_remote(path):
+        return HTTPFile(path)
+    return open(path, "rb")
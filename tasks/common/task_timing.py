@@ -0,0 +1,141 @@
+"""Time the phases of a task and count what it does.
+
+The benchmarker only sees how long a whole test command took. Task scripts
+break that down by wrapping their phases:
+
+    with task_timing.phase("read"):
+        arrays = parallel_read.read_parallel(load, paths)
+    task_timing.count("chunks_decoded", len(arrays))
+
+phase also works as a function decorator, including on functions that recurse
+or run in several threads at once. Phases nest, and a nested phase is named
+after its parents, like "merge/write". A phase that runs in several threads at
+once adds up the time spent in each of them.
+
+Nesting is tracked per thread, so a phase entered in a pool thread isn't
+nested under the phase that submitted the work: it's reported under its own
+name, from the top. Time the pool as a whole from the submitting thread, like
+the "copy_and_write" phase of the zarr merge does.
+
+If the TASK_TIMING_FILE environment variable is set, which the benchmarker
+does, the phase times and counters are written there as json when the
+process exits. Phases and counters in the workers of process pools aren't
+included, unless the workers return them, like parallel_read does with the
+bytes its loaders read.
+"""
+import atexit
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_phases = collections.OrderedDict()
+_counters = collections.OrderedDict()
+# (counter name, path) pairs whose sizes are added when the results are read
+_sizes = []
+
+
+class phase(contextlib.ContextDecorator):
+    """Time a block of code, or every call of a function, as a named phase.
+
+    As a decorator, one phase object is shared by every call of the function,
+    so the path and start time of each call are kept on the thread's stack of
+    open phases rather than on the object.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        path = stack[-1][0] + "/" + self.name if stack else self.name
+        stack.append((path, time.perf_counter()))
+        return self
+
+    def __exit__(self, *exc_info):
+        path, start = _local.stack.pop()
+        seconds = time.perf_counter() - start
+        with _lock:
+            stats = _phases.setdefault(path, {"seconds": 0.0, "calls": 0})
+            stats["seconds"] += seconds
+            stats["calls"] += 1
+        return False
+
+
+def count(name, amount=1):
+    """Add amount to the counter called name."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def count_size(name, path):
+    """Add the size of the file at path, or of all the files under it if it's
+    a directory, to the counter called name.
+
+    The size is only taken when the results are read, after the phases being
+    timed, so walking a directory of many chunk files doesn't add to them.
+    """
+    with _lock:
+        _sizes.append((name, path))
+
+
+def thread_bytes_read():
+    """Return how many bytes this thread has read with read calls, or None if
+    the kernel doesn't say.
+
+    Reads that the page cache serves are included, and pages of memory-mapped
+    files aren't.
+    """
+    try:
+        with open("/proc/thread-self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(dirpath, filename))
+                   for dirpath, _, filenames in os.walk(path)
+                   for filename in filenames)
+    return os.path.getsize(path)
+
+
+def results():
+    """Return the phase times and counters recorded so far."""
+    with _lock:
+        while _sizes:
+            name, path = _sizes.pop(0)
+            _counters[name] = _counters.get(name, 0) + _path_size(path)
+        return {
+            "phases": {name: dict(stats) for name, stats in _phases.items()},
+            "counters": dict(_counters),
+        }
+
+
+def dump(path):
+    """Write the phase times and counters to path as json."""
+    with open(path, "w") as f:
+        json.dump(results(), f)
+
+
+def _dump_at_exit():
+    path = os.environ.get("TASK_TIMING_FILE")
+    # Only the process that started the task writes the file, not the
+    # children it forks
+    if path and os.getpid() == _pid:
+        dump(path)
+
+
+_pid = os.getpid()
+atexit.register(_dump_at_exit)
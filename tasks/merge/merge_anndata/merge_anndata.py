@@ -1,25 +1,45 @@
 import argparse
-import numpy
-import yaml
 
+import h5py
 import scanpy.api as sc
 
-def merge_anndatas(anndata_paths, output_path):
+import matrix_stats
+import parallel_read
+import task_timing
 
-    first_adata = sc.read_h5ad(anndata_paths[0])
-    concat_adata = first_adata.concatenate(sc.read_h5ad(a) for a in anndata_paths[1:])
-    concat_adata.write(output_path)
+@task_timing.phase("merge")
+def merge_anndatas(anndata_paths, output_path, workers=None):
 
+    with task_timing.phase("read"):
+        # h5py only lets one thread read at a time
+        adatas = parallel_read.read_parallel(sc.read_h5ad, anndata_paths, workers,
+                                             use_processes=True)
+    with task_timing.phase("concatenate"):
+        concat_adata = adatas[0].concatenate(*adatas[1:])
+    with task_timing.phase("write"):
+        concat_adata.write(output_path)
+    task_timing.count_size("bytes_written", output_path)
 
-def verify_anndata(matrix_path, test_yaml_path):
 
-    expected_values = yaml.load(open(test_yaml_path))['expected_output']
+@task_timing.phase("verify")
+def verify_anndata(matrix_path, test_yaml_path):
 
-    output_matrix = sc.read_h5ad(matrix_path).X.T
+    # X is cells x genes, the expected shape is genes x cells
+    with h5py.File(matrix_path, "r") as adata_hfile:
+        X = adata_hfile["X"]
+        if isinstance(X, h5py.Group):
+            if "h5sparse_shape" in X.attrs:
+                shape = tuple(X.attrs["h5sparse_shape"])
+            else:
+                shape = tuple(X.attrs["shape"])
+            with task_timing.phase("stats"):
+                non_zero_count, total = matrix_stats.sparse_data_stats(X["data"])
+        else:
+            shape = X.shape
+            with task_timing.phase("stats"):
+                non_zero_count, total = matrix_stats.dense_stats(X, X.chunks)
 
-    assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+        matrix_stats.check_expected(test_yaml_path, non_zero_count, total, shape[::-1])
 
 def main():
 
@@ -40,6 +60,12 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        help=("Number of files to read concurrently. Defaults to the number of "
+              "CPUs the task may run on.")
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -54,7 +80,7 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_anndatas(args.input_paths, args.output_path)
+        merge_anndatas(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_anndata(args.output_matrix, args.test_yaml)
 
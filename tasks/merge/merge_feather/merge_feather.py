@@ -1,31 +1,82 @@
 import argparse
-import numpy
-import yaml
 
 import pandas
+import pyarrow
+import pyarrow.feather
 
-def merge_feathers(feather_paths, output_path):
+import matrix_stats
+import parallel_read
+import remote_io
+import task_timing
 
-    dfs_to_merge = []
-    print("Merging", feather_paths)
-    for feather_path in feather_paths:
-        dfs_to_merge.append(pandas.read_feather(feather_path).drop("index", 1))
-    print("Opened", len(dfs_to_merge), "dataframes")
-    print(dfs_to_merge[0])
-    print(dfs_to_merge[0].shape)
-    merged_df = pandas.concat(dfs_to_merge, axis=1)
-    print(merged_df.shape)
-    merged_df.to_feather(output_path)
+def _read_feather_df(feather_path):
+    return pandas.read_feather(feather_path).drop(columns="index")
 
+def _read_feather_table(feather_path):
+    if remote_io.is_remote(feather_path):
+        with remote_io.open_input(feather_path) as feather_file:
+            return pyarrow.feather.read_table(feather_file, memory_map=False)
+    return pyarrow.feather.read_table(feather_path, memory_map=True)
+
+@task_timing.phase("merge")
+def merge_feathers(feather_paths, output_path, workers=None):
+
+    with task_timing.phase("read"):
+        dfs_to_merge = parallel_read.read_parallel(_read_feather_df, feather_paths, workers)
+    with task_timing.phase("concatenate"):
+        merged_df = pandas.concat(dfs_to_merge, axis=1)
+    with task_timing.phase("write"):
+        merged_df.to_feather(output_path)
+    task_timing.count_size("bytes_written", output_path)
+
+@task_timing.phase("merge")
+def merge_feathers_mmap(feather_paths, output_path, workers=None):
+    """Merge feather files by reference to their memory-mapped columns.
+
+    Each file is memory-mapped and its value column is taken as it is, so for
+    uncompressed inputs, like the ones create_data writes, opening a file costs
+    little more than parsing its header. Compressed inputs, which is what
+    write_feather makes by default, are decompressed into memory instead. The
+    output table only references those columns and is written out once.
+    """
+
+    names = []
+    columns = []
+    num_rows = None
+    with task_timing.phase("read"):
+        tables = parallel_read.read_parallel(_read_feather_table, feather_paths, workers)
+    for feather_path, table in zip(feather_paths, tables):
+        if num_rows is None:
+            num_rows = table.num_rows
+        elif table.num_rows != num_rows:
+            raise ValueError("Can't merge {} with {} rows into a table with {} rows".format(
+                feather_path, table.num_rows, num_rows))
+        for name, column in zip(table.column_names, table.columns):
+            # The gene names, written by reset_index
+            if name == "index":
+                continue
+            names.append(name)
+            columns.append(column)
+
+    with task_timing.phase("concatenate"):
+        merged_table = pyarrow.Table.from_arrays(columns, names=names)
+    with task_timing.phase("write"):
+        pyarrow.feather.write_feather(merged_table, output_path)
+    task_timing.count_size("bytes_written", output_path)
+
+@task_timing.phase("verify")
 def verify_feathers(matrix_path, test_yaml_path):
 
-    expected_values = yaml.load(open(test_yaml_path))['expected_output']
+    output_table = pyarrow.feather.read_table(matrix_path, memory_map=True)
 
-    output_matrix = pandas.read_feather(matrix_path)
+    def column_stats(column):
+        return matrix_stats.array_stats(column.to_numpy())
 
-    assert numpy.count_nonzero(output_matrix.as_matrix()) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix.as_matrix()) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+    with task_timing.phase("stats"):
+        non_zero_count, total = matrix_stats.reduce_blocks(column_stats, output_table.columns)
+    task_timing.count("chunks_decoded", output_table.num_columns)
+    matrix_stats.check_expected(test_yaml_path, non_zero_count, total,
+                                (output_table.num_rows, output_table.num_columns))
 
 def main():
 
@@ -46,6 +97,19 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--engine",
+        choices=["mmap", "pandas"],
+        default="mmap",
+        help=("How to merge the matrices. mmap references the memory-mapped "
+              "input columns, pandas reads and concatenates dataframes.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        help=("Number of files to read concurrently. Defaults to the number of "
+              "CPUs the task may run on.")
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -60,7 +124,10 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_feathers(args.input_paths, args.output_path)
+        if args.engine == "mmap":
+            merge_feathers_mmap(args.input_paths, args.output_path, args.workers)
+        else:
+            merge_feathers(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_feathers(args.output_matrix, args.test_yaml)
 
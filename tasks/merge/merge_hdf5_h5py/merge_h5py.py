@@ -1,30 +1,200 @@
 import argparse
+import bisect
+import concurrent.futures
+import functools
+import os
+import tempfile
 import numpy
-import yaml
 
 import h5py
 
-def merge_hdf5s(hdf5_paths, output_path):
+import matrix_stats
+import parallel_read
+import remote_io
+import task_timing
 
-    arrays_to_merge = []
-    for hdf5_path in hdf5_paths:
-        arrays_to_merge.append(h5py.File(hdf5_path)["data"])
-    merged_array = numpy.concatenate(arrays_to_merge, axis=1)
-    with h5py.File(output_path, 'w') as output_hfile:
-        output_hfile.create_dataset(
-            name="data",
-            data=merged_array
-        )
+def _open_hdf5(hdf5_path):
+    """Open an input with h5py, through a file object if it's remote.
 
-def verify_hdf5(matrix_path, test_yaml_path):
+    h5py only accepts file objects from 2.9, so the image doesn't use the
+    distribution's package.
+    """
+    if remote_io.is_remote(hdf5_path):
+        return h5py.File(remote_io.open_input(hdf5_path), "r")
+    return h5py.File(hdf5_path, "r")
+
+def _read_dataset(hdf5_path):
+    with _open_hdf5(hdf5_path) as hfile:
+        return hfile["data"][()]
+
+@task_timing.phase("merge")
+def merge_hdf5s(hdf5_paths, output_path, workers=None):
+
+    with task_timing.phase("read"):
+        # h5py only lets one thread read at a time
+        arrays_to_merge = parallel_read.read_parallel(_read_dataset, hdf5_paths, workers,
+                                                      use_processes=True)
+    with task_timing.phase("concatenate"):
+        merged_array = numpy.concatenate(arrays_to_merge, axis=1)
+    with task_timing.phase("write"):
+        with h5py.File(output_path, 'w') as output_hfile:
+            output_hfile.create_dataset(
+                name="data",
+                data=merged_array
+            )
+    task_timing.count_size("bytes_written", output_path)
+
+def _read_layout(hdf5_path):
+    """Return the shape, dtype, chunking and compression of an input."""
+    with _open_hdf5(hdf5_path) as hfile:
+        dset = hfile["data"]
+        return dset.shape, dset.dtype, dset.chunks, dset.compression, dset.compression_opts
+
+def _read_into_band(band_path, band_shape, band_dtype, reads):
+    """Read slices of inputs straight into a band buffer shared through a
+    memory-mapped file.
+
+    reads is a list of (hdf5_path, input start column, input end column, band
+    start column) tuples.
+    """
+    band = numpy.memmap(band_path, dtype=band_dtype, mode="r+", shape=band_shape)
+    for hdf5_path, input_start, input_end, band_start in reads:
+        with _open_hdf5(hdf5_path) as hfile:
+            hfile["data"].read_direct(
+                band,
+                source_sel=numpy.s_[:, input_start:input_end],
+                dest_sel=numpy.s_[:, band_start:band_start + input_end - input_start])
+    band.flush()
+
+def _band_dir(output_path, band_bytes):
+    """Make a directory for the band buffers.
+
+    They go in /dev/shm if it has room for them, with some to spare. Docker
+    only gives containers 64 MB of it by default, so otherwise they go next
+    to the output, where the page cache holds them as long as there's memory.
+    """
+    if os.path.isdir("/dev/shm"):
+        shm_stats = os.statvfs("/dev/shm")
+        if shm_stats.f_bavail * shm_stats.f_frsize >= 2 * band_bytes:
+            return tempfile.mkdtemp(dir="/dev/shm")
+    return tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+
+def _parse_compression(compression):
+    """Turn a --compression value into h5py's compression and compression_opts."""
+    if compression is None or compression == "none":
+        return None, None
+    if compression.isdigit():
+        return "gzip", int(compression)
+    return compression, None
+
+@task_timing.phase("merge")
+def merge_hdf5s_chunked(hdf5_paths, output_path, chunks=None, compression=None,
+                        workers=None, files_per_task=64):
+    """Merge hdf5 files into a dataset created up front with its final shape,
+    chunking and compression.
+
+    The output is filled one band of chunk columns at a time. Reader processes
+    read_direct the inputs into a band buffer that lives in a shared
+    memory-mapped file, in /dev/shm if it's big enough, and once a band is
+    complete it is written with a single write that covers whole chunks, so
+    HDF5 never has to read back a partially written chunk. There are two band
+    buffers, so readers fill the next band while the current one is written.
+
+    If chunks or compression are not given, the output uses square chunks the
+    height of the input chunks and the input compression.
+    """
+
+    workers = workers or parallel_read.available_cpus()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        with task_timing.phase("read_layouts"):
+            layouts = parallel_read.read_parallel(
+                _read_layout, hdf5_paths, workers, use_processes=True)
+
+        num_rows = layouts[0][0][0]
+        for hdf5_path, layout in zip(hdf5_paths, layouts):
+            if len(layout[0]) != 2 or layout[0][0] != num_rows:
+                raise ValueError("Can't merge {} with shape {} into a matrix with {} rows".format(
+                    hdf5_path, layout[0], num_rows))
+        col_offsets = [0]
+        for layout in layouts:
+            col_offsets.append(col_offsets[-1] + layout[0][1])
+        num_cols = col_offsets[-1]
+        dtype = functools.reduce(numpy.promote_types, (layout[1] for layout in layouts))
 
-    expected_values = yaml.load(open(test_yaml_path))['expected_output']
+        _, _, input_chunks, input_compression, input_compression_opts = layouts[0]
+        if chunks is None:
+            chunk_side = input_chunks[0] if input_chunks else num_rows
+            chunks = (chunk_side, chunk_side)
+        chunks = (min(chunks[0], num_rows), min(chunks[1], num_cols))
+        if compression is None:
+            compression, compression_opts = input_compression, input_compression_opts
+        else:
+            compression, compression_opts = _parse_compression(compression)
 
-    output_matrix = h5py.File(matrix_path)["data"]
+        band_cols = chunks[1]
+        band_shape = (num_rows, band_cols)
+        band_dir = _band_dir(output_path, 2 * num_rows * band_cols * dtype.itemsize)
+        band_paths = [os.path.join(band_dir, "band_{}".format(i)) for i in range(2)]
+        bands = [numpy.memmap(p, dtype=dtype, mode="w+", shape=band_shape) for p in band_paths]
 
-    assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+        def submit_band_reads(band_idx):
+            """Start reading all the inputs overlapping a band of columns."""
+            start_col = band_idx * band_cols
+            end_col = min(start_col + band_cols, num_cols)
+            reads = []
+            for input_idx in range(bisect.bisect_right(col_offsets, start_col) - 1,
+                                   bisect.bisect_left(col_offsets, end_col)):
+                input_start = max(start_col, col_offsets[input_idx])
+                input_end = min(end_col, col_offsets[input_idx + 1])
+                reads.append((hdf5_paths[input_idx],
+                              input_start - col_offsets[input_idx],
+                              input_end - col_offsets[input_idx],
+                              input_start - start_col))
+            return [executor.submit(_read_into_band, band_paths[band_idx % 2], band_shape,
+                                    dtype, reads[i:i + files_per_task])
+                    for i in range(0, len(reads), files_per_task)]
+
+        try:
+            with h5py.File(output_path, "w") as output_hfile:
+                output_dset = output_hfile.create_dataset(
+                    name="data",
+                    shape=(num_rows, num_cols),
+                    dtype=dtype,
+                    chunks=chunks,
+                    compression=compression,
+                    compression_opts=compression_opts
+                )
+
+                num_bands = -(-num_cols // band_cols)
+                pending_reads = submit_band_reads(0)
+                for band_idx in range(num_bands):
+                    # Time spent waiting here is reading that writing didn't hide
+                    with task_timing.phase("wait_for_reads"):
+                        _ = [f.result() for f in pending_reads]
+                    if band_idx + 1 < num_bands:
+                        pending_reads = submit_band_reads(band_idx + 1)
+                    start_col = band_idx * band_cols
+                    end_col = min(start_col + band_cols, num_cols)
+                    with task_timing.phase("write"):
+                        band = bands[band_idx % 2]
+                        output_dset[:, start_col:end_col] = band[:, :end_col - start_col]
+                    task_timing.count("chunks_written", -(-num_rows // chunks[0]))
+            task_timing.count_size("bytes_written", output_path)
+        finally:
+            del bands
+            for band_path in band_paths:
+                os.remove(band_path)
+            os.rmdir(band_dir)
+
+@task_timing.phase("verify")
+def verify_hdf5(matrix_path, test_yaml_path):
+
+    with h5py.File(matrix_path, "r") as output_hfile:
+        output_matrix = output_hfile["data"]
+
+        with task_timing.phase("stats"):
+            non_zero_count, total = matrix_stats.dense_stats(output_matrix, output_matrix.chunks)
+        matrix_stats.check_expected(test_yaml_path, non_zero_count, total, output_matrix.shape)
 
 def main():
 
@@ -45,6 +215,31 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--engine",
+        choices=["chunked", "concatenate"],
+        default="chunked",
+        help=("How to merge the matrices. chunked writes the output one band "
+              "of chunks at a time, concatenate loads all the inputs into memory.")
+    )
+    test_group.add_argument(
+        "--chunks",
+        nargs=2,
+        type=int,
+        help=("Chunk shape of the output dataset. Defaults to square chunks the "
+              "height of the input chunks.")
+    )
+    test_group.add_argument(
+        "--compression",
+        help=("Compression of the output dataset: a gzip level, a filter name "
+              "like lzf, or none. Defaults to the input compression.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        help=("Number of files to read concurrently. Defaults to the number of "
+              "CPUs the task may run on.")
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -59,7 +254,11 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_hdf5s(args.input_paths, args.output_path)
+        if args.engine == "chunked":
+            merge_hdf5s_chunked(args.input_paths, args.output_path, args.chunks,
+                                args.compression, args.workers)
+        else:
+            merge_hdf5s(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_hdf5(args.output_matrix, args.test_yaml)
 
@@ -1,22 +1,69 @@
 import argparse
-import numpy
-import yaml
 
+import h5py
 import loompy
 
+import matrix_stats
+import parallel_read
+import task_timing
+
+@task_timing.phase("merge")
 def merge_looms(loom_paths, output_path):
+    start = task_timing.thread_bytes_read()
     loompy.combine(loom_paths, output_path)
+    task_timing.count("files_opened", len(loom_paths))
+    if start is not None:
+        task_timing.count("bytes_read", task_timing.thread_bytes_read() - start)
+    task_timing.count_size("bytes_written", output_path)
 
+def _read_row_attrs(loom_path):
+    """Read the row attributes of a loom file."""
+    with loompy.connect(loom_path, "r") as ds:
+        return {name: ds.ra[name] for name in ds.ra.keys()}
 
-def verify_loom(matrix_path, test_yaml_path):
+def _read_loom(loom_path):
+    """Read the layers and column attributes of a loom file."""
+    with loompy.connect(loom_path, "r") as ds:
+        layers = {name: ds.layers[name][:, :] for name in ds.layers.keys()}
+        col_attrs = {name: ds.ca[name] for name in ds.ca.keys()}
+    return layers, col_attrs
+
+@task_timing.phase("merge")
+def merge_looms_parallel(loom_paths, output_path, workers=None):
+    """Read the loom files concurrently and append them to the merged file in
+    order.
+
+    Like loompy.combine, the output is created from the first file, with its
+    row attributes, and the layers and column attributes of the others are
+    added as columns, so only the files read ahead are in memory at once.
+
+    h5py only lets one thread read at a time, so the HDF5 reads themselves
+    stay serial and the threads only overlap the rest of opening a file. A
+    process pool isn't an option: loompy compiles numba functions with
+    parallel=True when it's imported, and forking after that hangs the
+    process at exit.
+    """
+
+    with task_timing.phase("read_and_write"):
+        looms = parallel_read.iter_parallel(_read_loom, loom_paths, workers)
+        layers, col_attrs = next(looms)
+        loompy.create(output_path, layers, _read_row_attrs(loom_paths[0]), col_attrs)
+        with loompy.connect(output_path) as ds:
+            for layers, col_attrs in looms:
+                ds.add_columns(layers, col_attrs)
+    task_timing.count_size("bytes_written", output_path)
 
-    expected_values = yaml.load(open(test_yaml_path))['expected_output']
 
-    output_matrix = loompy.connect(matrix_path).sparse().toarray()
+@task_timing.phase("verify")
+def verify_loom(matrix_path, test_yaml_path):
+
+    # Read the main matrix of the loom file directly, a chunk at a time
+    with h5py.File(matrix_path, "r") as loom_hfile:
+        output_matrix = loom_hfile["matrix"]
 
-    assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+        with task_timing.phase("stats"):
+            non_zero_count, total = matrix_stats.dense_stats(output_matrix, output_matrix.chunks)
+        matrix_stats.check_expected(test_yaml_path, non_zero_count, total, output_matrix.shape)
 
 def main():
 
@@ -37,6 +84,20 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--engine",
+        choices=["parallel", "combine"],
+        default="parallel",
+        help=("How to merge the matrices. parallel reads the inputs "
+              "concurrently and appends them to the output in order, combine "
+              "uses loompy.combine.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        help=("Number of files to read concurrently. Defaults to the number of "
+              "CPUs the task may run on.")
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -51,7 +112,10 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_looms(args.input_paths, args.output_path)
+        if args.engine == "parallel":
+            merge_looms_parallel(args.input_paths, args.output_path, args.workers)
+        else:
+            merge_looms(args.input_paths, args.output_path)
     elif args.subcommand == "verify":
         verify_loom(args.output_matrix, args.test_yaml)
 
@@ -1,27 +1,194 @@
 import argparse
+import collections
+import concurrent.futures
+import functools
+import os
+import warnings
 import numpy
-import yaml
 
 import scipy.io
 import scipy.sparse
 
-def merge_matrix_markets(matrix_market_paths, output_path):
+import matrix_stats
+import parallel_read
+import remote_io
+import task_timing
 
-    arrays_to_merge = []
-    for matrix_market_path in matrix_market_paths:
-        arrays_to_merge.append(scipy.io.mmread(matrix_market_path))
-    merged_array = scipy.sparse.hstack(arrays_to_merge)
-    output_matrix_market = scipy.io.mmwrite(output_path, merged_array)
+def _mmread(matrix_market_path):
+    with remote_io.open_input(matrix_market_path) as mm_file:
+        return scipy.io.mmread(mm_file)
 
-def verify_matrix_markets(matrix_path, test_yaml_path):
+@task_timing.phase("merge")
+def merge_matrix_markets(matrix_market_paths, output_path, workers=None):
 
-    expected_values = yaml.load(open(test_yaml_path))['expected_output']
+    # mmread parses in Python, so use processes
+    with task_timing.phase("read"):
+        arrays_to_merge = parallel_read.read_parallel(
+            _mmread, matrix_market_paths, workers, use_processes=True)
+    with task_timing.phase("concatenate"):
+        merged_array = scipy.sparse.hstack(arrays_to_merge)
+    with task_timing.phase("write"):
+        output_matrix_market = scipy.io.mmwrite(output_path, merged_array)
+    if not output_path.endswith(".mtx"):
+        output_path += ".mtx"
+    task_timing.count_size("bytes_written", output_path)
 
-    output_matrix = scipy.io.mmread(matrix_path).toarray()
+MatrixMarketHeader = collections.namedtuple(
+    "MatrixMarketHeader", ["banner", "rows", "cols", "entries", "body_offset"])
 
-    assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+def _read_header(matrix_market_path):
+    """Read the banner and size line of a Matrix Market file."""
+    with remote_io.open_input(matrix_market_path) as mm_file:
+        banner = mm_file.readline()
+        line = mm_file.readline()
+        while line.startswith(b"%") or not line.strip():
+            line = mm_file.readline()
+        rows, cols, entries = (int(f) for f in line.split())
+        return MatrixMarketHeader(banner, rows, cols, entries, mm_file.tell())
+
+def _shift_columns(matrix_market_paths, body_offsets, col_offsets):
+    """Return the coordinate lines of some Matrix Market files with their column
+    indices shifted by col_offsets.
+
+    Everything other than the column index is copied byte for byte.
+    """
+    out_lines = []
+    for matrix_market_path, body_offset, col_offset in zip(
+            matrix_market_paths, body_offsets, col_offsets):
+        with remote_io.open_input(matrix_market_path) as mm_file:
+            mm_file.seek(body_offset)
+            body = mm_file.read()
+        for line in body.splitlines(True):
+            if not line.strip():
+                continue
+            row, _, rest = line.partition(b" ")
+            col, space, value = rest.partition(b" ")
+            if not space:
+                # Pattern matrices have no value, keep the line ending
+                value = col[len(col.rstrip()):]
+                col = col.rstrip()
+            out_lines.append(b"%s %d%s%s" % (row, int(col) + col_offset, space, value))
+    return b"".join(out_lines)
+
+@task_timing.phase("merge")
+def merge_matrix_markets_streaming(matrix_market_paths, output_path, workers=None,
+                                   files_per_task=64, buffer_size=16 * 2**20):
+    """Merge Matrix Market files by rewriting their text instead of parsing them.
+
+    Only the headers are parsed up front, which gives the output size line and
+    the column offset of each file. Worker processes then rewrite the column
+    indices of batches of files, and the results are written out in order
+    through a large buffer.
+
+    The output matches what mmwrite produces for the merged matrix, as long as
+    mmwrite would reproduce the inputs' values verbatim: integer entries in a
+    general, non-square matrix. Anything else goes through merge_matrix_markets.
+    """
+
+    workers = workers or parallel_read.available_cpus()
+    with task_timing.phase("read_headers"):
+        headers = parallel_read.read_parallel(_read_header, matrix_market_paths, workers)
+
+    num_rows = headers[0].rows
+    for matrix_market_path, header in zip(matrix_market_paths, headers):
+        if header.rows != num_rows:
+            raise ValueError("Can't merge {} with {} rows into a matrix with {} rows".format(
+                matrix_market_path, header.rows, num_rows))
+    num_cols = sum(header.cols for header in headers)
+    num_entries = sum(header.entries for header in headers)
+
+    banner = headers[0].banner
+    if (banner.split()[1:] != [b"matrix", b"coordinate", b"integer", b"general"]
+            or any(header.banner != banner for header in headers)
+            or num_rows == num_cols):
+        warnings.warn("Inputs can't be merged as text, falling back to mmread")
+        return merge_matrix_markets(matrix_market_paths, output_path, workers)
+
+    col_offsets = [0]
+    for header in headers[:-1]:
+        col_offsets.append(col_offsets[-1] + header.cols)
+
+    # mmwrite adds the extension if it's missing, so do the same here
+    if not output_path.endswith(".mtx"):
+        output_path += ".mtx"
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor, \
+            open(output_path, "wb", buffering=buffer_size) as output_file, \
+            task_timing.phase("rewrite"):
+        output_file.write(banner)
+        output_file.write(b"%\n")
+        output_file.write(b"%d %d %d\n" % (num_rows, num_cols, num_entries))
+
+        # Keep a bounded number of batches in flight so we don't buffer the
+        # whole output if writing falls behind
+        pending = collections.deque()
+        for task_start in range(0, len(matrix_market_paths), files_per_task):
+            task_end = task_start + files_per_task
+            pending.append(executor.submit(
+                _shift_columns,
+                matrix_market_paths[task_start:task_end],
+                [header.body_offset for header in headers[task_start:task_end]],
+                col_offsets[task_start:task_end]))
+            if len(pending) >= 4 * workers:
+                output_file.write(pending.popleft().result())
+        while pending:
+            output_file.write(pending.popleft().result())
+    task_timing.count("entries_rewritten", num_entries)
+    task_timing.count_size("bytes_written", output_path)
+
+def _coordinate_stats(matrix_market_path, value_dtype, byte_range):
+    """Return the nonzero count and sum of the entries on the coordinate lines
+    of a Matrix Market file that start within byte_range.
+    """
+    start, end = byte_range
+    with open(matrix_market_path, "rb") as mm_file:
+        # Skip the line we're in the middle of, it belongs to the previous range
+        mm_file.seek(start - 1)
+        if mm_file.read(1) != b"\n":
+            mm_file.readline()
+        position = mm_file.tell()
+        if position >= end:
+            return 0, 0
+        text = mm_file.read(end - position)
+        if not text.endswith(b"\n"):
+            text += mm_file.readline()
+
+    if value_dtype is None:
+        # Pattern matrices, every entry is a one
+        num_entries = len(text.split()) // 2
+        return num_entries, num_entries
+    entries = numpy.array(text.split(), dtype=value_dtype)
+    return matrix_stats.array_stats(entries.reshape(-1, 3)[:, 2])
+
+@task_timing.phase("verify")
+def verify_matrix_markets(matrix_path, test_yaml_path, block_bytes=16 * 2**20):
+
+    if not os.path.isfile(matrix_path):
+        matrix_path += ".mtx"
+    header = _read_header(matrix_path)
+    _, _, mm_format, field, symmetry = header.banner.decode().lower().split()
+
+    if mm_format != "coordinate" or symmetry != "general" or field == "complex":
+        # Not a layout we can stream, let scipy work it out
+        output_matrix = scipy.io.mmread(matrix_path)
+        if scipy.sparse.issparse(output_matrix):
+            non_zero_count = output_matrix.count_nonzero()
+            total = output_matrix.sum()
+        else:
+            non_zero_count, total = matrix_stats.array_stats(output_matrix)
+    else:
+        # Parse byte ranges of the coordinate lines in parallel. This assumes
+        # each entry appears once, which is how mmwrite writes them.
+        value_dtype = {"integer": numpy.int64, "real": numpy.float64, "pattern": None}[field]
+        file_size = os.path.getsize(matrix_path)
+        byte_ranges = [(start, min(start + block_bytes, file_size))
+                       for start in range(header.body_offset, file_size, block_bytes)]
+        with task_timing.phase("stats"):
+            non_zero_count, total = matrix_stats.reduce_blocks(
+                functools.partial(_coordinate_stats, matrix_path, value_dtype),
+                byte_ranges, use_processes=True)
+
+    matrix_stats.check_expected(test_yaml_path, non_zero_count, total,
+                                (header.rows, header.cols))
 
 def main():
 
@@ -42,6 +209,19 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--engine",
+        choices=["streaming", "mmread"],
+        default="streaming",
+        help=("How to merge the matrices. streaming rewrites the coordinate "
+              "lines of the inputs, mmread parses them with scipy.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        help=("Number of files to read concurrently and processes rewriting "
+              "them. Defaults to the number of CPUs the task may run on.")
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -56,7 +236,10 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_matrix_markets(args.input_paths, args.output_path)
+        if args.engine == "streaming":
+            merge_matrix_markets_streaming(args.input_paths, args.output_path, args.workers)
+        else:
+            merge_matrix_markets(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_matrix_markets(args.output_matrix, args.test_yaml)
 
@@ -1,24 +1,121 @@
 import argparse
+import functools
 import numpy
-import yaml
 
-def merge_npys(npy_paths, output_path):
+import matrix_stats
+import parallel_read
+import remote_io
+import task_timing
 
-    arrays_to_merge = []
-    for npy_path in npy_paths:
-        arrays_to_merge.append(numpy.load(npy_path))
-    merged_array = numpy.concatenate(arrays_to_merge, axis=1)
-    numpy.save(output_path, merged_array)
+def _load_npy(npy_path):
+    with remote_io.open_input(npy_path) as npy_file:
+        return numpy.load(npy_file)
 
-def verify_npys(matrix_path, test_yaml_path):
+@task_timing.phase("merge")
+def merge_npys(npy_paths, output_path, workers=None):
+
+    with task_timing.phase("read"):
+        arrays_to_merge = parallel_read.read_parallel(_load_npy, npy_paths, workers)
+    with task_timing.phase("concatenate"):
+        merged_array = numpy.concatenate(arrays_to_merge, axis=1)
+    with task_timing.phase("write"):
+        numpy.save(output_path, merged_array)
+    task_timing.count("bytes_written", merged_array.nbytes)
+
+def _read_npy_header(npy_path):
+    """Read the shape, layout, dtype and data offset of an .npy file without
+    touching its data.
+    """
+    with remote_io.open_input(npy_path) as npy_file:
+        version = numpy.lib.format.read_magic(npy_file)
+        if version == (1, 0):
+            header = numpy.lib.format.read_array_header_1_0(npy_file)
+        else:
+            header = numpy.lib.format.read_array_header_2_0(npy_file)
+        shape, fortran_order, dtype = header
+        return shape, fortran_order, dtype, npy_file.tell()
+
+def _map_npy(npy_path, header):
+    """Memory-map the data of an .npy file. Remote files can't be mapped, so
+    they're read instead.
+    """
+    shape, fortran_order, dtype, offset = header
+    if remote_io.is_remote(npy_path):
+        return _load_npy(npy_path)
+    return numpy.memmap(npy_path, dtype=dtype, mode="r", offset=offset,
+                        shape=shape, order="F" if fortran_order else "C")
+
+@task_timing.phase("merge")
+def merge_npys_streaming(npy_paths, output_path, workers=None,
+                         block_bytes=64 * 2**20, files_per_group=1024):
+    """Merge npy files without holding the inputs or the output in memory.
+
+    The output is preallocated with open_memmap, and the inputs are copied into
+    it through memory maps, a group of files at a time. Within a group we copy
+    blocks of rows so that the buffer holds at most about block_bytes, which
+    keeps the resident input and dirty output pages bounded no matter how many
+    files are merged.
+    """
+
+    with task_timing.phase("read_headers"):
+        headers = parallel_read.read_parallel(_read_npy_header, npy_paths, workers)
+
+    num_rows = headers[0][0][0]
+    for npy_path, (shape, _, _, _) in zip(npy_paths, headers):
+        if len(shape) != 2 or shape[0] != num_rows:
+            raise ValueError("Can't merge {} with shape {} into a matrix with {} rows".format(
+                npy_path, shape, num_rows))
+    num_cols = sum(shape[1] for shape, _, _, _ in headers)
+    dtype = functools.reduce(numpy.promote_types, (dtype for _, _, dtype, _ in headers))
+
+    # numpy.save appends the extension, so do the same here
+    if not output_path.endswith(".npy"):
+        output_path += ".npy"
+    merged_array = numpy.lib.format.open_memmap(
+        output_path, mode="w+", dtype=dtype, shape=(num_rows, num_cols))
+
+    col_offset = 0
+    for group_start in range(0, len(npy_paths), files_per_group):
+        group_paths = npy_paths[group_start:group_start + files_per_group]
+        group_headers = headers[group_start:group_start + files_per_group]
+        group_cols = sum(shape[1] for shape, _, _, _ in group_headers)
 
-    expected_values = yaml.load(open(test_yaml_path))['expected_output']
+        with task_timing.phase("map"):
+            input_maps = [_map_npy(npy_path, header)
+                          for npy_path, header in zip(group_paths, group_headers)]
 
-    output_matrix = numpy.load(matrix_path + ".npy")
+        block_rows = max(1, block_bytes // max(1, group_cols * dtype.itemsize))
+        buffer = numpy.empty((min(block_rows, num_rows), group_cols), dtype=dtype)
+        for row_start in range(0, num_rows, block_rows):
+            row_end = min(row_start + block_rows, num_rows)
+            block = buffer[:row_end - row_start]
+            buffer_col = 0
+            with task_timing.phase("copy"):
+                for input_map in input_maps:
+                    width = input_map.shape[1]
+                    block[:, buffer_col:buffer_col + width] = input_map[row_start:row_end]
+                    buffer_col += width
+            with task_timing.phase("write"):
+                merged_array[row_start:row_end, col_offset:col_offset + group_cols] = block
+                merged_array.flush()
+            task_timing.count("blocks_copied")
+            task_timing.count("bytes_written", block.nbytes)
 
-    assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+        # Drop the maps so their pages can be reclaimed before the next group
+        del input_maps
+        col_offset += group_cols
+
+    merged_array.flush()
+    del merged_array
+
+@task_timing.phase("verify")
+def verify_npys(matrix_path, test_yaml_path):
+
+    output_matrix = numpy.load(matrix_path + ".npy", mmap_mode="r")
+
+    with task_timing.phase("stats"):
+        non_zero_count, total = matrix_stats.dense_stats(output_matrix)
+    matrix_stats.check_expected(test_yaml_path, non_zero_count, total, output_matrix.shape)
 
 def main():
 
@@ -39,6 +136,19 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--engine",
+        choices=["streaming", "concatenate"],
+        default="streaming",
+        help=("How to merge the matrices. streaming copies the inputs into a "
+              "memory-mapped output, concatenate loads them all into memory.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        help=("Number of files to read concurrently. Defaults to the number of "
+              "CPUs the task may run on.")
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -53,7 +163,10 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_npys(args.input_paths, args.output_path)
+        if args.engine == "streaming":
+            merge_npys_streaming(args.input_paths, args.output_path, args.workers)
+        else:
+            merge_npys(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_npys(args.output_matrix, args.test_yaml)
 
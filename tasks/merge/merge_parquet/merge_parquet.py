@@ -1,30 +1,202 @@
 import argparse
-import numpy
-import yaml
+import collections
+import concurrent.futures
+import json
 
 import pandas
+import pyarrow
+import pyarrow.parquet
 
-def merge_parquets(parquet_paths, output_path):
+import matrix_stats
+import parallel_read
+import remote_io
+import task_timing
 
-    dfs_to_merge = []
-    for parquet_path in parquet_paths:
-        dfs_to_merge.append(pandas.read_parquet(parquet_path))
-    print("Opened", len(dfs_to_merge), "dataframes")
-    print(dfs_to_merge[0])
-    print(dfs_to_merge[0].shape)
-    merged_df = pandas.concat(dfs_to_merge, axis=1)
-    print(merged_df.shape)
-    merged_df.to_parquet(output_path)
+# How much of an input to read at a time, rather than a whole column chunk
+READ_BUFFER_BYTES = 2**20
 
+@task_timing.phase("merge")
+def merge_parquets(parquet_paths, output_path, workers=None):
+
+    with task_timing.phase("read"):
+        dfs_to_merge = parallel_read.read_parallel(pandas.read_parquet, parquet_paths, workers)
+    with task_timing.phase("concatenate"):
+        merged_df = pandas.concat(dfs_to_merge, axis=1)
+    with task_timing.phase("write"):
+        merged_df.to_parquet(output_path)
+    task_timing.count_size("bytes_written", output_path)
+
+def _index_columns(schema):
+    """Names of the physical columns pandas stored the dataframe index in."""
+    if schema.pandas_metadata is None:
+        return []
+    return [c for c in schema.pandas_metadata["index_columns"] if isinstance(c, str)]
+
+def _open_parquet(parquet_path):
+    """Open an input and read its footer."""
+    if remote_io.is_remote(parquet_path):
+        # Only the footer and the column chunks that are read are fetched
+        return pyarrow.parquet.ParquetFile(remote_io.open_input(parquet_path),
+                                           buffer_size=READ_BUFFER_BYTES)
+    return pyarrow.parquet.ParquetFile(parquet_path, buffer_size=READ_BUFFER_BYTES)
+
+class _BatchCursor(object):
+    """The decoded rows of one input that overlap the output row group being
+    written.
+    """
+
+    def __init__(self, parquet_file, value_names, index_names=(), batch_size=4096):
+        self.parquet_file = parquet_file
+        self.value_names = value_names
+        # The columns to decode
+        self.columns = value_names + list(index_names)
+        self.batch_iter = parquet_file.iter_batches(
+            batch_size=batch_size, columns=self.columns, use_threads=False)
+        # (first row, record batch) of the batches still needed
+        self.batches = collections.deque()
+        self.rows_read = 0
+
+    def read(self, start, end):
+        """Drop the batches before start and decode batches up to end."""
+        while self.batches and self.batches[0][0] + self.batches[0][1].num_rows <= start:
+            self.batches.popleft()
+        decoded = 0
+        while self.rows_read < end:
+            batch = next(self.batch_iter)
+            self.batches.append((self.rows_read, batch))
+            self.rows_read += batch.num_rows
+            decoded += 1
+        task_timing.count("chunks_decoded", decoded * len(self.columns))
+
+    def column(self, name, start, end):
+        """Return rows start to end of a column, from the decoded batches."""
+        chunks = []
+        for batch_start, batch in self.batches:
+            chunk_start = max(start, batch_start)
+            chunk_end = min(end, batch_start + batch.num_rows)
+            if chunk_start >= chunk_end:
+                continue
+            column = batch.column(batch.schema.get_field_index(name))
+            chunks.append(column.slice(chunk_start - batch_start, chunk_end - chunk_start))
+        return pyarrow.chunked_array(chunks, type=self.parquet_file.schema_arrow.field(name).type)
+
+@task_timing.phase("merge")
+def merge_parquets_arrow(parquet_paths, output_path, workers=None, row_group_size=4096):
+    """Merge parquet files column-wise with pyarrow, never going through pandas.
+
+    The output is written one row group of row_group_size rows at a time. For
+    each one, the rows of the inputs that overlap it are decoded on a thread
+    pool in batches of at most row_group_size rows, their value columns are
+    sliced and assembled into a table without copying, and the table is
+    written through a ParquetWriter. Batches are dropped once the output is
+    past them, and the inputs are read through a small buffer rather than a
+    column chunk at a time, so memory holds about two batches of every input
+    however the inputs are split into row groups. The index of the first file
+    becomes the index of the output, and the pandas metadata is merged so that
+    pandas.read_parquet gives the same dataframe as the pandas merge.
+    """
+
+    workers = workers or parallel_read.available_cpus()
+    with task_timing.phase("open"):
+        parquet_files = parallel_read.read_parallel(_open_parquet, parquet_paths, workers)
+
+    first_schema = parquet_files[0].schema_arrow
+    index_names = _index_columns(first_schema)
+    num_rows = parquet_files[0].metadata.num_rows
+
+    fields = []
+    column_metadata = []
+    cursors = []
+    for parquet_path, parquet_file in zip(parquet_paths, parquet_files):
+        if parquet_file.metadata.num_rows != num_rows:
+            raise ValueError("Can't merge {} with {} rows into a table with {} rows".format(
+                parquet_path, parquet_file.metadata.num_rows, num_rows))
+        schema = parquet_file.schema_arrow
+        file_index_names = _index_columns(schema)
+        pandas_columns = {}
+        if schema.pandas_metadata is not None:
+            pandas_columns = {c["field_name"]: c for c in schema.pandas_metadata["columns"]}
+        value_names = []
+        for field in schema:
+            if field.name in file_index_names:
+                continue
+            fields.append(field)
+            value_names.append(field.name)
+            if field.name in pandas_columns:
+                column_metadata.append(pandas_columns[field.name])
+        cursors.append(_BatchCursor(parquet_file, value_names,
+                                    index_names if not cursors else (), row_group_size))
+
+    # pandas writes the index after the value columns
+    for index_name in index_names:
+        fields.append(first_schema.field(index_name))
+
+    metadata = None
+    if first_schema.pandas_metadata is not None:
+        pandas_metadata = dict(first_schema.pandas_metadata)
+        pandas_metadata["columns"] = column_metadata + [
+            c for c in pandas_metadata["columns"] if c["field_name"] in index_names]
+        metadata = {b"pandas": json.dumps(pandas_metadata).encode()}
+    output_schema = pyarrow.schema(fields, metadata=metadata)
+
+    writer = pyarrow.parquet.ParquetWriter(output_path, output_schema)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, num_rows, row_group_size):
+                end = min(start + row_group_size, num_rows)
+
+                with task_timing.phase("read"):
+                    reads = [executor.submit(cursor.read, start, end) for cursor in cursors]
+                    for future in reads:
+                        future.result()
+
+                with task_timing.phase("concatenate"):
+                    columns = [cursor.column(name, start, end)
+                               for cursor in cursors for name in cursor.value_names]
+                    columns.extend(cursors[0].column(name, start, end) for name in index_names)
+                    table = pyarrow.Table.from_arrays(columns, schema=output_schema)
+
+                with task_timing.phase("write"):
+                    writer.write_table(table)
+    finally:
+        writer.close()
+    task_timing.count_size("bytes_written", output_path)
+
+def _all_zero(column_chunk):
+    """Use the row group statistics to tell if a column chunk is all zeros."""
+    stats = column_chunk.statistics
+    return (stats is not None and stats.has_min_max and stats.null_count == 0
+            and stats.min == 0 and stats.max == 0)
+
+@task_timing.phase("verify")
 def verify_parquets(matrix_path, test_yaml_path):
 
-    expected_values = yaml.load(open(test_yaml_path))['expected_output']
+    parquet_file = pyarrow.parquet.ParquetFile(matrix_path)
+    metadata = parquet_file.metadata
+    index_names = _index_columns(parquet_file.schema_arrow)
+    value_columns = [name for name in parquet_file.schema_arrow.names if name not in index_names]
+    value_column_idxs = [parquet_file.schema_arrow.get_field_index(name) for name in value_columns]
 
-    output_matrix = pandas.read_parquet(matrix_path)
+    def row_group_stats(row_group_idx):
+        row_group = metadata.row_group(row_group_idx)
+        # Skip the column chunks the statistics say are all zero
+        columns = [name for name, col_idx in zip(value_columns, value_column_idxs)
+                   if not _all_zero(row_group.column(col_idx))]
+        table = parquet_file.read_row_group(row_group_idx, columns=columns, use_threads=False)
+        task_timing.count("chunks_decoded", len(columns))
+        non_zero_count = 0
+        total = 0
+        for column in table.columns:
+            column_non_zero_count, column_total = matrix_stats.array_stats(column.to_numpy())
+            non_zero_count += column_non_zero_count
+            total += column_total
+        return non_zero_count, total
 
-    assert numpy.count_nonzero(output_matrix.as_matrix()) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix.as_matrix()) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+    with task_timing.phase("stats"):
+        non_zero_count, total = matrix_stats.reduce_blocks(
+            row_group_stats, range(metadata.num_row_groups))
+    matrix_stats.check_expected(test_yaml_path, non_zero_count, total,
+                                (metadata.num_rows, len(value_columns)))
 
 def main():
 
@@ -45,6 +217,19 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--engine",
+        choices=["arrow", "pandas"],
+        default="arrow",
+        help=("How to merge the matrices. arrow streams row groups through "
+              "pyarrow, pandas concatenates dataframes.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        help=("Number of files to read concurrently. Defaults to the number of "
+              "CPUs the task may run on.")
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -59,7 +244,10 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_parquets(args.input_paths, args.output_path)
+        if args.engine == "arrow":
+            merge_parquets_arrow(args.input_paths, args.output_path, args.workers)
+        else:
+            merge_parquets(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_parquets(args.output_matrix, args.test_yaml)
 
@@ -1,28 +1,134 @@
 import argparse
 import numpy
-import yaml
 
+import h5py
 import h5sparse
 import scipy.sparse
 
-def merge_hdf5s(hdf5_paths, output_path):
+import matrix_stats
+import parallel_read
+import remote_io
+import task_timing
 
-    arrays_to_merge = []
-    for hdf5_path in hdf5_paths:
-        arrays_to_merge.append(h5sparse.File(hdf5_path)["data"].value)
-    merged_array = scipy.sparse.hstack(arrays_to_merge, format="coo")
-    output_file = h5sparse.File(output_path, "w", libver="latest")
-    output_file.create_dataset("data", data=merged_array.toarray())
+def _read_h5sparse(hdf5_path):
+    return h5sparse.File(hdf5_path)["data"].value
 
-def verify_hdf5(matrix_path, test_yaml_path):
+@task_timing.phase("merge")
+def merge_hdf5s(hdf5_paths, output_path, workers=None):
+
+    with task_timing.phase("read"):
+        # h5py only lets one thread read at a time
+        arrays_to_merge = parallel_read.read_parallel(_read_h5sparse, hdf5_paths, workers,
+                                                      use_processes=True)
+    with task_timing.phase("concatenate"):
+        merged_array = scipy.sparse.hstack(arrays_to_merge, format="coo")
+    with task_timing.phase("write"):
+        output_file = h5sparse.File(output_path, "w", libver="latest")
+        output_file.create_dataset("data", data=merged_array.toarray())
+
+def _read_csc(hdf5_path):
+    """Read the sparse matrix in an h5sparse file and return it as CSC.
+
+    CSR inputs are converted here, one file at a time, so the merge only ever
+    has to deal with column-major data.
+    """
+    if remote_io.is_remote(hdf5_path):
+        hfile = h5py.File(remote_io.open_input(hdf5_path), "r")
+    else:
+        hfile = h5py.File(hdf5_path, "r")
+    with hfile:
+        group = hfile["data"]
+        sparse_format = group.attrs["h5sparse_format"]
+        if isinstance(sparse_format, bytes):
+            sparse_format = sparse_format.decode()
+        matrix_class = getattr(scipy.sparse, sparse_format + "_matrix")
+        matrix = matrix_class(
+            (group["data"][()], group["indices"][()], group["indptr"][()]),
+            shape=tuple(group.attrs["h5sparse_shape"]))
+    return matrix.tocsc()
+
+def _append(dataset, values):
+    start = dataset.shape[0]
+    dataset.resize((start + values.shape[0],))
+    dataset[start:] = values
+
+@task_timing.phase("merge")
+def merge_hdf5s_sparse(hdf5_paths, output_path, workers=None, batch_size=256):
+    """Merge sparse hdf5 files into a CSC h5sparse file without densifying.
+
+    Inputs are read in batches. For each batch we concatenate the data and
+    indices arrays, shift the indptr arrays by the number of nonzeros written
+    so far, and append the results to resizable datasets. Memory use and
+    output size scale with the number of nonzeros in a batch.
+    """
+
+    with h5py.File(output_path, "w", libver="latest") as output_hfile:
+        group = output_hfile.create_group("data")
+        group.attrs["h5sparse_format"] = "csc"
+
+        data_dset = indices_dset = None
+        indptr_dset = group.create_dataset(
+            "indptr", data=numpy.zeros(1, dtype=numpy.int64),
+            maxshape=(None,), chunks=True)
+
+        num_rows = None
+        num_cols = 0
+        nnz = 0
+        for batch_start in range(0, len(hdf5_paths), batch_size):
+            batch_paths = hdf5_paths[batch_start:batch_start + batch_size]
+            with task_timing.phase("read"):
+                matrices = parallel_read.read_parallel(_read_csc, batch_paths, workers,
+                                                       use_processes=True)
 
-    expected_values = yaml.load(open(test_yaml_path))['expected_output']
+            for hdf5_path, matrix in zip(batch_paths, matrices):
+                if num_rows is None:
+                    num_rows = matrix.shape[0]
+                elif matrix.shape[0] != num_rows:
+                    raise ValueError(
+                        "Can't merge {} with shape {} into a matrix with {} rows".format(
+                            hdf5_path, matrix.shape, num_rows))
 
-    output_matrix = h5sparse.File(matrix_path)["data"].value
+            if data_dset is None:
+                data_dset = group.create_dataset(
+                    "data", shape=(0,), dtype=matrices[0].dtype,
+                    maxshape=(None,), chunks=True)
+                indices_dset = group.create_dataset(
+                    "indices", shape=(0,), dtype=numpy.int32,
+                    maxshape=(None,), chunks=True)
 
-    assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+            with task_timing.phase("concatenate"):
+                batch_indptrs = []
+                for matrix in matrices:
+                    batch_indptrs.append(matrix.indptr[1:].astype(numpy.int64) + nnz)
+                    nnz += matrix.nnz
+                    num_cols += matrix.shape[1]
+                batch_data = numpy.concatenate([m.data for m in matrices])
+                batch_indices = numpy.concatenate([m.indices for m in matrices])
+                batch_indptr = numpy.concatenate(batch_indptrs)
+
+            with task_timing.phase("write"):
+                _append(data_dset, batch_data)
+                _append(indices_dset, batch_indices)
+                _append(indptr_dset, batch_indptr)
+            task_timing.count("bytes_written",
+                              batch_data.nbytes + batch_indices.nbytes + batch_indptr.nbytes)
+
+        group.attrs["h5sparse_shape"] = (num_rows, num_cols)
+
+@task_timing.phase("verify")
+def verify_hdf5(matrix_path, test_yaml_path):
+
+    with h5py.File(matrix_path, "r") as output_hfile, task_timing.phase("stats"):
+        output_item = output_hfile["data"]
+        if isinstance(output_item, h5py.Group):
+            # A sparse matrix, only the stored values matter
+            shape = tuple(output_item.attrs["h5sparse_shape"])
+            non_zero_count, total = matrix_stats.sparse_data_stats(output_item["data"])
+        else:
+            shape = output_item.shape
+            non_zero_count, total = matrix_stats.dense_stats(output_item, output_item.chunks)
+
+    matrix_stats.check_expected(test_yaml_path, non_zero_count, total, shape)
 
 def main():
 
@@ -43,6 +149,19 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--engine",
+        choices=["sparse", "dense"],
+        default="sparse",
+        help=("How to merge the matrices. sparse streams the inputs into a CSC "
+              "matrix, dense loads them all and writes a dense matrix.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        help=("Number of files to read concurrently. Defaults to the number of "
+              "CPUs the task may run on.")
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -57,7 +176,10 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_hdf5s(args.input_paths, args.output_path)
+        if args.engine == "sparse":
+            merge_hdf5s_sparse(args.input_paths, args.output_path, args.workers)
+        else:
+            merge_hdf5s(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_hdf5(args.output_matrix, args.test_yaml)
 
@@ -1,30 +1,195 @@
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import functools
 import numpy
-import yaml
 
 import zarr
 
-def merge_zarrs(zarr_paths, output_path):
+import matrix_stats
+import parallel_read
+import remote_io
+import task_timing
 
-    arrays_to_merge = []
-    for zarr_path in zarr_paths:
-        arrays_to_merge.append(zarr.open(zarr_path))
-    print("Opened", len(arrays_to_merge), "arrays")
-    print(arrays_to_merge[0])
-    print(arrays_to_merge[0].shape)
-    merged_array = numpy.concatenate(arrays_to_merge, axis=1)
-    print(merged_array.shape)
-    output_zarr = zarr.save(output_path, merged_array)
+def _open_zarr(zarr_path):
+    if remote_io.is_remote(zarr_path):
+        store = remote_io.HTTPStore(zarr_path)
+        # Newer zarr only takes its own store classes
+        if hasattr(zarr.storage, "KVStore"):
+            store = zarr.storage.KVStore(store)
+        return zarr.open_array(store=store, mode="r")
+    return zarr.open_array(zarr_path, mode="r")
 
-def verify_zarrs(matrix_path, test_yaml_path):
+@task_timing.phase("merge")
+def merge_zarrs(zarr_paths, output_path, workers=None):
+
+    with task_timing.phase("open"):
+        arrays_to_merge = parallel_read.read_parallel(_open_zarr, zarr_paths, workers)
+    # The arrays are read and decoded as they're concatenated
+    with task_timing.phase("concatenate"):
+        merged_array = numpy.concatenate(arrays_to_merge, axis=1)
+    with task_timing.phase("write"):
+        output_zarr = zarr.save(output_path, merged_array)
+    task_timing.count_size("bytes_written", output_path)
+
+def _chunk_key(row_chunk, col_chunk):
+    return "{}.{}".format(row_chunk, col_chunk)
+
+def _can_copy_raw_chunks(input_array, output_array, col_offset, num_cols):
+    """Test if the stored chunks of input_array can be copied into output_array
+    as they are.
+
+    That is the case when both arrays encode chunks identically and the input's
+    chunk grid lines up with the output's at col_offset. The input's last
+    column chunk is padded to the full chunk width, so it can only be copied if
+    the input is a whole number of chunks wide or ends where the output ends.
+    """
+    chunk_cols = output_array.chunks[1]
+    return (input_array.chunks == output_array.chunks
+            and input_array.dtype == output_array.dtype
+            and input_array.order == output_array.order
+            and input_array.compressor == output_array.compressor
+            and input_array.filters == output_array.filters
+            and input_array.fill_value == output_array.fill_value
+            and col_offset % chunk_cols == 0
+            and (input_array.shape[1] % chunk_cols == 0
+                 or col_offset + input_array.shape[1] == num_cols))
+
+def _copy_chunk(input_array, output_array, row_chunk, input_col_chunk, output_col_chunk):
+    """Copy one compressed chunk without decoding it."""
+    try:
+        chunk_bytes = input_array.store[_chunk_key(row_chunk, input_col_chunk)]
+    except KeyError:
+        # Missing chunks are all fill_value, same in the output
+        return
+    output_array.store[_chunk_key(row_chunk, output_col_chunk)] = chunk_bytes
+    task_timing.count("chunks_copied")
+
+def _write_chunk(input_arrays, col_offsets, output_array, row_chunk, output_col_chunk):
+    """Decode the parts of the inputs that overlap one output chunk and write it.
+
+    The write covers the whole output chunk, so zarr never has to read back and
+    re-encode a partially written chunk.
+    """
+    chunk_rows, chunk_cols = output_array.chunks
+    num_rows, num_cols = output_array.shape
+    start_row = row_chunk * chunk_rows
+    end_row = min(start_row + chunk_rows, num_rows)
+    start_col = output_col_chunk * chunk_cols
+    end_col = min(start_col + chunk_cols, num_cols)
+
+    first_input = bisect.bisect_right(col_offsets, start_col) - 1
+    last_input = bisect.bisect_left(col_offsets, end_col)
+
+    block = numpy.empty((end_row - start_row, end_col - start_col), dtype=output_array.dtype)
+    for input_idx in range(first_input, last_input):
+        input_start = max(start_col, col_offsets[input_idx])
+        input_end = min(end_col, col_offsets[input_idx + 1])
+        block[:, input_start - start_col:input_end - start_col] = \
+            input_arrays[input_idx][start_row:end_row,
+                                    input_start - col_offsets[input_idx]:
+                                    input_end - col_offsets[input_idx]]
+        task_timing.count("chunks_decoded")
+    output_array[start_row:end_row, start_col:end_col] = block
+    task_timing.count("chunks_written")
+
+def _default_chunks(input_arrays):
+    """Pick the output chunk shape when none is given.
+
+    If the inputs all have the same chunk shape, the output uses it too, so
+    their chunks can be copied without decoding them. Otherwise the chunks are
+    as tall as the first input's and as wide as the widest input chunk, so
+    narrow inputs, whose chunks are clipped to their width, don't shrink the
+    output's chunks.
+    """
+    chunk_shapes = set(input_array.chunks for input_array in input_arrays)
+    if len(chunk_shapes) == 1:
+        return chunk_shapes.pop()
+    return (input_arrays[0].chunks[0], max(chunks[1] for chunks in chunk_shapes))
+
+@task_timing.phase("merge")
+def merge_zarrs_chunked(zarr_paths, output_path, chunks=None, workers=None):
+    """Merge zarr arrays column-wise without materializing the result.
+
+    The output array is created up front, and each output chunk is filled
+    independently on a thread pool. Where an input's chunk grid lines up with
+    the output we copy its compressed chunks directly; elsewhere we decode just
+    the parts of the inputs that overlap the chunk.
+    """
+
+    with task_timing.phase("open"):
+        input_arrays = parallel_read.read_parallel(_open_zarr, zarr_paths, workers)
 
-    expected_values = yaml.load(open(test_yaml_path))['expected_output']
+    num_rows = input_arrays[0].shape[0]
+    for zarr_path, input_array in zip(zarr_paths, input_arrays):
+        if len(input_array.shape) != 2 or input_array.shape[0] != num_rows:
+            raise ValueError("Can't merge {} with shape {} into a matrix with {} rows".format(
+                zarr_path, input_array.shape, num_rows))
 
-    output_matrix = zarr.open(matrix_path)
+    col_offsets = [0]
+    for input_array in input_arrays:
+        col_offsets.append(col_offsets[-1] + input_array.shape[1])
+    num_cols = col_offsets[-1]
 
-    assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+    first_array = input_arrays[0]
+    if chunks is None:
+        chunks = _default_chunks(input_arrays)
+    chunks = (min(chunks[0], num_rows), min(chunks[1], num_cols))
+
+    output_array = zarr.open_array(
+        output_path,
+        mode="w",
+        shape=(num_rows, num_cols),
+        chunks=chunks,
+        dtype=functools.reduce(numpy.promote_types, (a.dtype for a in input_arrays)),
+        compressor=first_array.compressor,
+        filters=first_array.filters,
+        fill_value=first_array.fill_value,
+        order=first_array.order
+    )
+
+    raw_copies = {}
+    for input_idx, input_array in enumerate(input_arrays):
+        if _can_copy_raw_chunks(input_array, output_array, col_offsets[input_idx], num_cols):
+            first_chunk = col_offsets[input_idx] // chunks[1]
+            num_input_chunks = -(-input_array.shape[1] // chunks[1])
+            for input_col_chunk in range(num_input_chunks):
+                raw_copies[first_chunk + input_col_chunk] = (input_array, input_col_chunk)
+
+    num_row_chunks = -(-num_rows // chunks[0])
+    num_col_chunks = -(-num_cols // chunks[1])
+    workers = workers or parallel_read.available_cpus()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
+            task_timing.phase("copy_and_write"):
+        # Keep a bounded number of chunks in flight, so that a matrix of many
+        # small chunks doesn't queue a future for every one of them
+        pending = collections.deque()
+        for output_col_chunk in range(num_col_chunks):
+            for row_chunk in range(num_row_chunks):
+                if output_col_chunk in raw_copies:
+                    input_array, input_col_chunk = raw_copies[output_col_chunk]
+                    pending.append(executor.submit(
+                        _copy_chunk, input_array, output_array,
+                        row_chunk, input_col_chunk, output_col_chunk))
+                else:
+                    pending.append(executor.submit(
+                        _write_chunk, input_arrays, col_offsets,
+                        output_array, row_chunk, output_col_chunk))
+                if len(pending) >= 4 * workers:
+                    pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+    task_timing.count_size("bytes_written", output_path)
+
+@task_timing.phase("verify")
+def verify_zarrs(matrix_path, test_yaml_path):
+
+    output_matrix = zarr.open_array(matrix_path, mode="r")
+
+    with task_timing.phase("stats"):
+        non_zero_count, total = matrix_stats.dense_stats(output_matrix, output_matrix.chunks)
+    matrix_stats.check_expected(test_yaml_path, non_zero_count, total, output_matrix.shape)
 
 def main():
 
@@ -45,6 +210,27 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--engine",
+        choices=["chunked", "concatenate"],
+        default="chunked",
+        help=("How to merge the matrices. chunked writes the output one chunk "
+              "at a time, concatenate loads all the inputs into memory.")
+    )
+    test_group.add_argument(
+        "--chunks",
+        nargs=2,
+        type=int,
+        help=("Chunk shape of the output array. Defaults to the inputs' chunk "
+              "shape, or if they differ, their row chunk height and widest "
+              "column chunk.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        help=("Number of threads opening inputs and writing output chunks. "
+              "Defaults to the number of CPUs the task may run on.")
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -59,7 +245,11 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_zarrs(args.input_paths, args.output_path)
+        if args.engine == "chunked":
+            merge_zarrs_chunked(args.input_paths, args.output_path,
+                                args.chunks, args.workers)
+        else:
+            merge_zarrs(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_zarrs(args.output_matrix, args.test_yaml)
 